@@ -18,6 +18,10 @@ setup(
     description='Miscelleneous Django utils and design patterns as used by Visualspace.',
     long_description=README,
     install_requires=REQUIREMENTS,
+    extras_require={
+        # Migrations for the outbox and listener queue tables
+        'south': ['South>=1.0'],
+    },
     author='Mathijs de Bruin',
     author_email='mathijs@visualspace.nl',
     url='https://github.com/visualspace/django-vspace-utils',
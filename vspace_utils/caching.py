@@ -0,0 +1,142 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded mapping with optional per-entry expiry.
+
+    Usage::
+
+        cache = LRUCache(maxsize=100, ttl=60)
+        cache.set('key', 'value')
+        cache.set('other', 'value', ttl=5)
+
+        cache.get('key')
+
+    When the cache is full, the least recently used entry is discarded.
+    Entries without a `ttl` (and a cache without a default `ttl`) never
+    expire.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the value for `key` or `default` when absent or expired. """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= time.time():
+                return default
+
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` for `key`, expiring after `ttl` seconds. """
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl is not None:
+            expires = time.time() + ttl
+        else:
+            expires = None
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Call(object):
+    """ A single in-flight call, shared by all threads waiting for it. """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Collapse concurrent calls for the same key into a single call.
+
+    The first thread calling `do()` for a given key executes the function,
+    other threads calling `do()` for that key in the meantime wait for it
+    and receive the same result (or exception).
+
+    Usage::
+
+        flight = SingleFlight()
+        result = flight.do('example.com', expensive_lookup, 'example.com')
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            logger.debug('Waiting for in-flight call for %s', key)
+            call.event.wait()
+
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.event.set()
+
+        return call.result
@@ -0,0 +1,200 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import atexit
+import sys
+import threading
+
+from contextlib import contextmanager
+
+from django.utils.datastructures import SortedDict
+
+from vspace_utils import stats
+from vspace_utils.scopes import BlockScope, register_request_scope
+
+
+# Counter for saved dispatches in the statistics
+COALESCED = 'coalesced'
+
+
+# Calls delayed for a time window, keyed by (function, key)
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+class PendingCall(object):
+    """ A delayed call, carrying the latest arguments. """
+
+    def __init__(self, func, name, sender, kwargs):
+        self.func = func
+        self.name = name
+        self.sender = sender
+        self.kwargs = kwargs
+        self.count = 1
+
+    def update(self, sender, kwargs, count=1):
+        self.sender = sender
+        self.kwargs = kwargs
+        self.count += count
+
+        # Merging `count` dispatches saves a single call
+        stats.incr(self.name, COALESCED)
+
+    def run(self):
+        if self.count > 1:
+            logger.debug(
+                'Running %s once for %d dispatches', self.name, self.count)
+
+        return self.func(self.sender, **self.kwargs)
+
+
+def _run_calls(calls):
+    """ Run all calls, raising the first exception afterwards. """
+    exc_info = None
+
+    for call in calls:
+        try:
+            call.run()
+        except Exception:
+            logger.exception('Error running coalesced %s', call.name)
+
+            if exc_info is None:
+                exc_info = sys.exc_info()
+
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+class CoalescingScope(BlockScope):
+    """ Blocks of pending calls, keyed by (function, key). """
+
+    # Within the message batch of the request, so messages sent by
+    # coalesced listeners are batched as well
+    order = 200
+
+    def create_block(self):
+        return SortedDict()
+
+    def merge_block(self, outer, block):
+        for key, call in block.iteritems():
+            if key in outer:
+                outer[key].update(call.sender, call.kwargs, call.count)
+            else:
+                outer[key] = call
+
+    def run_block(self, block):
+        _run_calls(block.values())
+
+
+_blocks = CoalescingScope('coalesced calls')
+register_request_scope(_blocks)
+
+
+def begin_block():
+    """ Start collecting dispatches of coalescing listeners. """
+    _blocks.begin()
+
+
+def end_block(run=True):
+    """
+    Stop collecting dispatches, running the collected calls if `run` is
+    set or discarding them otherwise. Calls of nested blocks are merged into
+    the enclosing block and only run when the outermost block ends.
+    """
+    _blocks.end(run)
+
+
+def _run_window(key):
+    with _windows_lock:
+        call = _windows.pop(key, None)
+
+    if call is not None:
+        try:
+            call.run()
+        except Exception:
+            logger.exception('Error running coalesced %s', call.name)
+
+
+def coalesce(func, name, key, sender, kwargs, window=None):
+    """
+    Call `func(sender, **kwargs)` once for all dispatches with the same
+    `key`, using the arguments of the latest dispatch. `name` is used for
+    logging and statistics.
+
+    Within a block, ie. a request or `coalesced_signals()`, the call is
+    delayed until the block ends. Outside of blocks, the call is delayed
+    for `window` seconds and run from a separate thread. Without a window,
+    it is run right away.
+    """
+    blocks = _blocks.get_blocks()
+    key = (func, key)
+
+    if blocks:
+        pending = blocks[-1]
+
+        if key in pending:
+            pending[key].update(sender, kwargs)
+        else:
+            pending[key] = PendingCall(func, name, sender, kwargs)
+
+        return
+
+    if not window:
+        return func(sender, **kwargs)
+
+    with _windows_lock:
+        if key in _windows:
+            _windows[key].update(sender, kwargs)
+            return
+
+        _windows[key] = PendingCall(func, name, sender, kwargs)
+
+    timer = threading.Timer(window, _run_window, [key])
+    timer.daemon = True
+    timer.start()
+
+
+def flush_windows():
+    """ Run all calls waiting for their time window to pass. """
+    with _windows_lock:
+        calls = _windows.values()
+        _windows.clear()
+
+    _run_calls(calls)
+
+
+@contextmanager
+def coalesced_signals():
+    """
+    Collapse dispatches to coalescing listeners within the block, running
+    each listener once when it exits, or not at all when it raises an
+    exception.
+
+    Place the block around the transaction, so listeners only run after it
+    has been committed::
+
+        with coalesced_signals():
+            with transaction.commit_on_success():
+                obj.save()
+                formset.save()
+    """
+    begin_block()
+
+    try:
+        yield
+    except:
+        end_block(run=False)
+        raise
+
+    end_block()
+
+
+def _flush_windows_at_exit():
+    try:
+        flush_windows()
+    except Exception:
+        # Already logged
+        pass
+
+
+atexit.register(_flush_windows_at_exit)
@@ -0,0 +1,281 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import atexit
+import base64
+import cPickle as pickle
+import threading
+import time
+
+from Queue import Queue, Full, Empty
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.db.models.base import ModelBase
+from django.utils.importlib import import_module
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6
+    from django.db import close_connection as close_old_connections
+
+
+def import_by_path(path):
+    """ Import a class or function by its dotted path. """
+    module_name, attr = path.rsplit('.', 1)
+
+    try:
+        return getattr(import_module(module_name), attr)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Could not import %s: %s' % (path, e))
+
+
+def run_listener(listener_class, initkwargs, sender, kwargs):
+    """ Instantiate a listener and dispatch a signal to it. """
+    listener = listener_class(**initkwargs)
+    return listener.run(sender, **kwargs)
+
+
+def serialize_payload(listener_class, initkwargs, sender, kwargs):
+    """
+    Pickle a signal dispatch for later execution, possibly in another
+    process. The following rules apply:
+
+    * The listener class is stored by its dotted path, so it should be
+      importable from its module.
+    * Model classes as sender are stored by app label and model name.
+      Other senders are pickled as they are.
+    * The `signal` keyword argument is left out, as signals can't be
+      pickled. All other keyword arguments, including `initkwargs`, are
+      pickled as they are; model instances are stored in the state they
+      are in when the signal is sent.
+
+    Raises `pickle.PicklingError` or `TypeError` for unpicklable payloads.
+    """
+    if isinstance(sender, ModelBase):
+        sender = ('model', sender._meta.app_label, sender._meta.object_name)
+    else:
+        sender = ('object', sender)
+
+    kwargs = dict(
+        (key, value) for key, value in kwargs.iteritems() if key != 'signal'
+    )
+
+    payload = pickle.dumps(
+        (initkwargs, sender, kwargs), pickle.HIGHEST_PROTOCOL)
+
+    listener_path = '%s.%s' % (
+        listener_class.__module__, listener_class.__name__)
+
+    return listener_path, base64.b64encode(payload)
+
+
+def deserialize_payload(listener_path, payload):
+    """
+    Reverse `serialize_payload`, returning a tuple
+    `(listener_class, initkwargs, sender, kwargs)`.
+    """
+    listener_class = import_by_path(listener_path)
+
+    initkwargs, sender, kwargs = pickle.loads(base64.b64decode(payload))
+
+    if sender[0] == 'model':
+        sender = models.get_model(sender[1], sender[2])
+    else:
+        sender = sender[1]
+
+    return listener_class, initkwargs, sender, kwargs
+
+
+class BaseExecutor(object):
+    """
+    Executes listeners outside of the thread sending the signal.
+
+    When a call cannot be handed off, ie. because the queue is full or the
+    payload can't be serialized, it is executed synchronously in the
+    calling thread instead and a warning is logged.
+    """
+
+    def submit(self, listener_class, initkwargs, sender, kwargs):
+        raise NotImplementedError
+
+    def run_synchronously(self, listener_class, initkwargs, sender, kwargs,
+                          reason):
+        logger.warning(
+            'Running %s synchronously: %s', listener_class.__name__, reason)
+
+        return run_listener(listener_class, initkwargs, sender, kwargs)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ThreadPoolExecutor(BaseExecutor):
+    """
+    Runs listeners on a pool of `max_workers` threads in the current
+    process.
+
+    At most `max_queue` calls wait for execution. On shutdown, which is
+    performed automatically when the interpreter exits, queued calls are
+    drained for at most `drain_timeout` seconds.
+
+    Listeners may run before the transaction of the code sending the
+    signal has been committed, so they may not see its changes yet. Use
+    `DatabaseExecutor` when listeners depend on those. Database
+    connections opened by listeners are closed after every call.
+    """
+
+    def __init__(self, max_workers=4, max_queue=1000, drain_timeout=30):
+        self.max_workers = max_workers
+        self.drain_timeout = drain_timeout
+
+        self._queue = Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+        atexit.register(self.shutdown)
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                # Drained through the atexit hook, don't block exiting
+                thread.daemon = True
+                thread.start()
+
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+
+            try:
+                if call is None:
+                    return
+
+                run_listener(*call)
+
+            except Exception:
+                logger.exception('Error running listener %s', call[0])
+
+            finally:
+                # Django only closes connections at the end of requests
+                try:
+                    close_old_connections()
+                except Exception:
+                    logger.exception('Error closing database connection')
+
+                self._queue.task_done()
+
+    def submit(self, listener_class, initkwargs, sender, kwargs):
+        if self._shutdown:
+            return self.run_synchronously(
+                listener_class, initkwargs, sender, kwargs,
+                'executor has been shut down'
+            )
+
+        if len(self._threads) < self.max_workers:
+            self._start()
+
+        try:
+            self._queue.put_nowait((listener_class, initkwargs, sender, kwargs))
+        except Full:
+            return self.run_synchronously(
+                listener_class, initkwargs, sender, kwargs, 'queue is full')
+
+    def shutdown(self, wait=True):
+        """ Stop accepting calls and drain the queue, if `wait` is set. """
+        if self._shutdown:
+            return
+
+        self._shutdown = True
+
+        if not self._threads:
+            return
+
+        deadline = time.time() + self.drain_timeout
+
+        for thread in self._threads:
+            # Sentinel, put after all queued calls
+            try:
+                if wait:
+                    self._queue.put(
+                        None, timeout=max(deadline - time.time(), 0))
+                else:
+                    self._queue.put_nowait(None)
+
+            except Full:
+                # The (daemonic) workers keep running until the process ends
+                break
+
+        if wait:
+            for thread in self._threads:
+                thread.join(max(deadline - time.time(), 0))
+
+            if any(thread.is_alive() for thread in self._threads):
+                logger.warning(
+                    'Listener queue not drained within %d seconds',
+                    self.drain_timeout
+                )
+
+
+class DatabaseExecutor(BaseExecutor):
+    """
+    Stores calls in the database as `QueuedListenerCall`'s, to be executed
+    by the `process_listener_queue` management command. Payloads are
+    serialized according to the rules of `serialize_payload`.
+
+    When `max_queue` is set and at least that many calls are waiting, new
+    calls are executed synchronously.
+    """
+
+    def __init__(self, max_queue=None):
+        self.max_queue = max_queue
+
+    def submit(self, listener_class, initkwargs, sender, kwargs):
+        from vspace_utils.models import QueuedListenerCall
+
+        if self.max_queue is not None and \
+                QueuedListenerCall.objects.count() >= self.max_queue:
+            return self.run_synchronously(
+                listener_class, initkwargs, sender, kwargs, 'queue is full')
+
+        try:
+            listener_path, payload = serialize_payload(
+                listener_class, initkwargs, sender, kwargs)
+
+        except (pickle.PicklingError, TypeError), e:
+            return self.run_synchronously(
+                listener_class, initkwargs, sender, kwargs,
+                'payload could not be pickled (%s)' % e
+            )
+
+        QueuedListenerCall.objects.create(
+            listener=listener_path, payload=payload)
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+    """
+    Return the executor for background listeners, as configured by the
+    `LISTENER_EXECUTOR` setting (a dotted path to an executor class),
+    defaulting to `ThreadPoolExecutor`.
+    """
+    global _default_executor
+
+    with _default_executor_lock:
+        if _default_executor is None:
+            executor_path = getattr(
+                settings, 'LISTENER_EXECUTOR',
+                'vspace_utils.executors.ThreadPoolExecutor'
+            )
+
+            _default_executor = import_by_path(executor_path)()
+
+    return _default_executor
@@ -3,24 +3,43 @@ logger = logging.getLogger(__name__)
 
 import datetime
 
-# Note: we need dnspython for this to work
-# Install with `pip install dnspython`
-import dns.resolver
-import dns.exception
-
 from django import forms
 from django.utils.translation import ugettext as _
 from django.utils import dates
 
+from vspace_utils.mx import get_default_resolver, validate_domain
+
 
 class ValidatingEmailField(forms.EmailField):
     """
     Django EmailField which checks for MX records on the email domain.
     Requires dnspython to be installed.
 
+    Lookups go through a `CachingResolver`, by default the process-wide one
+    from `vspace_utils.mx`. A different (ie. stub) resolver can be given
+    with the `resolver` argument.
+
+    MX and A/AAAA records are looked up concurrently, for at most `lifetime`
+    seconds. What happens when lookups time out is determined by
+    `on_timeout`, one of 'reject' (default), 'accept' or 'defer'; see
+    `vspace_utils.mx.validate_domain`.
+
     Initially published at: https://gist.github.com/876648
     """
 
+    def __init__(self, *args, **kwargs):
+        self.resolver = kwargs.pop('resolver', None)
+        self.lifetime = kwargs.pop('lifetime', None)
+        self.on_timeout = kwargs.pop('on_timeout', 'reject')
+
+        super(ValidatingEmailField, self).__init__(*args, **kwargs)
+
+    def get_resolver(self):
+        if self.resolver is None:
+            return get_default_resolver()
+
+        return self.resolver
+
     def clean(self, value):
         email = super(ValidatingEmailField, self).clean(value)
 
@@ -31,19 +50,47 @@ class ValidatingEmailField(forms.EmailField):
         domain = email.split('@')[1]
 
         # Make sure the domain exists
-        try:
-            logger.debug('Checking domain %s', domain)
+        validate_domain(
+            domain, self.get_resolver(),
+            lifetime=self.lifetime, on_timeout=self.on_timeout
+        )
+
+        return email
+
 
-            dns.resolver.query(domain, 'MX')
+class _LazyChoices(object):
+    """
+    Choices returned by `func(*args)`, called whenever they are iterated,
+    ie. when rendering or validating, rather than when constructing.
+    """
 
-        except dns.exception.DNSException, e:
-            logger.debug('Domain %s does not exist.', e)
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
 
-            raise forms.ValidationError(_(
-                u"The domain %s could not be found.") % domain
-            )
+    def __iter__(self):
+        return iter(self.func(*self.args))
 
-        return email
+    def __deepcopy__(self, memo):
+        # Immutable, shared between copies of forms
+        return self
+
+
+class _LazySelect(forms.Select):
+    """ Select widget which doesn't evaluate its choices up front. """
+
+    def __init__(self, attrs=None, choices=()):
+        super(_LazySelect, self).__init__(attrs)
+        self.choices = choices
+
+
+class _LazyChoiceField(forms.ChoiceField):
+    """ Choice field which doesn't evaluate its choices up front. """
+
+    def _set_choices(self, value):
+        self._choices = self.widget.choices = value
+
+    choices = property(forms.ChoiceField._get_choices, _set_choices)
 
 
 class SplitDateFormField(forms.MultiValueField):
@@ -57,44 +104,129 @@ class SplitDateFormField(forms.MultiValueField):
 
     If from_date=datetime.date(2007,01,01), till_date=datetime.date(2010,01,01)
     and reverse=False, then we obtain the sequence of years: 2007, 2008, 2009, 2010
+
+    A callable till_date is evaluated when the field is rendered or
+    validated, at most once per day for all fields. Year choices and widget
+    classes are shared between fields with the same range of years.
     """
     EMPTY = [('', u'---')]
     DAYS = [(day, '%02d' % day) for day in xrange(1, 32)]
     MONTHS = [(month, dates.MONTHS[month]) for month in xrange(1, 13)]
     DEFAULT_FROM_YEAR = 1930
 
+    # Caches for year choices and widget classes, keyed by the class as
+    # subclasses may override the choices or the widget factory
+    _years_cache = {}
+    _lazy_years_cache = {}
+    _widget_cache = {}
+
+    # Values of callable till_date's, by callable, for the current day
+    _till_dates = (None, {})
+
     def __init__(
         self, from_date=datetime.date(DEFAULT_FROM_YEAR, 01, 01),
         till_date=datetime.date.today, reverse=False, *args, **kwargs
     ):
         if callable(from_date):
             from_date = from_date()
-        if callable(till_date):
-            till_date = till_date()
         self.from_date = from_date
-        self.till_date = till_date
-        from_year = from_date.year
-        till_year = till_date.year
-        years = [(year, '%04d' % year) for year in xrange(
-            till_year, from_year - 1, -1)]
+        self._till_date = till_date
 
-        if reverse:
-            years.reverse()
+        key = (from_date.year, till_date, reverse)
 
         errors = self.default_error_messages.copy()
         if 'error_messages' in kwargs:
             errors.update(kwargs['error_messages'])
 
-        kwargs['widget'] = self.widget_factory(years)
+        kwargs['widget'] = self.get_widget_class(*key)
 
         fields = (
             forms.ChoiceField(choices=self.DAYS),
             forms.ChoiceField(choices=self.MONTHS),
-            forms.ChoiceField(choices=years),
+            _LazyChoiceField(choices=self.get_lazy_years(*key)),
         )
 
         super(SplitDateFormField, self).__init__(fields, *args, **kwargs)
 
+    @property
+    def till_date(self):
+        """ The maximum date. """
+        return self.get_till_date(self._till_date)
+
+    @classmethod
+    def get_till_date(cls, till_date):
+        """ Evaluate a callable till_date, at most once a day. """
+        if not callable(till_date):
+            return till_date
+
+        today = datetime.date.today()
+
+        day, till_dates = SplitDateFormField._till_dates
+        if day != today:
+            till_dates = {}
+            SplitDateFormField._till_dates = (today, till_dates)
+
+        if till_date not in till_dates:
+            till_dates[till_date] = till_date()
+
+        return till_dates[till_date]
+
+    @classmethod
+    def get_year_choices(cls, from_year, till_date, reverse=False):
+        """ Return the year choices up to the year of till_date. """
+        return cls.get_years(
+            from_year, cls.get_till_date(till_date).year, reverse)
+
+    @classmethod
+    def get_lazy_years(cls, from_year, till_date, reverse=False):
+        """
+        Return (cached) year choices up to the year of till_date, which are
+        determined when iterated.
+        """
+        key = (cls, from_year, till_date, reverse)
+
+        years = cls._lazy_years_cache.get(key)
+        if years is None:
+            years = _LazyChoices(
+                cls.get_year_choices, from_year, till_date, reverse)
+            cls._lazy_years_cache[key] = years
+
+        return years
+
+    @classmethod
+    def get_years(cls, from_year, till_year, reverse=False):
+        """ Return (cached) choices for the years in the given range. """
+        key = (cls, from_year, till_year, reverse)
+
+        years = cls._years_cache.get(key)
+        if years is None:
+            years = [(year, '%04d' % year) for year in xrange(
+                till_year, from_year - 1, -1)]
+
+            if reverse:
+                years.reverse()
+
+            years = tuple(years)
+            cls._years_cache[key] = years
+
+        return years
+
+    @classmethod
+    def get_widget_class(cls, from_year, till_date, reverse=False):
+        """
+        Return the (cached) widget class for the given range of years, of
+        which the choices are determined when rendering.
+        """
+        key = (cls, from_year, till_date, reverse)
+
+        widget_class = cls._widget_cache.get(key)
+        if widget_class is None:
+            widget_class = cls.widget_factory(
+                cls.get_lazy_years(from_year, till_date, reverse))
+            cls._widget_cache[key] = widget_class
+
+        return widget_class
+
     def compress(self, value_list):
         error_messages = forms.SplitDateTimeField.default_error_messages
 
@@ -127,7 +259,8 @@ class SplitDateFormField(forms.MultiValueField):
                 widgets = (
                     forms.Select(attrs=None, choices=cls.EMPTY + cls.DAYS),
                     forms.Select(attrs=None, choices=cls.EMPTY + cls.MONTHS),
-                    forms.Select(attrs=None, choices=cls.EMPTY + years),
+                    _LazySelect(attrs=None, choices=_LazyChoices(
+                        lambda: cls.EMPTY + list(years))),
                 )
                 super(SplitDateWidget, self).__init__(widgets, attrs)
 
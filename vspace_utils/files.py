@@ -0,0 +1,335 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import mimetypes
+import os
+import re
+import struct
+
+from os.path import splitext
+
+from django.core.files.images import get_image_dimensions as \
+    pil_image_dimensions
+from django.utils.functional import cached_property
+
+from vspace_utils.images import (
+    BMP_HEADER_SIZES, RangeReader, parse_image_dimensions
+)
+
+
+# Number of bytes read from the start of a file for sniffing its type
+HEADER_SIZE = 4096
+
+# Number of bytes read at once when inspecting files, enough to find the
+# dimensions of most images without further reads
+WINDOW_SIZE = 64 * 1024
+
+# Signatures as (offset, magic bytes, mimetype), checked in order
+SIGNATURES = (
+    (0, '\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, 'GIF87a', 'image/gif'),
+    (0, 'GIF89a', 'image/gif'),
+    (0, '\xff\xd8\xff', 'image/jpeg'),
+    (0, 'BM', 'image/bmp'),
+    (0, 'II*\x00', 'image/tiff'),
+    (0, 'MM\x00*', 'image/tiff'),
+    (0, '\x00\x00\x01\x00', 'image/x-icon'),
+    (0, '8BPS', 'image/vnd.adobe.photoshop'),
+    (0, '%PDF-', 'application/pdf'),
+    (0, '%!PS', 'application/postscript'),
+    (0, '{\\rtf', 'application/rtf'),
+    (0, 'PK\x03\x04', 'application/zip'),
+    (0, 'PK\x05\x06', 'application/zip'),
+    (0, '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (0, '\x1f\x8b', 'application/gzip'),
+    (0, 'BZh', 'application/x-bzip2'),
+    (0, 'Rar!\x1a\x07', 'application/x-rar-compressed'),
+    (0, '7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, '\xfd7zXZ\x00', 'application/x-xz'),
+    (0, 'ID3', 'audio/mpeg'),
+    (0, '\xff\xfb', 'audio/mpeg'),
+    (0, '\xff\xf3', 'audio/mpeg'),
+    (0, 'OggS', 'audio/ogg'),
+    (0, 'fLaC', 'audio/flac'),
+    (0, '\x1aE\xdf\xa3', 'video/webm'),
+    (0, 'FLV\x01', 'video/x-flv'),
+    (0, 'wOFF', 'font/woff'),
+    (0, 'wOF2', 'font/woff2'),
+    (4, 'ftypqt', 'video/quicktime'),
+    (4, 'ftypM4A', 'audio/mp4'),
+    (4, 'ftyp', 'video/mp4'),
+)
+
+def _is_bmp(header):
+    # The file header is followed by a DIB header starting with its size
+    if len(header) < 18:
+        return False
+
+    return struct.unpack('<I', header[14:18])[0] in BMP_HEADER_SIZES
+
+
+def _is_mp3_frame(header):
+    # The third byte of an MPEG audio frame header holds the bitrate and
+    # the sampling rate, of which some values are invalid
+    if len(header) < 4:
+        return False
+
+    bitrate = ord(header[2]) >> 4
+    sampling_rate = (ord(header[2]) >> 2) & 0x03
+
+    return bitrate not in (0x00, 0x0f) and sampling_rate != 0x03
+
+
+# Short signatures which also occur in other files, ie. text, and need
+# further checks
+SIGNATURE_CHECKS = {
+    'BM': _is_bmp,
+    '\xff\xfb': _is_mp3_frame,
+    '\xff\xf3': _is_mp3_frame,
+}
+
+# RIFF containers, identified by the form type at offset 8
+RIFF_TYPES = {
+    'WEBP': 'image/webp',
+    'WAVE': 'audio/wav',
+    'AVI ': 'video/x-msvideo',
+}
+
+# Start of SVG documents: the svg root element, optionally preceded by an
+# XML declaration, a doctype and comments
+SVG_ROOT = re.compile(
+    r'(<\?xml[^>]*\?>\s*)?(<!--.*?-->\s*)*(<!doctype[^>]*>\s*)?'
+    r'(<!--.*?-->\s*)*<svg[\s>]',
+    re.DOTALL
+)
+
+# Generic sniffed types which may be refined by the type guessed from
+# the file name, when it is in the same family.
+FAMILIES = {
+    'application/zip': (
+        'application/vnd.openxmlformats-officedocument.',
+        'application/vnd.oasis.opendocument.',
+        'application/epub+zip',
+        'application/java-archive',
+    ),
+    'application/x-ole-storage': (
+        'application/msword',
+        'application/vnd.ms-',
+    ),
+    'text/plain': ('text/', ),
+    'application/xml': (
+        'text/xml',
+        'application/xhtml+xml',
+        'application/rss+xml',
+        'application/atom+xml',
+    ),
+}
+
+
+def sniff_mimetype(header, name=None):
+    """
+    Determine the mimetype of a file from the first bytes of its contents.
+    Returns `None` when the type cannot be determined.
+
+    Some formats, ie. zip-based office documents and text files, cannot be
+    told apart from their header alone. For these, the type guessed from
+    `name` is returned when it belongs to the same family.
+    """
+    mimetype = None
+
+    if header[:4] == 'RIFF':
+        mimetype = RIFF_TYPES.get(header[8:12])
+
+    else:
+        for offset, magic, signature_type in SIGNATURES:
+            if header[offset:offset + len(magic)] != magic:
+                continue
+
+            check = SIGNATURE_CHECKS.get(magic)
+            if check is None or check(header):
+                mimetype = signature_type
+                break
+
+    if mimetype is None:
+        mimetype = sniff_text(header)
+
+    if mimetype in FAMILIES and name:
+        guessed = mimetypes.guess_type(name)[0]
+
+        if guessed and guessed.startswith(FAMILIES[mimetype]):
+            mimetype = guessed
+
+    return mimetype
+
+
+def sniff_text(header):
+    """
+    Detect HTML, SVG, XML or plain text files. Only documents with an svg
+    root element are considered SVG, not ie. HTML with inline SVG.
+    """
+    if '\x00' in header:
+        # Binary
+        return None
+
+    try:
+        text = header.decode('utf-8')
+    except UnicodeDecodeError:
+        # Could be truncated in the middle of a multibyte character
+        try:
+            text = header[:-3].decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    start = text.lstrip(u'\ufeff \t\r\n')[:1024].lower()
+
+    if start.startswith((u'<!doctype html', u'<html')):
+        return 'text/html'
+
+    if SVG_ROOT.match(start):
+        return 'image/svg+xml'
+
+    if start.startswith(u'<?xml'):
+        return 'application/xml'
+
+    return 'text/plain'
+
+
+def _get_file(value):
+    """ Return the underlying file object for (field) files. """
+    return getattr(value, 'file', value)
+
+
+def read_header(value, size=HEADER_SIZE):
+    """
+    Read the first `size` bytes of a file, restoring its position afterwards.
+    """
+    f = _get_file(value)
+
+    try:
+        position = f.tell()
+    except (AttributeError, IOError, ValueError):
+        position = None
+
+    f.seek(0)
+    header = f.read(size)
+
+    if position is not None:
+        f.seek(position)
+
+    return header
+
+
+def get_file_size(value):
+    """
+    Determine the size of a file through Django's file or storage API,
+    falling back to seeking to the end of the file.
+    """
+    try:
+        return value.size
+    except (AttributeError, IOError, OSError, NotImplementedError):
+        pass
+
+    f = _get_file(value)
+
+    position = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(position)
+
+    return size
+
+
+class FileInfo(object):
+    """
+    Properties of a file which are relevant for validation, each computed
+    only once and from a single buffered window at the start of the file.
+
+    Use `inspect_file()` to share one instance between validators.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.name = value.name
+
+    @cached_property
+    def extension(self):
+        return splitext(self.name)[1][1:].lower()
+
+    @cached_property
+    def size(self):
+        return get_file_size(self.value)
+
+    @cached_property
+    def reader(self):
+        reader = RangeReader(_get_file(self.value))
+        reader.block_size = WINDOW_SIZE
+
+        return reader
+
+    def _read(self, func):
+        """ Call `func` with the reader, restoring the file position. """
+        f = _get_file(self.value)
+
+        try:
+            position = f.tell()
+        except (AttributeError, IOError, ValueError):
+            position = None
+
+        try:
+            return func(self.reader)
+        finally:
+            if position is not None:
+                f.seek(position)
+
+    @cached_property
+    def header(self):
+        return self._read(lambda reader: reader.read_at(0, HEADER_SIZE))
+
+    @cached_property
+    def mimetype(self):
+        """ The sniffed mimetype or `None` when unknown. """
+        return sniff_mimetype(self.header, self.name)
+
+    @cached_property
+    def client_mimetype(self):
+        """ The mimetype as supplied by the client, if any. """
+        return getattr(_get_file(self.value), 'content_type', None)
+
+    @cached_property
+    def dimensions(self):
+        """ Image (width, height), `(None, None)` when not an image. """
+        if self.mimetype is not None and \
+                not self.mimetype.startswith('image/'):
+            # Don't read (the rest of) files known not to be images
+            return (None, None)
+
+        dimensions = self._read(
+            lambda reader: parse_image_dimensions(reader=reader))
+
+        if dimensions is None:
+            # Fall back to PIL for other formats
+            dimensions = pil_image_dimensions(_get_file(self.value))
+
+        return tuple(dimensions)
+
+
+def inspect_file(value):
+    """
+    Return the `FileInfo` for a (field) file, shared between all callers
+    for as long as the underlying file object stays the same.
+    """
+    f = _get_file(value)
+
+    cached = getattr(value, '_file_info', None)
+    if cached is not None and cached[0] is f:
+        return cached[1]
+
+    info = FileInfo(value)
+
+    try:
+        value._file_info = (f, info)
+    except AttributeError:
+        # Objects with __slots__, ie. some file wrappers
+        pass
+
+    return info
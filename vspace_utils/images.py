@@ -0,0 +1,229 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import struct
+
+from django.core.files.images import get_image_dimensions as \
+    pil_image_dimensions
+
+
+class RangeReader(object):
+    """
+    Random access reads on a file object through seek/read, buffering a
+    block at a time. For storage-backed files supporting seeking, ie. files
+    on S3, this only fetches the requested ranges.
+    """
+
+    block_size = 4096
+
+    def __init__(self, f):
+        self.file = f
+        self.bytes_read = 0
+
+        self._offset = 0
+        self._buffer = ''
+
+    def read_at(self, offset, size):
+        """
+        Return `size` bytes at `offset`, or less at the end of the file.
+        """
+        start = offset - self._offset
+        if start >= 0 and start + size <= len(self._buffer):
+            return self._buffer[start:start + size]
+
+        self.file.seek(offset)
+        self._buffer = self.file.read(max(size, self.block_size))
+        self._offset = offset
+
+        self.bytes_read += len(self._buffer)
+
+        return self._buffer[:size]
+
+
+def _png_dimensions(reader):
+    header = reader.read_at(12, 12)
+    if header[:4] != 'IHDR':
+        return None
+
+    return struct.unpack('>II', header[4:12])
+
+
+def _gif_dimensions(reader):
+    return struct.unpack('<HH', reader.read_at(6, 4))
+
+
+# Sizes of the known DIB headers, following the 14 byte file header
+BMP_HEADER_SIZES = frozenset((12, 40, 52, 56, 64, 108, 124))
+
+
+def _bmp_dimensions(reader):
+    header = reader.read_at(14, 12)
+    header_size = struct.unpack('<I', header[:4])[0]
+
+    if header_size not in BMP_HEADER_SIZES:
+        # Not a bitmap, ie. text starting with 'BM'
+        return None
+
+    if header_size == 12:
+        # OS/2 BITMAPCOREHEADER
+        return struct.unpack('<HH', header[4:8])
+
+    width, height = struct.unpack('<ii', header[4:12])
+
+    # Negative heights denote top-down bitmaps
+    return width, abs(height)
+
+
+def _webp_dimensions(reader):
+    header = reader.read_at(12, 18)
+    chunk = header[:4]
+
+    if chunk == 'VP8 ':
+        width, height = struct.unpack('<HH', header[14:18])
+        return width & 0x3fff, height & 0x3fff
+
+    if chunk == 'VP8L':
+        bits = struct.unpack('<I', header[9:13])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+
+    if chunk == 'VP8X':
+        width = struct.unpack('<I', header[12:15] + '\x00')[0]
+        height = struct.unpack('<I', header[15:18] + '\x00')[0]
+        return width + 1, height + 1
+
+    return None
+
+
+# Start Of Frame markers, which contain the image dimensions
+JPEG_SOF_MARKERS = frozenset(
+    range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+
+# Markers without a length: RSTn, SOI and TEM
+JPEG_STANDALONE_MARKERS = frozenset(range(0xd0, 0xd9) + [0x01])
+
+
+def _jpeg_dimensions(reader):
+    # Skip segments until we hit a Start Of Frame marker
+    offset = 2
+
+    while True:
+        segment = reader.read_at(offset, 9)
+        if len(segment) < 2 or segment[0] != '\xff':
+            return None
+
+        marker = ord(segment[1])
+
+        if marker == 0xff:
+            # Fill byte
+            offset += 1
+            continue
+
+        if marker == 0xd9:
+            # End of image
+            return None
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+
+        if len(segment) < 4:
+            return None
+
+        if marker in JPEG_SOF_MARKERS:
+            if len(segment) < 9:
+                return None
+
+            height, width = struct.unpack('>HH', segment[5:9])
+            return width, height
+
+        length = struct.unpack('>H', segment[2:4])[0]
+        offset += 2 + length
+
+
+# Parsers as (offset, magic bytes, parser)
+PARSERS = (
+    (0, '\x89PNG\r\n\x1a\n', _png_dimensions),
+    (0, 'GIF87a', _gif_dimensions),
+    (0, 'GIF89a', _gif_dimensions),
+    (0, '\xff\xd8', _jpeg_dimensions),
+    (8, 'WEBP', _webp_dimensions),
+    (0, 'BM', _bmp_dimensions),
+)
+
+
+def parse_image_dimensions(f=None, reader=None):
+    """
+    Parse the (width, height) of a PNG, GIF, JPEG, WebP or BMP image from
+    the file object `f`, reading only the required headers. Returns `None`
+    for other formats or corrupt images.
+
+    Instead of a file, an existing `RangeReader` may be given.
+    """
+    if reader is None:
+        reader = RangeReader(f)
+    header = reader.read_at(0, 16)
+
+    for offset, magic, parser in PARSERS:
+        if header[offset:offset + len(magic)] == magic:
+            try:
+                dimensions = parser(reader)
+            except struct.error:
+                # Truncated file
+                dimensions = None
+
+            logger.debug(
+                'Parsed image dimensions %s from %d bytes',
+                dimensions, reader.bytes_read
+            )
+
+            return dimensions
+
+    return None
+
+
+def get_image_dimensions(file_or_path):
+    """
+    Returns the (width, height) of an image, given an open file or a path.
+    This is a drop-in replacement for Django's `get_image_dimensions`,
+    which is used as a fallback for formats we can't parse ourselves.
+    """
+    if hasattr(file_or_path, 'read'):
+        f = file_or_path
+        close = False
+    else:
+        f = open(file_or_path, 'rb')
+        close = True
+
+    try:
+        try:
+            position = f.tell()
+        except (AttributeError, IOError, ValueError):
+            position = None
+
+        dimensions = parse_image_dimensions(f)
+
+        if position is not None:
+            f.seek(position)
+
+        if dimensions is None:
+            logger.debug('Falling back to PIL for image dimensions')
+            dimensions = pil_image_dimensions(f)
+
+        return tuple(dimensions)
+
+    finally:
+        if close:
+            f.close()
+
+
+def get_storage_image_dimensions(storage, name):
+    """
+    Returns the (width, height) of an image in a file storage, only reading
+    its headers if the storage's files support seeking.
+    """
+    f = storage.open(name, 'rb')
+
+    try:
+        return get_image_dimensions(f)
+    finally:
+        f.close()
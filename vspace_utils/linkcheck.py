@@ -0,0 +1,309 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import httplib
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+
+from collections import OrderedDict
+
+from vspace_utils.caching import LRUCache, SingleFlight
+
+
+class HostConnectionPool(object):
+    """
+    Pool of keep-alive HTTP(S) connections to a single host.
+
+    Idle connections are reused for subsequent requests and closed once
+    they have been idle for longer than `idle_timeout` seconds, as most
+    servers close keep-alive connections after a couple of seconds anyway.
+    Expired connections are swept whenever a connection is taken from or
+    returned to the pool. Connections returned after the pool has been
+    closed are closed right away.
+    """
+
+    def __init__(self, scheme, host, port=None, maxsize=4, timeout=10,
+                 idle_timeout=15):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            try:
+                connection_class = httplib.HTTPSConnection
+            except AttributeError:
+                # Python isn't compiled with SSL support
+                raise urllib2.URLError(
+                    'Not validating SSL URL\'s, Python isn\'t compiled '
+                    'with SSL support'
+                )
+        else:
+            connection_class = httplib.HTTPConnection
+
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def get(self):
+        """
+        Return a tuple `(connection, reused)`, where `reused` indicates
+        whether the connection has been used before.
+        """
+        now = time.time()
+
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+
+                if now - last_used < self.idle_timeout:
+                    return connection, True
+
+                connection.close()
+
+        return self.new_connection(), False
+
+    def _sweep(self, now):
+        # Close expired connections, the oldest are at the start
+        while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+            connection, last_used = self._idle.pop(0)
+            connection.close()
+
+    def put(self, connection):
+        """ Return a connection to the pool for later reuse. """
+        now = time.time()
+
+        with self._lock:
+            self._sweep(now)
+
+            if not self._closed and len(self._idle) < self.maxsize:
+                self._idle.append((connection, now))
+                return
+
+        connection.close()
+
+    def close(self):
+        """ Close all idle connections and stop accepting connections. """
+        with self._lock:
+            self._closed = True
+
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                connection.close()
+
+    def __len__(self):
+        return len(self._idle)
+
+
+class LinkChecker(object):
+    """
+    Check whether URL's exist by sending HEAD requests.
+
+    Connections are kept alive in a pool per host and results, positive as
+    well as negative, are cached for `ttl` and `negative_ttl` seconds
+    respectively. Concurrent checks for the same URL are collapsed into a
+    single request.
+
+    Redirects are not followed but are not considered errors either; any
+    response with a status code below 400 is considered a valid link.
+
+    Pools are kept for at most `max_pools` hosts; the pool of the least
+    recently checked host is closed when another one is needed.
+
+    Usage::
+
+        checker = LinkChecker()
+        if not checker.check('http://www.example.com/'):
+            # Broken link
+            pass
+    """
+
+    headers = {
+        "Accept": "text/xml,application/xml,application/xhtml+xml,text/html;q=0.9,text/plain;q=0.8,image/png,*/*;q=0.5",
+        "Accept-Language": "en-us,en;q=0.5",
+        "Accept-Charset": "ISO-8859-1,utf-8;q=0.7,*;q=0.7",
+        "Connection": "keep-alive",
+    }
+
+    def __init__(self, timeout=10, cache_size=1024, ttl=3600,
+                 negative_ttl=300, pool_size=4, max_pools=32):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.pool_size = pool_size
+        self.max_pools = max_pools
+
+        self.cache = LRUCache(maxsize=cache_size, ttl=ttl)
+
+        # Pools by (scheme, host, port), least recently used first
+        self._pools = OrderedDict()
+        self._pools_lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        evicted = []
+
+        with self._pools_lock:
+            pool = self._pools.pop(key, None)
+
+            if pool is None:
+                pool = HostConnectionPool(
+                    scheme, host, port,
+                    maxsize=self.pool_size, timeout=self.timeout
+                )
+
+            # (Re-)insert to mark as most recently used
+            self._pools[key] = pool
+
+            while len(self._pools) > self.max_pools:
+                evicted.append(self._pools.popitem(last=False)[1])
+
+        for evicted_pool in evicted:
+            evicted_pool.close()
+
+        return pool
+
+    def close(self):
+        """ Close all pooled connections. """
+        with self._pools_lock:
+            pools = self._pools.values()
+            self._pools = OrderedDict()
+
+        for pool in pools:
+            pool.close()
+
+    def check(self, url, headers=None):
+        """
+        Return `True` when the URL exists and `False` for broken links.
+
+        Raises `ValueError` when the URL cannot be checked at all, ie. when
+        it has no scheme or host.
+        """
+        result = self.cache.get(url)
+
+        if result is None:
+            result = self._flight.do(url, self._check, url, headers)
+        else:
+            logger.debug('Cached link check for %s: %s', url, result)
+
+        return result
+
+    def _check(self, url, headers):
+        # Another thread might have finished checking while we were waiting
+        result = self.cache.get(url)
+        if result is not None:
+            return result
+
+        try:
+            status = self.fetch(url, headers)
+        except ValueError:
+            raise
+        except Exception, e: # socket.error, httplib.HTTPException, etc.
+            logger.info('Error checking URL %s: %s', url, e)
+            status = None
+
+        result = status is not None and status < 400
+
+        if result:
+            self.cache.set(url, result, self.ttl)
+        else:
+            self.cache.set(url, result, self.negative_ttl)
+
+        return result
+
+    def get_headers(self, headers=None):
+        request_headers = self.headers.copy()
+
+        if headers:
+            request_headers.update(headers)
+
+        return request_headers
+
+    def fetch(self, url, headers=None):
+        """ Send a HEAD request for the URL and return the status code. """
+        parsed = urlparse.urlsplit(url)
+
+        if not parsed.scheme or not parsed.netloc:
+            raise ValueError('unknown url type: %s' % url)
+
+        if parsed.scheme not in ('http', 'https'):
+            return self.fetch_unpooled(url, headers)
+
+        pool = self.get_pool(parsed.scheme, parsed.hostname, parsed.port)
+
+        selector = urlparse.urlunsplit(
+            ('', '', parsed.path or '/', parsed.query, ''))
+        request_headers = self.get_headers(headers)
+
+        while True:
+            connection, reused = pool.get()
+
+            try:
+                connection.request('HEAD', selector, headers=request_headers)
+                response = connection.getresponse()
+                response.read()
+
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+
+                if reused:
+                    # Stale keep-alive connection, retry on a fresh one
+                    logger.debug('Retrying %s on new connection', url)
+                    continue
+
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                pool.put(connection)
+
+            return response.status
+
+    def fetch_unpooled(self, url, headers=None):
+        """
+        Fallback for schemes other than HTTP(S), ie. FTP, using a
+        non-persistent urllib2 opener.
+        """
+        request_headers = self.get_headers(headers)
+        request_headers['Connection'] = 'close'
+
+        req = urllib2.Request(url, None, request_headers)
+        req.get_method = lambda: 'HEAD'
+
+        # Create an opener that does not support local file access
+        opener = urllib2.OpenerDirector()
+        handlers = [urllib2.UnknownHandler(),
+                    urllib2.HTTPDefaultErrorHandler(),
+                    urllib2.FTPHandler(),
+                    urllib2.HTTPErrorProcessor()]
+        map(opener.add_handler, handlers)
+
+        response = opener.open(req, timeout=self.timeout)
+
+        # FTP responses have no status code
+        return getattr(response, 'code', None) or 200
+
+
+_default_checker = None
+_default_checker_lock = threading.Lock()
+
+
+def get_default_checker():
+    """ Return the process-wide `LinkChecker`, creating it when required. """
+    global _default_checker
+
+    with _default_checker_lock:
+        if _default_checker is None:
+            _default_checker = LinkChecker()
+
+    return _default_checker
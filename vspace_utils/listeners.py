@@ -1,6 +1,9 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import threading
+
+from django.utils.datastructures import SortedDict
 from django.utils.decorators import classonlymethod
 from django.utils.functional import update_wrapper
 from django.utils import translation
@@ -8,11 +11,67 @@ from django.utils.translation import get_language
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import EmailMessage
+from django.db import models
 
-from django.template.loader import render_to_string
+from django.conf import settings
+from django.template import Context
+from django.template.loader import select_template
 
 from django.contrib.sites.models import Site
 
+from vspace_utils.executors import get_default_executor
+from vspace_utils.mail import queue_message, send_messages, store_message
+from vspace_utils import coalescing, stats
+
+
+CACHED_TEMPLATE_LOADER = 'django.template.loaders.cached.Loader'
+
+
+class LazyValue(object):
+    """ Callable registered in a `LazyContext`. """
+
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def evaluate(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class LazyContext(dict):
+    """
+    Template context of which values can be registered as callables,
+    evaluated only once and only when the template uses them::
+
+        context = LazyContext(user=user)
+        context.lazy('orders', user.orders.all().count)
+
+    Note that copying the context with `dict(context)` copies unevaluated
+    values as `LazyValue` objects.
+    """
+
+    def lazy(self, key, func, *args, **kwargs):
+        """ Register `func(*args, **kwargs)` as the value for `key`. """
+        dict.__setitem__(self, key, LazyValue(func, args, kwargs))
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+
+        if isinstance(value, LazyValue):
+            value = value.evaluate()
+            dict.__setitem__(self, key, value)
+
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        return default
+
 
 class Listener(object):
     """
@@ -25,9 +84,47 @@ class Listener(object):
                 # DO SOMETHING
                 pass
 
-        funkysignal.connect(MySillyListener.as_view(), weak=False)
+        funkysignal.connect(MySillyListener.as_listener(), weak=False)
+
+    Slow listeners can be executed in the background, outside of the thread
+    sending the signal::
+
+        funkysignal.connect(
+            MySillyListener.as_listener(background=True), weak=False)
+
+    The signal is then handed to `executor` or, by default, the executor
+    configured through the `LISTENER_EXECUTOR` setting; see
+    `vspace_utils.executors`. Note that background listeners may run before
+    the transaction of the code sending the signal has been committed.
+
+    Call counts, errors and durations are recorded per listener class, see
+    `vspace_utils.stats`. Calls taking longer than `slow_threshold` seconds,
+    by default the `LISTENER_SLOW_THRESHOLD` setting, are logged as slow.
+
+    When `coalesce` is set, repeated dispatches with the same key, as
+    returned by `get_coalesce_key()`, are collapsed into a single call with
+    the arguments of the latest dispatch. Dispatches are collected until
+    the current request or `vspace_utils.coalescing.coalesced_signals()`
+    block ends or, outside of those, for `coalesce_window` seconds::
+
+        post_save.connect(
+            MySillyListener.as_listener(coalesce=True), weak=False)
+
+    Saved dispatches are counted in the `coalesced` counter of the listener
+    statistics.
+
+    Listeners only interested in some senders should declare these in
+    `senders` and be connected through a `ListenerRegistry`, see below.
     """
 
+    slow_threshold = None
+
+    # Senders handled when registered with a `ListenerRegistry`
+    senders = None
+
+    coalesce = False
+    coalesce_window = None
+
     def __init__(self, **kwargs):
         """
         Constructor. Called in the URLconf; can contain helpful extra
@@ -39,23 +136,28 @@ class Listener(object):
             setattr(self, key, value)
 
     @classonlymethod
-    def as_listener(cls, **initkwargs):
+    def as_listener(cls, background=False, executor=None, **initkwargs):
         """
         Main entry point for a sender-listener process.
         """
         # sanitize keyword arguments
         for key in initkwargs:
-            if key in cls.http_method_names:
-                raise TypeError(u"You tried to pass in the %s method name as a "
-                                u"keyword argument to %s(). Don't do that."
-                                % (key, cls.__name__))
             if not hasattr(cls, key):
                 raise TypeError(u"%s() received an invalid keyword %r" % (
                     cls.__name__, key))
 
-        def listener(sender, **kwargs):
-            self = cls(**initkwargs)
-            return self.dispatch(sender, **kwargs)
+        if background:
+            def listener(sender, **kwargs):
+                (executor or get_default_executor()).submit(
+                    cls, initkwargs, sender, kwargs)
+
+        else:
+            def listener(sender, **kwargs):
+                self = cls(**initkwargs)
+                return self.run(sender, **kwargs)
+
+        if initkwargs.get('coalesce', cls.coalesce):
+            listener = cls._coalescing(listener, initkwargs)
 
         # take name and docstring from class
         update_wrapper(listener, cls, updated=())
@@ -64,15 +166,255 @@ class Listener(object):
         update_wrapper(listener, cls.dispatch, assigned=())
         return listener
 
+    @classmethod
+    def _coalescing(cls, run, initkwargs):
+        name = cls.get_stats_name()
+
+        def listener(sender, **kwargs):
+            self = cls(**initkwargs)
+
+            coalescing.coalesce(
+                run, name, self.get_coalesce_key(sender, **kwargs),
+                sender, kwargs, self.coalesce_window
+            )
+
+        return listener
+
+    def get_coalesce_key(self, sender, **kwargs):
+        """
+        Key for collapsing dispatches, defaults to the sender and the primary
+        key of the `instance` argument, if any. Dispatches for unsaved
+        instances are only collapsed for the same instance object.
+        """
+        instance = kwargs.get('instance')
+
+        if instance is not None:
+            if instance.pk is None:
+                # The pending call keeps the instance alive, so its id
+                # can't be reused in the meantime
+                return (sender, None, id(instance))
+
+            return (sender, instance.pk)
+
+        return sender
+
+    @classmethod
+    def get_stats_name(cls):
+        """ Name under which statistics are recorded. """
+        return '%s.%s' % (cls.__module__, cls.__name__)
+
+    def measure(self, phase=stats.DISPATCH):
+        """ Return a context manager recording the duration of `phase`. """
+        slow_threshold = None
+
+        if phase == stats.DISPATCH:
+            slow_threshold = self.slow_threshold
+            if slow_threshold is None:
+                slow_threshold = stats.get_slow_threshold()
+
+        return stats.measure(self.get_stats_name(), phase, slow_threshold)
+
+    def run(self, sender, **kwargs):
+        """ Dispatch the signal, recording statistics. """
+        with self.measure():
+            return self.dispatch(sender, **kwargs)
+
     def dispatch(self, sender, **kwargs):
         raise NotImplementedError('Sublcasses should implement this!')
 
 
+class ListenerRegistry(object):
+    """
+    Connects listeners to signals through a single receiver per signal,
+    dispatching to the listeners registered for the sender by looking it up
+    in a table keyed by sender. The table is filled on first use of a
+    sender, matching class senders against the senders of listeners
+    through their MRO, so listeners for a model also handle its subclasses.
+
+    Usage::
+
+        class MySillyListener(Listener):
+            senders = (MyModel, 'otherapp.OtherModel')
+
+            def dispatch(self, sender, **kwargs):
+                pass
+
+        registry.register(post_save, MySillyListener)
+
+    Listeners without `senders` handle all senders. Models can be given as
+    'app_label.ModelName' strings, which are resolved once, on first
+    dispatch of the signal. Unknown models are logged and skipped.
+    """
+
+    def __init__(self):
+        # Registered (senders, listener) tuples, by signal
+        self._listeners = {}
+        # Listeners by sender, by signal
+        self._tables = {}
+        # Registered listeners with resolved senders, by signal
+        self._resolved = {}
+
+        self._lock = threading.Lock()
+
+    def register(self, signal, listener_class, senders=None, **initkwargs):
+        """
+        Register `listener_class` for `signal`. `senders` defaults to the
+        `senders` attribute of the class, other keyword arguments are passed
+        on to `as_listener()`. Returns the listener function.
+        """
+        if senders is None:
+            senders = listener_class.senders
+
+        if senders is not None and not isinstance(senders, (list, tuple)):
+            senders = (senders, )
+
+        listener = listener_class.as_listener(**initkwargs)
+
+        with self._lock:
+            if signal not in self._listeners:
+                self._listeners[signal] = []
+
+                signal.connect(
+                    self._get_receiver(signal), weak=False,
+                    dispatch_uid='%s.%d' % (self.__class__.__name__, id(self))
+                )
+
+            self._listeners[signal].append((senders, listener))
+            self._tables[signal] = {}
+            self._resolved.pop(signal, None)
+
+        return listener
+
+    def unregister(self, signal, listener):
+        """ Remove a listener function returned by `register()`. """
+        with self._lock:
+            self._listeners[signal] = [
+                (senders, registered)
+                for senders, registered in self._listeners.get(signal, [])
+                if registered is not listener
+            ]
+            self._tables[signal] = {}
+            self._resolved.pop(signal, None)
+
+    def _get_receiver(self, signal):
+        def receiver(sender, **kwargs):
+            for listener in self.get_listeners(signal, sender):
+                listener(sender, **kwargs)
+
+        return receiver
+
+    def _resolve(self, senders):
+        """ Resolve model strings, leaving out unknown models. """
+        if senders is None:
+            return None
+
+        resolved = []
+
+        for sender in senders:
+            if isinstance(sender, basestring):
+                model = None
+
+                if sender.count('.') == 1:
+                    model = models.get_model(*sender.split('.'))
+
+                if model is None:
+                    logger.error('Unknown model %s for listeners', sender)
+                    continue
+
+                sender = model
+
+            resolved.append(sender)
+
+        return resolved
+
+    def _get_resolved(self, signal):
+        """ Registered (senders, listener) tuples, with resolved senders. """
+        resolved = self._resolved.get(signal)
+
+        if resolved is None:
+            resolved = self._resolved[signal] = [
+                (self._resolve(senders), listener)
+                for senders, listener in self._listeners.get(signal, [])
+            ]
+
+        return resolved
+
+    def _matches(self, senders, sender):
+        if senders is None:
+            return True
+
+        if isinstance(sender, type):
+            return any(cls in senders for cls in sender.__mro__)
+
+        return sender in senders
+
+    def get_listeners(self, signal, sender):
+        """ Return the listener functions for `sender`. """
+        table = self._tables.get(signal, {})
+
+        try:
+            return table[sender]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable sender, don't cache
+            table = {}
+
+        with self._lock:
+            listeners = [
+                listener
+                for senders, listener in self._get_resolved(signal)
+                if self._matches(senders, sender)
+            ]
+
+            try:
+                table[sender] = listeners
+            except TypeError:
+                pass
+
+        return listeners
+
+
+registry = ListenerRegistry()
+
+
 class EmailingListener(Listener):
-    """ Listener which sends out emails. """
+    """
+    Listener which sends out emails.
+
+    When `batch_send` is set, messages are not sent right away but collected
+    and sent over a single connection when the current request finishes,
+    or when leaving a `vspace_utils.mail.batched_messages()` block. When
+    the request raises an exception, and its transaction is rolled back,
+    the messages are discarded. The number of messages per connection call
+    is set through the `EMAIL_BATCH_SIZE` setting.
+
+    When `outbox` is set, messages are stored in the database instead, in
+    the transaction of the code sending the signal, and sent by the
+    `send_outbox` management command. Failing deliveries are retried and
+    don't affect the code sending the signal.
+
+    Subject and body templates are loaded and compiled once per
+    (template names, language) and reused for all messages. With `DEBUG`
+    enabled and no cached template loader configured, templates are
+    reloaded for every message, just like the template loaders do.
+
+    Besides the call as a whole, the `render` and `send` phases are
+    recorded in the listener statistics. Database queries made while
+    creating messages are counted, in the `queries` and `messages` counters,
+    when `DEBUG` or `count_queries` is enabled.
+    """
 
     body_template_name = None
     subject_template_name = None
+    batch_send = False
+    outbox = False
+    count_queries = False
+
+    # Compiled templates, keyed by template names. Translations are looked
+    # up when rendering, so templates are shared between languages and the
+    # cache is bounded by the number of templates used.
+    _template_cache = {}
 
     def get_subject_template_names(self):
         """
@@ -103,12 +445,13 @@ class EmailingListener(Listener):
         """
         Context for the message template rendered. Defaults to sender, the
         current site object and kwargs.
-        """
 
-        current_site = Site.objects.get_current()
+        Returns a `LazyContext`, expensive values should be added using its
+        `lazy()` method so they are only evaluated when used.
+        """
 
-        context = {'sender': self.sender,
-                   'site': current_site}
+        context = LazyContext(sender=self.sender)
+        context.lazy('site', Site.objects.get_current)
 
         context.update(self.kwargs)
 
@@ -125,13 +468,58 @@ class EmailingListener(Listener):
         """
         return None
 
+    def use_template_cache(self):
+        """
+        Whether compiled templates may be reused: always, unless templates
+        are expected to change, ie. when `DEBUG` is enabled without the
+        cached template loader.
+        """
+        if not settings.DEBUG:
+            return True
+
+        for loader in settings.TEMPLATE_LOADERS:
+            # Cached loader is configured as (loader, (loaders, ...))
+            if isinstance(loader, (tuple, list)):
+                loader = loader[0]
+
+            if loader == CACHED_TEMPLATE_LOADER:
+                return True
+
+        return False
+
+    def get_template(self, template_names):
+        """ Return the (cached) compiled template for `template_names`. """
+        if not self.use_template_cache():
+            return select_template(template_names)
+
+        key = tuple(template_names)
+
+        template = self._template_cache.get(key)
+        if template is None:
+            template = select_template(template_names)
+            self._template_cache[key] = template
+
+        return template
+
+    def render_template(self, template_names, context):
+        """ Render the first available template with `context`. """
+        return self.get_template(template_names).render(Context(context))
+
+    def render_subject(self, context):
+        subject = self.render_template(
+            self.get_subject_template_names(), context)
+        # Clean the subject a bit for common errors (newlines!)
+        return subject.strip().replace('\n', ' ')
+
+    def render_body(self, context):
+        return self.render_template(self.get_body_template_names(), context)
+
     def create_message(self, context):
         """ Create an email message. """
-        subject = render_to_string(self.get_subject_template_names(), context)
-        # Clean the subject a bit for common errors (newlines!)
-        subject = subject.strip().replace('\n', ' ')
+        with self.measure('render'):
+            subject = self.render_subject(context)
+            body = self.render_body(context)
 
-        body = render_to_string(self.get_body_template_names(), context)
         recipients = self.get_recipients()
         sender = self.get_sender()
 
@@ -139,26 +527,70 @@ class EmailingListener(Listener):
 
         return email
 
+    def record_queries(self, queries, messages=1):
+        """ Record the number of queries made for creating `messages`. """
+        if queries is None:
+            return
+
+        logger.debug('%d queries for %d messages', queries, messages)
+
+        name = self.get_stats_name()
+        stats.incr(name, 'messages', messages)
+        stats.incr(name, 'queries', queries)
+
+    def send_message(self, message):
+        """
+        Send the message, or store it when `outbox` is set or queue it when
+        `batch_send` is set.
+        """
+        with self.measure('send'):
+            if self.outbox:
+                store_message(message)
+            elif self.batch_send:
+                queue_message(message)
+            else:
+                message.send()
+
     def handler(self, sender, **kwargs):
         """ Store sender and kwargs attributes on self. """
 
         self.sender = sender
         self.kwargs = kwargs
 
-        context = self.get_context_data()
+        with stats.QueryCounter(force=self.count_queries) as queries:
+            context = self.get_context_data()
 
-        message = self.create_message(context)
+            message = self.create_message(context)
 
-        message.send()
+        self.record_queries(queries.count)
+
+        self.send_message(message)
 
 
 class TranslatedEmailingListener(EmailingListener):
-    """ Email sending listener which switched locale before processing. """
+    """
+    Email sending listener which switched locale before processing.
+
+    Besides handling signals, it can send the same message to many
+    recipients with `fan_out()`, rendering it only once per language.
+    Messages are either sent individually (`delivery = 'individual'`) or
+    with recipients in BCC (`delivery = 'bcc'`), `bcc_chunk_size` at a time.
+    """
+
+    delivery = 'individual'
+    bcc_chunk_size = 50
 
     def get_language(self, sender, **kwargs):
         """ Return the language we should switch to. """
         raise NotImplementedError
 
+    def get_recipient_language(self, recipient):
+        """
+        Return the language for a recipient in `fan_out()`, defaults to the
+        language for the signal.
+        """
+        return self.get_language(self.sender, **self.kwargs)
+
     def handler(self, sender, **kwargs):
         old_language = get_language()
 
@@ -167,6 +599,79 @@ class TranslatedEmailingListener(EmailingListener):
         logger.debug('Changing to language %s for email submission', language)
         translation.activate(language)
 
-        super(TranslatedEmailingListener, self).handler(sender, **kwargs)
+        try:
+            super(TranslatedEmailingListener, self).handler(sender, **kwargs)
+        finally:
+            translation.activate(old_language)
+
+    def create_fan_out_messages(self, subject, body, recipients):
+        """ Create the messages for recipients sharing a language. """
+        from_email = self.get_sender()
+
+        if self.delivery == 'bcc':
+            return [
+                EmailMessage(subject, body, from_email,
+                    bcc=recipients[start:start + self.bcc_chunk_size])
+                for start in xrange(0, len(recipients), self.bcc_chunk_size)
+            ]
+
+        return [
+            EmailMessage(subject, body, from_email, [recipient])
+            for recipient in recipients
+        ]
+
+    def fan_out(self, sender, recipients, **kwargs):
+        """
+        Send the message to all `recipients`, grouped by the language
+        returned by `get_recipient_language()`. Subject and body are
+        rendered once per language and all messages are sent over a single
+        connection (or stored when `outbox` is set or queued when
+        `batch_send` is set).
+
+        Returns the number of messages created.
+        """
+        self.sender = sender
+        self.kwargs = kwargs
+
+        languages = SortedDict()
+        for recipient in recipients:
+            language = self.get_recipient_language(recipient)
+            languages.setdefault(language, []).append(recipient)
+
+        messages = []
+        old_language = get_language()
+
+        with stats.QueryCounter(force=self.count_queries) as queries:
+            try:
+                for language, language_recipients in languages.iteritems():
+                    logger.debug(
+                        'Rendering message in %s for %d recipients',
+                        language, len(language_recipients)
+                    )
+                    translation.activate(language)
+
+                    context = self.get_context_data()
+
+                    with self.measure('render'):
+                        subject = self.render_subject(context)
+                        body = self.render_body(context)
+
+                    messages.extend(self.create_fan_out_messages(
+                        subject, body, language_recipients))
+
+            finally:
+                translation.activate(old_language)
+
+        self.record_queries(queries.count, len(messages))
+
+        with self.measure('send'):
+            if self.outbox:
+                for message in messages:
+                    store_message(message)
+            elif self.batch_send:
+                for message in messages:
+                    queue_message(message)
+            else:
+                send_messages(messages)
 
-        translation.activate(old_language)
+        return len(messages)
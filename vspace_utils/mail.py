@@ -0,0 +1,251 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import traceback
+import uuid
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from vspace_utils.scopes import BlockScope, register_request_scope
+
+
+def get_batch_size():
+    """
+    Number of messages per `send_messages()` call, from the
+    `EMAIL_BATCH_SIZE` setting.
+    """
+    return getattr(settings, 'EMAIL_BATCH_SIZE', 100)
+
+
+def send_messages(messages, batch_size=None, connection=None):
+    """
+    Send messages over a single connection, in chunks of `batch_size`.
+    Returns the number of messages sent.
+    """
+    if not messages:
+        return 0
+
+    if batch_size is None:
+        batch_size = get_batch_size()
+
+    if connection is None:
+        connection = get_connection()
+
+    sent = 0
+
+    connection.open()
+    try:
+        for start in xrange(0, len(messages), batch_size):
+            sent += connection.send_messages(
+                messages[start:start + batch_size]) or 0
+    finally:
+        connection.close()
+
+    logger.debug('Sent %d messages', sent)
+
+    return sent
+
+
+class BatchScope(BlockScope):
+    """ Batches of messages, sent when the outermost batch ends. """
+
+    # Outside of other request scopes, so their work can queue messages
+    order = 100
+
+    def create_block(self):
+        return []
+
+    def merge_block(self, outer, block):
+        outer.extend(block)
+
+    def run_block(self, block, batch_size=None):
+        send_messages(block, batch_size)
+
+
+_batches = BatchScope('message batch')
+register_request_scope(_batches)
+
+
+def begin_batch():
+    """ Start collecting messages queued with `queue_message()`. """
+    _batches.begin()
+
+
+def end_batch(send=True, batch_size=None):
+    """
+    Stop collecting messages, sending them if `send` is set or discarding
+    them otherwise. Messages of nested batches are only sent when the
+    outermost batch ends.
+    """
+    _batches.end(send, batch_size=batch_size)
+
+
+def queue_message(message):
+    """
+    Queue a message for sending when the current batch ends. Without an
+    active batch, the message is sent right away.
+    """
+    batches = _batches.get_blocks()
+
+    if batches:
+        batches[-1].append(message)
+    else:
+        message.send()
+
+
+@contextmanager
+def batched_messages(batch_size=None):
+    """
+    Collect messages queued within the block and send them over a single
+    connection when it exits, or discard them when it raises an exception.
+
+    Place the block outside any transaction, so messages are only sent
+    after it has been committed::
+
+        with batched_messages():
+            with transaction.commit_on_success():
+                for obj in objects:
+                    obj.save()
+    """
+    begin_batch()
+
+    try:
+        yield
+    except:
+        end_batch(send=False)
+        raise
+
+    end_batch(batch_size=batch_size)
+
+
+def store_message(message):
+    """
+    Store a message in the outbox, to be sent by the `send_outbox`
+    management command. As the message is saved in the current transaction,
+    it is only sent when the transaction is committed.
+    """
+    from vspace_utils.models import OutboxMessage
+
+    outbox_message = OutboxMessage()
+    outbox_message.set_message(message)
+    outbox_message.save()
+
+    return outbox_message
+
+
+def claim_outbox_messages(batch_size=100, max_attempts=5, lease=300):
+    """
+    Lock up to `batch_size` outbox messages for `lease` seconds and return
+    them. Messages are claimed in a single UPDATE, so workers running in
+    parallel never claim the same message.
+    """
+    from vspace_utils.models import OutboxMessage
+
+    now = timezone.now()
+    available = Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+
+    pks = list(OutboxMessage.objects.filter(
+        available, attempts__lt=max_attempts
+    ).values_list('pk', flat=True)[:batch_size])
+
+    if not pks:
+        return []
+
+    lock_id = uuid.uuid4().hex
+
+    OutboxMessage.objects.filter(available, pk__in=pks).update(
+        locked_until=now + datetime.timedelta(seconds=lease),
+        lock_id=lock_id
+    )
+
+    return list(OutboxMessage.objects.filter(lock_id=lock_id))
+
+
+def send_outbox(batch_size=100, max_attempts=5, lease=300, connection=None):
+    """
+    Send a batch of outbox messages over a single connection, returning the
+    number of messages processed. Sent messages are removed from the
+    outbox, failed messages are retried with exponential backoff until they
+    have failed `max_attempts` times, after which they are logged as errors
+    and removed as well.
+
+    Messages the email backend reports as not sent, ie. by returning 0
+    from `send_messages()`, count as failed.
+    """
+    from vspace_utils.models import OutboxMessage
+
+    outbox_messages = claim_outbox_messages(batch_size, max_attempts, lease)
+
+    if not outbox_messages:
+        return 0
+
+    if connection is None:
+        connection = get_connection()
+
+    sent = []
+
+    try:
+        connection.open()
+
+    except Exception:
+        logger.exception('Error opening connection for outbox')
+
+        error = traceback.format_exc()
+        for outbox_message in outbox_messages:
+            outbox_message.last_error = error
+
+        failed = outbox_messages
+
+    else:
+        failed = []
+
+        try:
+            for outbox_message in outbox_messages:
+                try:
+                    if connection.send_messages(
+                            [outbox_message.get_message()]) == 0:
+                        raise ValueError('Message not sent by email backend')
+
+                except Exception:
+                    logger.exception('Error sending %s', outbox_message)
+
+                    outbox_message.last_error = traceback.format_exc()
+                    failed.append(outbox_message)
+
+                else:
+                    sent.append(outbox_message.pk)
+
+        finally:
+            connection.close()
+
+    OutboxMessage.objects.filter(pk__in=sent).delete()
+
+    for outbox_message in failed:
+        outbox_message.attempts += 1
+
+        if outbox_message.attempts >= max_attempts:
+            logger.error(
+                'Giving up on %s after %d attempts:\n%s', outbox_message,
+                outbox_message.attempts, outbox_message.last_error
+            )
+
+            outbox_message.delete()
+            continue
+
+        # Exponential backoff before the next attempt
+        outbox_message.locked_until = timezone.now() + datetime.timedelta(
+            seconds=10 * 2 ** outbox_message.attempts)
+        outbox_message.lock_id = ''
+        outbox_message.save()
+
+    logger.debug(
+        'Sent %d outbox messages, %d failed', len(sent), len(failed))
+
+    return len(outbox_messages)
+
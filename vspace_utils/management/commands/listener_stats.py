@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import NoArgsCommand
+
+from vspace_utils import stats
+
+
+class Command(NoArgsCommand):
+    help = (
+        'Print call counts, errors and durations of listeners, as flushed '
+        'to the cache set by LISTENER_STATS_CACHE by all processes. This '
+        'has to be a cache shared between processes, ie. memcached, not a '
+        'local memory cache.'
+    )
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--histogram', action='store_true', default=False,
+            help='Print the duration histogram of every phase.'),
+        make_option('--reset', action='store_true', default=False,
+            help='Clear the statistics after printing them.'),
+    )
+
+    def handle_noargs(self, **options):
+        if isinstance(stats.get_shared_cache(), LocMemCache):
+            self.stderr.write(
+                'LISTENER_STATS_CACHE is a local memory cache, statistics of '
+                'other processes are not available.\n'
+            )
+
+        snapshot = stats.shared_snapshot()
+        counters = stats.shared_counters()
+
+        if not (snapshot or counters):
+            self.stdout.write('No listener statistics recorded.\n')
+
+        for name in sorted(set(snapshot) | set(counters)):
+            self.stdout.write('%s\n' % name)
+
+            for counter, value in sorted(counters.get(name, {}).iteritems()):
+                self.stdout.write('  %-10s %8d\n' % (counter, value))
+
+            for phase, metric in sorted(snapshot.get(name, {}).iteritems()):
+                self.stdout.write(
+                    '  %-10s %8d calls %6d errors %10.3f ms mean '
+                    '%10.2f s total\n' % (
+                        phase, metric['calls'], metric['errors'],
+                        metric['mean'] * 1000, metric['total']
+                    )
+                )
+
+                if options['histogram']:
+                    for bound, count in metric['histogram']:
+                        if bound is None:
+                            label = '> %g s' % stats.BUCKETS[-1]
+                        else:
+                            label = '<= %g s' % bound
+
+                        self.stdout.write('    %-10s %8d\n' % (label, count))
+
+        if options['reset']:
+            stats.reset_shared()
@@ -0,0 +1,120 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import signal
+import time
+import traceback
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from vspace_utils.executors import deserialize_payload, run_listener
+from vspace_utils.models import QueuedListenerCall
+
+
+class Command(NoArgsCommand):
+    help = (
+        'Execute listener calls queued in the database by the '
+        'DatabaseExecutor. Stops gracefully, after the current call, on '
+        'SIGTERM or SIGINT.'
+    )
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Number of calls to claim at once (default: 100).'),
+        make_option('--max-attempts', type='int', default=5,
+            help='Number of attempts before giving up on a call (default: 5).'),
+        make_option('--lease', type='int', default=300,
+            help='Seconds a claimed call stays locked (default: 300).'),
+        make_option('--sleep', type='int', default=5,
+            help='Seconds to wait when the queue is empty (default: 5).'),
+        make_option('--once', action='store_true', default=False,
+            help='Exit when the queue is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.stopping = False
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            processed = self.process_batch(
+                options['batch_size'], options['max_attempts'],
+                options['lease']
+            )
+
+            if not processed:
+                if options['once']:
+                    break
+
+                time.sleep(options['sleep'])
+
+    def stop(self, signum, frame):
+        logger.info('Stopping after the current call')
+        self.stopping = True
+
+    def claim(self, pk, lease):
+        """
+        Lock a call for `lease` seconds, returning whether we got it.
+        Workers running in parallel never claim the same call.
+
+        Claiming counts as an attempt, so calls which crash the worker
+        aren't retried forever.
+        """
+        now = timezone.now()
+
+        return QueuedListenerCall.objects.filter(pk=pk).filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+        ).update(
+            locked_until=now + datetime.timedelta(seconds=lease),
+            attempts=F('attempts') + 1
+        ) == 1
+
+    def process_batch(self, batch_size, max_attempts, lease):
+        """ Process available calls, returning the number processed. """
+        now = timezone.now()
+
+        pks = QueuedListenerCall.objects.filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+            attempts__lt=max_attempts
+        ).values_list('pk', flat=True)[:batch_size]
+
+        processed = 0
+        for pk in pks:
+            if self.stopping:
+                break
+
+            if not self.claim(pk, lease):
+                continue
+
+            self.process(QueuedListenerCall.objects.get(pk=pk))
+            processed += 1
+
+        return processed
+
+    def process(self, call):
+        try:
+            run_listener(*deserialize_payload(call.listener, call.payload))
+
+        except Exception:
+            logger.exception('Error processing %s', call)
+
+            # Discard changes of the failed call, ie. a transaction aborted
+            # by a database error, before recording the failure
+            transaction.rollback()
+
+            call.last_error = traceback.format_exc()
+
+            # Exponential backoff before the next attempt
+            call.locked_until = timezone.now() + datetime.timedelta(
+                seconds=10 * 2 ** call.attempts)
+            call.save()
+
+        else:
+            call.delete()
@@ -0,0 +1,55 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import signal
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from vspace_utils.mail import send_outbox
+
+
+class Command(NoArgsCommand):
+    help = (
+        'Send email messages stored in the outbox, in batches over a single '
+        'connection. Stops gracefully, after the current batch, on SIGTERM '
+        'or SIGINT.'
+    )
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Number of messages to claim at once (default: 100).'),
+        make_option('--max-attempts', type='int', default=5,
+            help='Number of attempts before giving up on a message '
+                 '(default: 5).'),
+        make_option('--lease', type='int', default=300,
+            help='Seconds a claimed message stays locked (default: 300).'),
+        make_option('--sleep', type='int', default=5,
+            help='Seconds to wait when the outbox is empty (default: 5).'),
+        make_option('--once', action='store_true', default=False,
+            help='Exit when the outbox is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.stopping = False
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            processed = send_outbox(
+                options['batch_size'], options['max_attempts'],
+                options['lease']
+            )
+
+            if not processed:
+                if options['once']:
+                    break
+
+                time.sleep(options['sleep'])
+
+    def stop(self, signum, frame):
+        logger.info('Stopping after the current batch')
+        self.stopping = True
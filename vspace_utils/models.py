@@ -1,7 +1,11 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from django.db import models
+import base64
+import cPickle as pickle
+
+from django.db import models, router, transaction, IntegrityError
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import slugify
 
@@ -20,6 +24,12 @@ class AutoSlugMixin(object):
     The name of the slug field and the field to populate from can be set
     using the `_slug_from` and `_slug_field` properties.
 
+    When the source is available when an object is first saved, the slug is
+    generated before it is inserted and `update_slug()` has nothing left
+    to do. Set `_slug_on_insert` to `False` to disable this. Otherwise,
+    `update_slug()` only writes the slug column with a single UPDATE,
+    without sending signals.
+
     The big advantage of this method of setting slugs over others
     (ie. django-autoslug) is that we can set the value of slugs
     automatically based on the value of a field of an a field with a foreign
@@ -46,9 +56,17 @@ class AutoSlugMixin(object):
 
         (The code above is untested and _might_ be buggy.)
 
+    For imports, slugs for many instances can be generated at once with
+    `assign_slugs()`, before `bulk_create()`, and already saved instances
+    can be updated with `save_slugs()`::
+
+        objects = MyModel.assign_slugs(objects)
+        MyModel.objects.bulk_create(objects)
+
     """
     _slug_from = 'name'
     _slug_field = 'slug'
+    _slug_on_insert = True
 
     def slugify(self, name):
         return slugify(name)
@@ -61,32 +79,254 @@ class AutoSlugMixin(object):
 
         return self.slugify(slug_base)
 
-    def update_slug(self, commit=True):
-        if not getattr(self, self._slug_field) and \
-               getattr(self, self._slug_from):
+    def save(self, *args, **kwargs):
+        if self._slug_on_insert and self._state.adding and self.needs_slug():
             setattr(self, self._slug_field, self.generate_slug())
 
+        super(AutoSlugMixin, self).save(*args, **kwargs)
+
+    def update_slug(self, commit=True, full_save=False):
+        """
+        Generate the slug if it is empty and the source is available. With
+        `commit`, the slug is written using an UPDATE of only the slug
+        column, or by calling `save()` when `full_save` is set or the
+        object has not been saved yet.
+        """
+        if self.needs_slug():
+            slug = self.generate_slug()
+            setattr(self, self._slug_field, slug)
+
             if commit:
-                self.save()
+                if full_save or self._state.adding:
+                    self.save()
+                else:
+                    self.__class__._default_manager.using(
+                        self._state.db
+                    ).filter(pk=self.pk).update(**{self._slug_field: slug})
+
+    def needs_slug(self):
+        """ Whether the slug is empty and can be generated. """
+        return not getattr(self, self._slug_field) and \
+            getattr(self, self._slug_from)
+
+    @classmethod
+    def assign_slugs(cls, instances):
+        """
+        Generate slugs for all `instances` without one, without saving.
+        Returns the instances, as a list.
+        """
+        instances = list(instances)
+
+        for instance in instances:
+            if instance.needs_slug():
+                setattr(instance, cls._slug_field, instance.generate_slug())
+
+        return instances
+
+    @classmethod
+    def save_slugs(cls, instances, chunk_size=500):
+        """
+        Write the slugs of saved `instances` to the database in bulk,
+        without calling `save()` or sending signals. Returns the number of
+        rows updated.
+        """
+        from vspace_utils.utils import bulk_update_column
+
+        values = dict(
+            (instance.pk, getattr(instance, cls._slug_field))
+            for instance in instances if instance.pk is not None
+        )
+
+        return bulk_update_column(cls, cls._slug_field, values, chunk_size)
 
 
 class AutoUniqueSlugMixin(AutoSlugMixin):
-    """ Make sure that the generated slug is unique. """
+    """
+    Make sure that the generated slug is unique, by appending the first
+    free numeric suffix (`slug-1`, `slug-2`, ...) when it is already taken.
+
+    Taken slugs are fetched in a single query, regardless of the number of
+    collisions. When a concurrent save takes the slug before we do,
+    `save()` and `update_slug()` generate a new one and try again, at most
+    `_slug_retries` times.
+    """
+
+    _slug_retries = 5
+
+    # Number of slugs per query when prefetching taken slugs in bulk
+    _slug_prefetch_chunk = 100
+
+    def get_slug_queryset(self):
+        """
+        Objects the slug should be unique among, used by `save()` as well
+        as by `assign_slugs()`. The object itself is excluded by callers.
+
+        Defaults to all objects, including those hidden by a filtering
+        default manager.
+        """
+        return self.__class__._base_manager.all()
+
+    def _get_other_slugs(self):
+        qs = self.get_slug_queryset()
+
+        if self.pk:
+            qs = qs.exclude(pk=self.pk)
+
+        return qs
 
     def is_unique_slug(self, slug):
-        qs = self.__class__.objects.filter(**{self._slug_field: slug})
+        qs = self._get_other_slugs().filter(**{self._slug_field: slug})
         return not qs.exists()
 
+    @classmethod
+    def get_taken_slugs_filter(cls, slug):
+        """ Filter for `slug` and slugs with a suffix, ie. `slug-1`. """
+        return models.Q(**{cls._slug_field: slug}) | models.Q(
+            **{'%s__startswith' % cls._slug_field: slug + '-'})
+
+    def get_taken_slugs(self, slug):
+        """ Return the set of taken slugs equal to `slug` or suffixed. """
+        return set(self._get_other_slugs().filter(
+            self.get_taken_slugs_filter(slug)
+        ).values_list(self._slug_field, flat=True))
+
     def generate_slug(self):
         original_slug = super(AutoUniqueSlugMixin, self).generate_slug()
-        slug = original_slug
+
+        taken = self.get_taken_slugs(original_slug)
+
+        if original_slug not in taken:
+            return original_slug
+
+        # Suffixes in use, other slugs with the same prefix are ignored
+        prefix = original_slug + '-'
+        suffixes = set()
+        for slug in taken:
+            suffix = slug[len(prefix):]
+            if slug.startswith(prefix) and suffix.isdigit():
+                suffixes.add(int(suffix))
 
         iteration = 1
-        while not self.is_unique_slug(slug):
-            slug = "%s-%d" % (original_slug, iteration)
+        while iteration in suffixes:
             iteration += 1
 
-        return slug
+        return "%s-%d" % (original_slug, iteration)
+
+    @classmethod
+    def assign_slugs(cls, instances):
+        """
+        Generate unique slugs for all `instances` without one, without
+        saving. Instances are grouped by their `get_slug_queryset()`; per
+        group, taken slugs are prefetched in one query per
+        `_slug_prefetch_chunk` distinct slugs and slugs generated for
+        earlier instances in the group are taken into account as well.
+        Returns the instances, as a list.
+        """
+        instances = list(instances)
+
+        # Pending (instance, base slug) tuples and their queryset, by scope
+        scopes = SortedDict()
+
+        for instance in instances:
+            if instance.needs_slug():
+                qs = instance.get_slug_queryset()
+                sql, params = qs.query.sql_with_params()
+                scope = scopes.setdefault(
+                    (qs.db, sql, tuple(params)), (qs, []))
+
+                # The slug, before making it unique
+                slug = super(AutoUniqueSlugMixin, instance).generate_slug()
+                scope[1].append((instance, slug))
+
+        for qs, pending in scopes.itervalues():
+            cls._assign_scope_slugs(qs, pending)
+
+        return instances
+
+    @classmethod
+    def _assign_scope_slugs(cls, qs, pending):
+        bases = sorted(set(slug for instance, slug in pending))
+
+        qs = qs.exclude(pk__in=[
+            instance.pk for instance, slug in pending
+            if instance.pk is not None
+        ])
+
+        taken = set()
+        for start in xrange(0, len(bases), cls._slug_prefetch_chunk):
+            q = models.Q()
+            for base in bases[start:start + cls._slug_prefetch_chunk]:
+                q |= cls.get_taken_slugs_filter(base)
+
+            taken.update(qs.filter(q).values_list(cls._slug_field, flat=True))
+
+        # Next suffix to try, per base
+        iterations = {}
+
+        for instance, base in pending:
+            slug = base
+            iteration = iterations.get(base, 1)
+
+            while slug in taken:
+                slug = "%s-%d" % (base, iteration)
+                iteration += 1
+
+            iterations[base] = iteration
+            taken.add(slug)
+
+            setattr(instance, cls._slug_field, slug)
+
+        logger.debug(
+            'Assigned %d slugs with %d distinct bases',
+            len(pending), len(bases)
+        )
+
+    def _retry_slug(self, func, *args, **kwargs):
+        """
+        Call `func`, which saves a generated slug, generating a new slug
+        when it raises an `IntegrityError` because the slug has been taken
+        in the meantime. Other errors are raised right away.
+        """
+        using = router.db_for_write(self.__class__, instance=self)
+
+        for attempt in xrange(self._slug_retries):
+            sid = transaction.savepoint(using=using)
+
+            try:
+                result = func(*args, **kwargs)
+
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=using)
+
+                slug = getattr(self, self._slug_field)
+
+                if attempt + 1 == self._slug_retries or \
+                        self.is_unique_slug(slug):
+                    raise
+
+                logger.debug('Slug %s taken concurrently, retrying', slug)
+
+                setattr(self, self._slug_field, '')
+
+            else:
+                transaction.savepoint_commit(sid, using=using)
+                return result
+
+    def save(self, *args, **kwargs):
+        if not self._slug_on_insert or not self._state.adding or \
+                not self.needs_slug():
+            return super(AutoUniqueSlugMixin, self).save(*args, **kwargs)
+
+        return self._retry_slug(
+            super(AutoUniqueSlugMixin, self).save, *args, **kwargs)
+
+    def update_slug(self, commit=True, full_save=False):
+        if not commit or getattr(self, self._slug_field):
+            return super(AutoUniqueSlugMixin, self).update_slug(
+                commit, full_save)
+
+        return self._retry_slug(
+            super(AutoUniqueSlugMixin, self).update_slug, commit, full_save)
 
 
 class UniqueSlugItemBase(models.Model):
@@ -115,3 +355,72 @@ class NonUniqueSlugItemBase(models.Model):
             'Short name for an item, used for constructing its web addres. '
             'A slug should be unique and may only contain letters, numbers '
             'and \'-\'.'), blank=True)
+
+
+class QueuedListenerCall(models.Model):
+    """
+    Signal dispatch queued for a background listener by the
+    `DatabaseExecutor`, processed by the `process_listener_queue`
+    management command.
+    """
+
+    listener = models.CharField(_('listener'), max_length=255)
+    payload = models.TextField(_('payload'))
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    locked_until = models.DateTimeField(
+        _('locked until'), null=True, blank=True, db_index=True)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta:
+        ordering = ('pk', )
+        verbose_name = _('queued listener call')
+        verbose_name_plural = _('queued listener calls')
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.listener, self.created)
+
+
+class OutboxMessage(models.Model):
+    """
+    Email message stored by `vspace_utils.mail.store_message()`, delivered
+    by the `send_outbox` management command.
+    """
+
+    subject = models.CharField(_('subject'), max_length=255)
+    recipients = models.TextField(_('recipients'))
+    message = models.TextField(_('message'))
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    locked_until = models.DateTimeField(
+        _('locked until'), null=True, blank=True, db_index=True)
+    lock_id = models.CharField(
+        _('lock id'), max_length=32, blank=True, db_index=True)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta:
+        ordering = ('pk', )
+        verbose_name = _('outbox message')
+        verbose_name_plural = _('outbox messages')
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.subject, self.recipients)
+
+    def get_message(self):
+        """ Return the stored `EmailMessage`. """
+        return pickle.loads(base64.b64decode(self.message))
+
+    def set_message(self, message):
+        """ Store `message`, which should be an `EmailMessage`. """
+        # Connections can't be pickled
+        connection = message.connection
+        message.connection = None
+
+        try:
+            self.message = base64.b64encode(
+                pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+        finally:
+            message.connection = connection
+
+        self.subject = message.subject[:255]
+        self.recipients = u', '.join(message.recipients())
@@ -0,0 +1,449 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+
+# Note: we need dnspython for this to work
+# Install with `pip install dnspython`
+import dns.resolver
+import dns.exception
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.dispatch import Signal
+from django.utils.translation import ugettext as _
+
+from vspace_utils.caching import LRUCache, SingleFlight
+
+
+# Sent after every uncached DNS lookup, for monitoring purposes.
+# Status is one of 'ok', 'nxdomain', 'noanswer', 'timeout' or 'error',
+# duration is in seconds.
+lookup_completed = Signal(
+    providing_args=['domain', 'rdtype', 'status', 'duration'])
+
+# Lookup statuses implying the domain (or record) doesn't exist
+NEGATIVE_STATUSES = ('nxdomain', 'noanswer')
+
+
+class CachingResolver(object):
+    """
+    Process-wide DNS lookup cache in front of a dnspython resolver.
+
+    Answers are cached for the TTL of the returned records, non-existing
+    domains (NXDOMAIN) and empty answers for `negative_ttl` seconds. Other
+    errors, ie. timeouts, are never cached. Concurrent lookups for the same
+    domain are collapsed into a single query.
+
+    Optionally, results are shared between processes through the Django
+    cache specified by `cache_alias`.
+
+    Usage::
+
+        resolver = CachingResolver()
+        try:
+            hosts = resolver.query('example.com', 'MX')
+        except dns.exception.DNSException:
+            # Domain doesn't exist
+            pass
+
+    For testing, any object with a `query(domain, rdtype, lifetime=None)`
+    method similar to dnspython's may be passed as `resolver`.
+
+    When no resolver is given, a dnspython resolver is created with the
+    given `timeout` per nameserver. `lifetime` is the default maximum
+    duration of a single lookup, in seconds. Lookups for
+    `check_mail_domain()` run on a shared pool of at most `max_lookups`
+    threads.
+    """
+
+    def __init__(self, resolver=None, negative_ttl=300, default_ttl=300,
+                 max_ttl=86400, maxsize=4096, cache_alias=None,
+                 key_prefix='vspace_utils.mx', timeout=None, lifetime=5,
+                 max_lookups=10):
+        if resolver is None:
+            resolver = dns.resolver.Resolver()
+
+            if timeout is not None:
+                resolver.timeout = timeout
+
+        self.resolver = resolver
+        self.lifetime = lifetime
+        self.negative_ttl = negative_ttl
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.key_prefix = key_prefix
+        self.max_lookups = max_lookups
+
+        self.cache = LRUCache(maxsize=maxsize)
+
+        if cache_alias:
+            try:
+                from django.core.cache import caches
+                self.shared_cache = caches[cache_alias]
+            except ImportError:
+                # Django < 1.7
+                from django.core.cache import get_cache
+                self.shared_cache = get_cache(cache_alias)
+        else:
+            self.shared_cache = None
+
+        self._flight = SingleFlight()
+
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def get_pool(self):
+        """ Return the lookup thread pool, creating it when required. """
+        with self._pool_lock:
+            # Threads don't survive forking, create a new pool in children
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(self.max_lookups)
+                self._pool_pid = os.getpid()
+
+            return self._pool
+
+    def get_cache_key(self, domain, rdtype):
+        return '%s.%s.%s' % (self.key_prefix, rdtype, domain)
+
+    def get_ttl(self, answer):
+        """ Return the number of seconds an answer may be cached. """
+        rrset = getattr(answer, 'rrset', None)
+        ttl = getattr(rrset, 'ttl', None)
+
+        if ttl is None:
+            ttl = self.default_ttl
+
+        return min(ttl, self.max_ttl)
+
+    def query(self, domain, rdtype='MX', lifetime=None):
+        """
+        Return a tuple with the textual records of type `rdtype` for
+        `domain`. Raises `dns.resolver.NXDOMAIN` or `dns.resolver.NoAnswer`
+        when the domain or records don't exist and other `DNSException`'s
+        when the lookup failed.
+
+        When specified, `lifetime` limits the time in seconds an uncached
+        lookup may take.
+        """
+        domain = domain.lower().rstrip('.')
+        key = self.get_cache_key(domain, rdtype)
+
+        result = self.get_cached(domain, rdtype)
+
+        if result is None:
+            result = self._flight.do(
+                key, self._query, domain, rdtype, key, lifetime)
+        else:
+            logger.debug('Cached %s lookup for %s', rdtype, domain)
+
+        status, records = result
+
+        if status == 'nxdomain':
+            raise dns.resolver.NXDOMAIN()
+        elif status == 'noanswer':
+            raise dns.resolver.NoAnswer()
+
+        return records
+
+    def get_cached(self, domain, rdtype='MX'):
+        """
+        Return the cached `(status, records)` tuple for a lookup or `None`.
+        """
+        domain = domain.lower().rstrip('.')
+        key = self.get_cache_key(domain, rdtype)
+
+        result = self.cache.get(key)
+
+        if result is None and self.shared_cache is not None:
+            result = self.shared_cache.get(key)
+
+        return result
+
+    def _query(self, domain, rdtype, key, lifetime):
+        logger.debug('Looking up %s records for %s', rdtype, domain)
+
+        if lifetime is None:
+            lifetime = self.lifetime
+
+        kwargs = {}
+        if lifetime is not None:
+            kwargs['lifetime'] = lifetime
+
+        status = 'error'
+        start = time.time()
+
+        try:
+            answer = self.resolver.query(domain, rdtype, **kwargs)
+
+        except dns.resolver.NXDOMAIN:
+            status = 'nxdomain'
+            result = (status, None)
+            ttl = self.negative_ttl
+
+        except dns.resolver.NoAnswer:
+            status = 'noanswer'
+            result = (status, None)
+            ttl = self.negative_ttl
+
+        except dns.exception.Timeout:
+            status = 'timeout'
+            raise
+
+        else:
+            status = 'ok'
+            result = (status, tuple(rdata.to_text() for rdata in answer))
+            ttl = self.get_ttl(answer)
+
+        finally:
+            duration = time.time() - start
+
+            logger.debug(
+                '%s lookup for %s: %s in %.3fs',
+                rdtype, domain, status, duration
+            )
+
+            lookup_completed.send(
+                sender=self.__class__, domain=domain, rdtype=rdtype,
+                status=status, duration=duration
+            )
+
+        if ttl > 0:
+            self.cache.set(key, result, ttl)
+
+            if self.shared_cache is not None:
+                self.shared_cache.set(key, result, ttl)
+
+        return result
+
+    def _status(self, domain, rdtype, lifetime):
+        """ Perform a lookup, returning only its status. """
+        try:
+            self.query(domain, rdtype, lifetime=lifetime)
+        except dns.resolver.NXDOMAIN:
+            return 'nxdomain'
+        except dns.resolver.NoAnswer:
+            return 'noanswer'
+        except dns.exception.Timeout:
+            return 'timeout'
+        except Exception, e:
+            logger.warning('Error looking up %s for %s: %s', rdtype, domain, e)
+            return 'error'
+
+        return 'ok'
+
+    def check_mail_domain(self, domain, lifetime=None,
+                          rdtypes=('MX', 'A', 'AAAA')):
+        """
+        Check whether a domain can receive mail, returning the status of
+        the first successful lookup or, when none succeeds, the status of
+        the failed lookups: 'nxdomain' or 'noanswer' when the domain has no
+        records and 'timeout' or 'error' when it could not be determined.
+
+        MX and A/AAAA lookups are raced concurrently, as domains with just
+        an address record are valid mail domains (RFC 5321, section 5.1).
+        No more than `lifetime` seconds are spent waiting for an answer.
+        """
+        if lifetime is None:
+            lifetime = self.lifetime
+
+        # Use cached results, if available
+        statuses = {}
+        for rdtype in rdtypes:
+            result = self.get_cached(domain, rdtype)
+
+            if result is not None:
+                if result[0] == 'ok':
+                    return 'ok'
+
+                statuses[rdtype] = result[0]
+
+        pending = [rdtype for rdtype in rdtypes if rdtype not in statuses]
+
+        # Lookups we stop waiting for finish in the background, on the
+        # pool's (daemonic) threads
+        queue = Queue()
+        pool = self.get_pool()
+        for rdtype in pending:
+            pool.apply_async(
+                self._status, (domain, rdtype, lifetime),
+                callback=lambda status, rdtype=rdtype: queue.put(
+                    (rdtype, status))
+            )
+
+        if lifetime is not None:
+            deadline = time.time() + lifetime
+        else:
+            deadline = None
+
+        for i in xrange(len(pending)):
+            try:
+                if deadline is None:
+                    rdtype, status = queue.get()
+                else:
+                    rdtype, status = queue.get(
+                        timeout=max(deadline - time.time(), 0))
+
+            except Empty:
+                logger.info('Lookups for domain %s timed out', domain)
+                return 'timeout'
+
+            if status == 'ok':
+                return 'ok'
+
+            statuses[rdtype] = status
+
+        for status in ('timeout', 'error'):
+            if status in statuses.values():
+                return status
+
+        return statuses[rdtypes[0]]
+
+    def clear(self):
+        """ Clear the local cache. """
+        self.cache.clear()
+
+    def close(self):
+        """ Stop the lookup threads, abandoning pending lookups. """
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.terminate()
+
+            self._pool = None
+
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+
+def get_default_resolver():
+    """
+    Return the process-wide `CachingResolver`, creating it when required.
+
+    The Django cache to share results through can be set using the
+    `MX_LOOKUP_CACHE` setting, the time to cache non-existing domains
+    using `MX_LOOKUP_NEGATIVE_TTL`. The timeout per nameserver and maximum
+    duration per lookup are set through `MX_LOOKUP_TIMEOUT` and
+    `MX_LOOKUP_LIFETIME`, which defaults to 5 seconds.
+    """
+    global _default_resolver
+
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = CachingResolver(
+                cache_alias=getattr(settings, 'MX_LOOKUP_CACHE', None),
+                negative_ttl=getattr(settings, 'MX_LOOKUP_NEGATIVE_TTL', 300),
+                timeout=getattr(settings, 'MX_LOOKUP_TIMEOUT', None),
+                lifetime=getattr(settings, 'MX_LOOKUP_LIFETIME', 5)
+            )
+
+    return _default_resolver
+
+
+def validate_domain(domain, resolver=None, lifetime=None,
+                    on_timeout='reject'):
+    """
+    Make sure the domain can receive mail, raising `ValidationError` if not.
+
+    When the lookups time out or fail, `on_timeout` determines what happens:
+
+        'reject': the domain is considered invalid (default)
+        'accept': the domain is considered valid
+        'defer': a `ValidationError` with code 'dns_timeout' is raised,
+            asking the user to try again later
+    """
+    assert on_timeout in ('reject', 'accept', 'defer'), \
+        u'Invalid timeout policy %s' % on_timeout
+
+    if resolver is None:
+        resolver = get_default_resolver()
+
+    logger.debug('Checking domain %s', domain)
+
+    status = resolver.check_mail_domain(domain, lifetime=lifetime)
+
+    if status == 'ok':
+        return
+
+    if status not in NEGATIVE_STATUSES:
+        if on_timeout == 'accept':
+            logger.warning(
+                'Accepting domain %s after failed lookup (%s)', domain, status)
+            return
+
+        if on_timeout == 'defer':
+            raise ValidationError(_(
+                u"The domain %s could not be verified right now. "
+                u"Please try again later.") % domain,
+                code='dns_timeout'
+            )
+
+    logger.debug('Domain %s does not exist.', domain)
+
+    raise ValidationError(_(
+        u"The domain %s could not be found.") % domain
+    )
+
+
+def validate_addresses(addresses, resolver=None, max_workers=20,
+                       timeout=None, on_timeout='reject'):
+    """
+    Check many email addresses at once, ie. for list imports. Yields
+    `(address, error)` tuples where `error` is `None` for valid addresses
+    or the `ValidationError` for invalid ones.
+
+    Addresses are grouped by domain and each distinct domain is looked up
+    only once, on a pool of at most `max_workers` threads, each lookup
+    taking at most `timeout` seconds. Verdicts for invalid addresses are
+    yielded first, the others as soon as their domain has been resolved.
+    See `validate_domain` for `on_timeout`.
+
+    Usage::
+
+        for address, error in validate_addresses(addresses, timeout=5):
+            if error:
+                logger.info('Skipping %s: %s', address, error.messages[0])
+    """
+    if resolver is None:
+        resolver = get_default_resolver()
+
+    domains = {}
+    for address in addresses:
+        try:
+            validate_email(address)
+        except ValidationError, e:
+            yield address, e
+            continue
+
+        domain = address.rsplit('@', 1)[1].lower()
+        domains.setdefault(domain, []).append(address)
+
+    if not domains:
+        return
+
+    def lookup(domain):
+        try:
+            validate_domain(
+                domain, resolver, lifetime=timeout, on_timeout=on_timeout)
+        except ValidationError, e:
+            return domain, e
+
+        return domain, None
+
+    logger.debug('Looking up %d distinct domains', len(domains))
+
+    pool = ThreadPool(min(max_workers, len(domains)))
+    try:
+        for domain, error in pool.imap_unordered(lookup, domains.keys()):
+            for address in domains[domain]:
+                yield address, error
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,144 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+
+from django.core.signals import (
+    request_started, request_finished, got_request_exception
+)
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6
+    from django.db import close_connection as close_old_connections
+
+
+class BlockScope(object):
+    """
+    Thread-local stack of blocks collecting work, ie. messages or listener
+    calls, which is done when the outermost block ends. Work of nested
+    blocks is merged into the enclosing block.
+
+    Subclasses implement `create_block()`, `merge_block()` and
+    `run_block()`. Scopes registered with `register_request_scope()` have a
+    block for every request, which is ended when the request finishes or
+    discarded when it raises an exception.
+    """
+
+    # Request scopes are begun in ascending and ended in descending order,
+    # so scopes with a higher order are nested within those with a lower one
+    order = 0
+
+    def __init__(self, name):
+        self.name = name
+        self._local = threading.local()
+
+    def get_blocks(self):
+        if not hasattr(self._local, 'blocks'):
+            self._local.blocks = []
+
+        return self._local.blocks
+
+    def create_block(self):
+        raise NotImplementedError
+
+    def merge_block(self, outer, block):
+        """ Merge the work of a nested block into the enclosing block. """
+        raise NotImplementedError
+
+    def run_block(self, block, **kwargs):
+        raise NotImplementedError
+
+    def begin(self):
+        """ Start a (nested) block. """
+        self.get_blocks().append(self.create_block())
+
+    def end(self, run=True, **kwargs):
+        """
+        End the current block, doing its work if `run` is set and this is
+        the outermost block, or discarding it when `run` is not set.
+        Keyword arguments are passed on to `run_block()`.
+        """
+        blocks = self.get_blocks()
+        block = blocks.pop()
+
+        if not run:
+            logger.debug('Discarding %s block', self.name)
+            return
+
+        if blocks:
+            self.merge_block(blocks[-1], block)
+        else:
+            self.run_block(block, **kwargs)
+
+    def end_all(self):
+        """ End all blocks left open, ie. by exceptions. """
+        blocks = self.get_blocks()
+
+        while blocks:
+            self.end()
+
+    def discard_all(self):
+        """ Discard all open blocks. """
+        self._local.blocks = []
+
+
+_request_scopes = []
+
+
+def register_request_scope(scope):
+    """ Give `scope` a block for every request. """
+    if scope not in _request_scopes:
+        _request_scopes.append(scope)
+        _request_scopes.sort(key=lambda scope: scope.order)
+
+
+def _request_started(sender, **kwargs):
+    for scope in _request_scopes:
+        # Discard left-overs from requests which did not finish properly
+        scope.discard_all()
+        scope.begin()
+
+
+def _closes_connections():
+    """
+    Whether Django's receiver closing database connections is connected to
+    `request_finished`. The test client disconnects it during requests.
+    """
+    return any(
+        lookup_key[0] == id(close_old_connections)
+        for lookup_key, receiver in request_finished.receivers
+    )
+
+
+def _request_finished(sender, **kwargs):
+    for scope in reversed(_request_scopes):
+        try:
+            scope.end_all()
+        except Exception:
+            logger.exception('Error ending %s block', scope.name)
+            scope.discard_all()
+
+    # Django's receiver, connected before ours, has already closed the
+    # connection; close the one opened by the work done above as well
+    if _closes_connections():
+        close_old_connections()
+
+
+def _got_request_exception(sender, **kwargs):
+    # The transaction will be rolled back, don't do anything
+    for scope in _request_scopes:
+        if scope.get_blocks():
+            logger.debug('Discarding %s blocks after exception', scope.name)
+            scope.discard_all()
+
+
+request_started.connect(
+    _request_started, dispatch_uid='vspace_utils.scopes.request_started')
+request_finished.connect(
+    _request_finished, dispatch_uid='vspace_utils.scopes.request_finished')
+got_request_exception.connect(
+    _got_request_exception,
+    dispatch_uid='vspace_utils.scopes.got_request_exception'
+)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'OutboxMessage'
+        db.create_table('vspace_utils_outboxmessage', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('subject', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('recipients', self.gf('django.db.models.fields.TextField')()),
+            ('message', self.gf('django.db.models.fields.TextField')()),
+            ('created', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('attempts', self.gf('django.db.models.fields.PositiveSmallIntegerField')(default=0)),
+            ('locked_until', self.gf('django.db.models.fields.DateTimeField')(db_index=True, null=True, blank=True)),
+            ('lock_id', self.gf('django.db.models.fields.CharField')(db_index=True, max_length=32, blank=True)),
+            ('last_error', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal('vspace_utils', ['OutboxMessage'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'OutboxMessage'
+        db.delete_table('vspace_utils_outboxmessage')
+
+
+    models = {
+        'vspace_utils.outboxmessage': {
+            'Meta': {'ordering': "('pk',)", 'object_name': 'OutboxMessage'},
+            'attempts': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'lock_id': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '32', 'blank': 'True'}),
+            'locked_until': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {}),
+            'recipients': ('django.db.models.fields.TextField', [], {}),
+            'subject': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'vspace_utils.queuedlistenercall': {
+            'Meta': {'ordering': "('pk',)", 'object_name': 'QueuedListenerCall'},
+            'attempts': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'listener': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'locked_until': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'payload': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['vspace_utils']
\ No newline at end of file
@@ -0,0 +1,502 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import atexit
+import bisect
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+# Upper bounds, in seconds, of the duration histogram buckets. The last
+# bucket holds all durations above the last bound.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Phase for the listener call as a whole
+DISPATCH = 'dispatch'
+
+CACHE_KEY_PREFIX = 'vspace_utils.listener_stats'
+
+# Timeout of shared statistics; `None` means the default timeout of the
+# cache backend for Django < 1.6, 30 days is the maximum for memcached
+CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class Metric(object):
+    """ Call count, error count and duration histogram for a phase. """
+
+    __slots__ = ('calls', 'errors', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+        self.buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total': self.total,
+            'mean': self.calls and self.total / self.calls,
+            'max': self.max,
+            'histogram': zip(BUCKETS + (None, ), self.buckets),
+        }
+
+
+class Measurement(object):
+    """
+    Context manager recording the duration of a phase, and whether it
+    raised an exception.
+    """
+
+    __slots__ = ('name', 'phase', 'slow_threshold', 'start')
+
+    def __init__(self, name, phase, slow_threshold=None):
+        self.name = name
+        self.phase = phase
+        self.slow_threshold = slow_threshold
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+
+        record(self.name, self.phase, duration, exc_type is not None)
+
+        if self.slow_threshold is not None and \
+                duration >= self.slow_threshold:
+            logger.warning(
+                'Slow listener %s: %s took %.3f seconds',
+                self.name, self.phase, duration
+            )
+
+        return False
+
+
+class QueryCounter(object):
+    """
+    Context manager counting the database queries executed within the
+    block in `count`. Queries are only logged by Django with `DEBUG`
+    enabled, unless `force` is set. Queries logged because of `force` are
+    removed from the log afterwards, as it is only cleared when requests
+    start.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, force=False):
+        self.connection = connections[using]
+        self.force = force
+        self.count = None
+
+    def __enter__(self):
+        self.enabled = self.force or settings.DEBUG
+
+        if self.enabled:
+            if self.force:
+                self.use_debug_cursor = self.connection.use_debug_cursor
+                self.connection.use_debug_cursor = True
+
+            self.start = len(self.connection.queries)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.enabled:
+            self.count = len(self.connection.queries) - self.start
+
+            if self.force:
+                self.connection.use_debug_cursor = self.use_debug_cursor
+
+                # Only when logging was enabled for counting
+                if not (self.use_debug_cursor or settings.DEBUG):
+                    del self.connection.queries[self.start:]
+
+        return False
+
+
+class NullMeasurement(object):
+    """ Measurement used when statistics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_measurement = NullMeasurement()
+
+_lock = threading.Lock()
+
+# Metrics since the process started and since the last flush, keyed by
+# (name, phase)
+_metrics = {}
+_pending = {}
+
+# Counters, likewise keyed by (name, counter)
+_counters = {}
+_pending_counters = {}
+
+# Process id of the thread flushing to the shared cache, if started
+_flusher_pid = [None]
+
+
+def is_enabled():
+    """ Whether statistics are collected, from the `LISTENER_STATS` setting. """
+    return getattr(settings, 'LISTENER_STATS', True)
+
+
+def get_slow_threshold():
+    """
+    Duration in seconds above which listener calls are logged as slow, from
+    the `LISTENER_SLOW_THRESHOLD` setting. `None` disables the warnings.
+    """
+    return getattr(settings, 'LISTENER_SLOW_THRESHOLD', 1.0)
+
+
+def get_flush_interval():
+    """
+    Seconds between flushes to the shared cache, from the
+    `LISTENER_STATS_FLUSH_INTERVAL` setting. `None` disables automatic
+    flushing.
+    """
+    return getattr(settings, 'LISTENER_STATS_FLUSH_INTERVAL', 60)
+
+
+def get_shared_cache():
+    """
+    The Django cache set by the `LISTENER_STATS_CACHE` setting.
+
+    Statistics are only shared between processes through a cache shared
+    by those processes, ie. memcached. With a local memory cache, Django's
+    default, the `listener_stats` command sees no statistics but its own.
+    """
+    cache_alias = getattr(settings, 'LISTENER_STATS_CACHE', 'default')
+
+    try:
+        from django.core.cache import caches
+        return caches[cache_alias]
+    except ImportError:
+        # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(cache_alias)
+
+
+def measure(name, phase=DISPATCH, slow_threshold=None):
+    """
+    Return a context manager recording the duration of `phase` for the
+    listener `name`. When the duration exceeds `slow_threshold` seconds, a
+    warning is logged.
+
+    Usage::
+
+        with measure('myapp.listeners.MyListener', 'render'):
+            render_something()
+    """
+    if not is_enabled():
+        return _null_measurement
+
+    return Measurement(name, phase, slow_threshold)
+
+
+def record(name, phase, duration, error=False):
+    """ Record a call of `duration` seconds. """
+    key = (name, phase)
+
+    with _lock:
+        for metrics in (_metrics, _pending):
+            metric = metrics.get(key)
+            if metric is None:
+                metric = metrics[key] = Metric()
+
+            metric.add(duration, error)
+
+    if _flusher_pid[0] != os.getpid():
+        _start_flusher()
+
+
+def incr(name, counter, value=1):
+    """ Increment `counter`, ie. the number of messages, for `name`. """
+    if not is_enabled():
+        return
+
+    key = (name, counter)
+
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _pending_counters[key] = _pending_counters.get(key, 0) + value
+
+    if _flusher_pid[0] != os.getpid():
+        _start_flusher()
+
+
+def snapshot():
+    """
+    Return the statistics of the current process as a dictionary, mapping
+    listener names to dictionaries of phases. Every phase has the keys
+    `calls`, `errors`, `total`, `mean` and `max`, durations in seconds, and
+    `histogram`: a list of (upper bound, count) tuples.
+    """
+    with _lock:
+        result = {}
+        for (name, phase), metric in _metrics.iteritems():
+            result.setdefault(name, {})[phase] = metric.as_dict()
+
+    return result
+
+
+def counters():
+    """
+    Return the counters of the current process as a dictionary, mapping
+    listener names to dictionaries of counters.
+    """
+    with _lock:
+        result = {}
+        for (name, counter), value in _counters.iteritems():
+            result.setdefault(name, {})[counter] = value
+
+    return result
+
+
+def reset():
+    """ Clear the statistics of the current process. """
+    with _lock:
+        _metrics.clear()
+        _pending.clear()
+        _counters.clear()
+        _pending_counters.clear()
+
+
+def _flush_periodically(interval):
+    while True:
+        time.sleep(interval)
+        flush()
+
+
+def _start_flusher():
+    """
+    Start the thread flushing statistics every
+    `LISTENER_STATS_FLUSH_INTERVAL` seconds, once per process as threads
+    don't survive forking.
+    """
+    with _lock:
+        pid = os.getpid()
+
+        if _flusher_pid[0] == pid:
+            return
+
+        _flusher_pid[0] = pid
+
+    interval = get_flush_interval()
+    if interval is None:
+        return
+
+    thread = threading.Thread(
+        target=_flush_periodically, args=(interval, ),
+        name='listener-stats-flusher'
+    )
+    thread.daemon = True
+    thread.start()
+
+
+def _get_cache_keys(name, phase):
+    key = '%s.%s.%s' % (CACHE_KEY_PREFIX, name, phase)
+
+    return [
+        '%s.%s' % (key, field) for field in ('calls', 'errors', 'total')
+    ] + [
+        '%s.bucket%d' % (key, index) for index in xrange(len(BUCKETS) + 1)
+    ]
+
+
+def _get_counter_key(name, counter):
+    return '%s.%s.counter.%s' % (CACHE_KEY_PREFIX, name, counter)
+
+
+def _incr(cache, key, delta):
+    """ Increment `key`, which is added when missing. """
+    cache.add(key, 0, CACHE_TIMEOUT)
+
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Expired or evicted in between
+        cache.set(key, delta, CACHE_TIMEOUT)
+        return delta
+
+
+# Shared indexes of (name, phase) and (name, counter) tuples. Entries are
+# stored in numbered keys, allocated through incr(), and guarded by a key
+# per entry added with add(), so concurrent processes never overwrite each
+# other's entries.
+METRICS_INDEX = 'index'
+COUNTERS_INDEX = 'counters'
+
+
+def _get_index_count_key(index):
+    return '%s.%s.count' % (CACHE_KEY_PREFIX, index)
+
+
+def _get_index_guard_key(index, entry):
+    return '%s.%s.entry.%s' % (CACHE_KEY_PREFIX, index, '.'.join(entry))
+
+
+def _get_index_entry_key(index, position):
+    return '%s.%s.%d' % (CACHE_KEY_PREFIX, index, position)
+
+
+def _add_to_index(cache, index, entry):
+    if not cache.add(_get_index_guard_key(index, entry), True, CACHE_TIMEOUT):
+        # Already indexed
+        return
+
+    position = _incr(cache, _get_index_count_key(index), 1)
+    cache.set(_get_index_entry_key(index, position), entry, CACHE_TIMEOUT)
+
+
+def _get_index(cache, index):
+    """ Return the entries of `index`, leaving out evicted ones. """
+    count = cache.get(_get_index_count_key(index)) or 0
+
+    keys = [
+        _get_index_entry_key(index, position)
+        for position in xrange(1, count + 1)
+    ]
+    values = cache.get_many(keys)
+
+    entries = []
+    for key in keys:
+        if key in values and tuple(values[key]) not in entries:
+            entries.append(tuple(values[key]))
+
+    return entries
+
+
+def flush():
+    """
+    Add the statistics recorded since the last flush to the shared cache,
+    where they are combined with those of other processes. This happens
+    automatically, from a separate thread, every
+    `LISTENER_STATS_FLUSH_INTERVAL` seconds and when the process exits.
+    """
+    with _lock:
+        pending = _pending.items()
+        _pending.clear()
+
+        pending_counters = _pending_counters.items()
+        _pending_counters.clear()
+
+    if not (pending or pending_counters):
+        return
+
+    try:
+        cache = get_shared_cache()
+
+        for (name, phase), metric in pending:
+            _add_to_index(cache, METRICS_INDEX, (name, phase))
+
+            # Durations are stored in microseconds, for incr()
+            deltas = [
+                metric.calls, metric.errors, int(metric.total * 1000000)
+            ] + metric.buckets
+
+            for key, delta in zip(_get_cache_keys(name, phase), deltas):
+                if delta:
+                    _incr(cache, key, delta)
+
+        for (name, counter), value in pending_counters:
+            _add_to_index(cache, COUNTERS_INDEX, (name, counter))
+
+            if value:
+                _incr(cache, _get_counter_key(name, counter), value)
+
+    except Exception:
+        logger.exception('Error flushing listener statistics')
+
+
+def _flush_at_exit():
+    if _flusher_pid[0] == os.getpid() and get_flush_interval() is not None:
+        flush()
+
+
+atexit.register(_flush_at_exit)
+
+
+def shared_snapshot():
+    """
+    Return the statistics flushed by all processes, in the format of
+    `snapshot()`. The maximum duration is not shared, and always 0.
+    """
+    cache = get_shared_cache()
+
+    result = {}
+    for name, phase in _get_index(cache, METRICS_INDEX):
+        keys = _get_cache_keys(name, phase)
+        values = cache.get_many(keys)
+
+        metric = Metric()
+        metric.calls = values.get(keys[0], 0)
+        metric.errors = values.get(keys[1], 0)
+        metric.total = values.get(keys[2], 0) / 1000000.0
+        metric.buckets = [values.get(key, 0) for key in keys[3:]]
+
+        result.setdefault(name, {})[phase] = metric.as_dict()
+
+    return result
+
+
+def shared_counters():
+    """ Return the counters flushed by all processes. """
+    cache = get_shared_cache()
+
+    index = _get_index(cache, COUNTERS_INDEX)
+    values = cache.get_many([
+        _get_counter_key(name, counter) for name, counter in index
+    ])
+
+    result = {}
+    for name, counter in index:
+        result.setdefault(name, {})[counter] = values.get(
+            _get_counter_key(name, counter), 0)
+
+    return result
+
+
+def reset_shared():
+    """ Clear the statistics in the shared cache. """
+    cache = get_shared_cache()
+
+    keys = []
+    for index, get_keys in (
+            (METRICS_INDEX, lambda entry: _get_cache_keys(*entry)),
+            (COUNTERS_INDEX, lambda entry: [_get_counter_key(*entry)])):
+        count_key = _get_index_count_key(index)
+
+        keys.append(count_key)
+        keys.extend(
+            _get_index_entry_key(index, position)
+            for position in xrange(1, (cache.get(count_key) or 0) + 1)
+        )
+
+        for entry in _get_index(cache, index):
+            keys.append(_get_index_guard_key(index, entry))
+            keys.extend(get_keys(entry))
+
+    cache.delete_many(keys)
@@ -1,10 +1,47 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import BaseHTTPServer
+import shutil
+import tempfile
+import threading
+import time
+
+from cStringIO import StringIO
+
+from django.conf.urls import patterns, url
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
+from django.core.signals import (
+    request_started, request_finished, got_request_exception
+)
 from django.core.urlresolvers import reverse
+from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import Signal
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import unittest
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6
+    from django.db import close_connection as close_old_connections
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 from py_w3c.validators.html.validator import HTMLValidator
 
+from vspace_utils.listeners import EmailingListener, Listener
+from vspace_utils.models import AutoSlugMixin, AutoUniqueSlugMixin
+
 try:
     from sitemap import UrlSet
 except ImportError:
@@ -93,3 +130,2373 @@ class SitemapTesterMixin(object):
 
         for url in self.get_sitemap_urls():
             self._test_sitemap(url)
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.server.requests.append(self.path)
+
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _LocalServer(BaseHTTPServer.HTTPServer):
+    """ Local HTTP server, counting requests and connections. """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), _RequestHandler)
+
+        self.requests = []
+        self.connections = 0
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+
+        # Handle every connection in its own thread
+        thread = threading.Thread(
+            target=BaseHTTPServer.HTTPServer.process_request,
+            args=(self, request, client_address)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LinkCheckerTests(TestCase):
+    def setUp(self):
+        self.server = _LocalServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_check(self):
+        from vspace_utils.linkcheck import LinkChecker
+
+        checker = LinkChecker()
+
+        self.assertTrue(checker.check(self.server.url + '/'))
+        self.assertFalse(checker.check(self.server.url + '/missing'))
+
+        # Results are cached
+        self.assertTrue(checker.check(self.server.url + '/'))
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Over a single keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+        checker.close()
+
+    def test_invalid(self):
+        from vspace_utils.linkcheck import LinkChecker
+
+        self.assertRaises(ValueError, LinkChecker().check, '/relative')
+
+    def test_max_pools(self):
+        from vspace_utils.linkcheck import LinkChecker
+
+        servers = [_LocalServer() for i in xrange(3)]
+
+        try:
+            checker = LinkChecker(max_pools=2)
+
+            pools = []
+            for server in servers:
+                checker.check(server.url + '/')
+                pools.append(checker.get_pool('http', '127.0.0.1',
+                                              server.server_port))
+
+            self.assertEqual(len(checker._pools), 2)
+
+            # The pool of the least recently used host has been closed
+            self.assertEqual(len(pools[0]), 0)
+            self.assertEqual(len(pools[2]), 1)
+
+            checker.close()
+            self.assertEqual(len(pools[2]), 0)
+
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_idle_sweep(self):
+        from vspace_utils.linkcheck import HostConnectionPool
+
+        pool = HostConnectionPool(
+            'http', '127.0.0.1', self.server.server_port, idle_timeout=0)
+
+        first, reused = pool.get()
+        first.connect()
+        pool.put(first)
+
+        # Returning a connection sweeps the expired one
+        second = pool.new_connection()
+        pool.put(second)
+
+        self.assertEqual(len(pool), 1)
+        self.assertTrue(first.sock is None)
+
+    def test_validate_many(self):
+        from vspace_utils.linkcheck import LinkChecker
+        from vspace_utils.validators import URLValidator
+
+        checker = LinkChecker()
+        validator = URLValidator(verify_exists=True, checker=checker)
+
+        urls = ['%s/%d' % (self.server.url, i) for i in xrange(10)]
+        urls.append(self.server.url + '/missing')
+        urls.append('invalid')
+
+        results = validator.validate_many(urls, per_host=2)
+
+        for url in urls[:10]:
+            self.assertEqual(results[url], None)
+
+        self.assertTrue(results[urls[10]])
+        self.assertTrue(results['invalid'])
+
+        # At most two connections, kept by the given checker
+        self.assertTrue(self.server.connections <= 2)
+        self.assertTrue(checker._pools)
+
+        checker.close()
+
+    def test_validate_many_default_checker(self):
+        from vspace_utils.linkcheck import get_default_checker
+        from vspace_utils.validators import URLValidator
+
+        default_checker = get_default_checker()
+        default_checker.check(self.server.url + '/')
+        pools = dict(default_checker._pools)
+
+        urls = ['%s/%d' % (self.server.url, i) for i in xrange(4)]
+        results = URLValidator(verify_exists=True).validate_many(urls)
+
+        self.assertEqual(results.values(), [None] * 4)
+
+        # A checker of its own is used and closed, the process-wide one is
+        # left alone
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(default_checker._pools, pools)
+        self.assertEqual(len(pools.values()[0]), 1)
+
+        default_checker.close()
+
+
+def _page_view(request):
+    from django.http import HttpResponse
+
+    return HttpResponse('Page')
+
+
+urlpatterns = patterns('',
+    url(r'^page/$', _page_view),
+)
+
+
+class RelativeURLValidatorTests(TestCase):
+    # Resolve against the patterns above
+    urls = 'vspace_utils.tests'
+
+    def setUp(self):
+        from django.core.urlresolvers import get_resolver
+
+        # Count actual resolving
+        self.resolved = []
+        resolver = get_resolver(None)
+        resolve = resolver.resolve
+
+        def counting_resolve(path):
+            self.resolved.append(path)
+            return resolve(path)
+
+        resolver.resolve = counting_resolve
+
+    def test_cached(self):
+        from vspace_utils.validators import RelativeURLValidator
+
+        validator = RelativeURLValidator(verify_exists=True)
+
+        validator('/page/')
+        RelativeURLValidator(verify_exists=True)('/page/')
+
+        # The query string and fragment are not resolved, nor part of the key
+        validator('/page/?q=test')
+        validator('/page/#top')
+
+        self.assertEqual(self.resolved, ['/page/'])
+
+    def test_not_found(self):
+        from django.core.exceptions import ValidationError
+        from vspace_utils.validators import RelativeURLValidator
+
+        validator = RelativeURLValidator(verify_exists=True)
+
+        for value in ('/missing/', '/missing/?q=test'):
+            try:
+                validator(value)
+            except ValidationError, e:
+                self.assertEqual(e.code, 'invalid_link')
+            else:
+                self.fail('ValidationError not raised for %s' % value)
+
+        # Not found is cached as well
+        self.assertEqual(self.resolved, ['/missing/'])
+
+
+class _Rdata(object):
+    def __init__(self, text):
+        self.text = text
+
+    def to_text(self):
+        return self.text
+
+
+class _Answer(list):
+    """ Stand-in for dnspython answers: iterable rdata and an rrset TTL. """
+
+    class RRset(object):
+        def __init__(self, ttl):
+            self.ttl = ttl
+
+    def __init__(self, records, ttl=300):
+        super(_Answer, self).__init__(_Rdata(record) for record in records)
+        self.rrset = self.RRset(ttl)
+
+
+class _StubResolver(object):
+    """
+    Resolver answering from a dict of `(domain, rdtype)` to answers or
+    exceptions, NXDOMAIN for anything else. Lookups of domains in `hang`
+    block until `release` is set or their lifetime has passed.
+    """
+
+    def __init__(self, answers=None, hang=()):
+        self.answers = answers or {}
+        self.hang = hang
+        self.release = threading.Event()
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def query(self, domain, rdtype, lifetime=None):
+        import dns.exception
+        import dns.resolver
+
+        with self._lock:
+            self.queries.append((domain, rdtype))
+
+        if domain in self.hang:
+            self.release.wait(lifetime or 10)
+            raise dns.exception.Timeout()
+
+        answer = self.answers.get((domain, rdtype), dns.resolver.NXDOMAIN)
+
+        if isinstance(answer, type) and issubclass(answer, Exception):
+            raise answer()
+
+        return answer
+
+
+class _Clock(object):
+    """ Replacement for the time module, with a settable time. """
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+class CachingResolverTests(TestCase):
+    def setUp(self):
+        from vspace_utils import caching
+
+        self.clock = _Clock()
+        self._time = caching.time
+        caching.time = self.clock
+
+    def tearDown(self):
+        from vspace_utils import caching
+
+        caching.time = self._time
+
+    def test_ttl(self):
+        from vspace_utils.mx import CachingResolver
+
+        stub = _StubResolver({
+            ('example.com', 'MX'): _Answer(['10 mx.example.com.'], ttl=60),
+            ('example.org', 'MX'): _Answer(['10 mx.example.org.'], ttl=10 ** 6),
+        })
+        resolver = CachingResolver(resolver=stub, max_ttl=3600)
+
+        self.assertEqual(
+            resolver.query('example.com'), ('10 mx.example.com.', ))
+        self.assertEqual(
+            resolver.query('Example.COM.'), ('10 mx.example.com.', ))
+        self.assertEqual(len(stub.queries), 1)
+
+        # Cached for the TTL of the records
+        self.clock.now += 59
+        resolver.query('example.com')
+        self.assertEqual(len(stub.queries), 1)
+
+        self.clock.now += 2
+        resolver.query('example.com')
+        self.assertEqual(len(stub.queries), 2)
+
+        # But no longer than max_ttl
+        resolver.query('example.org')
+        self.clock.now += 3599
+        resolver.query('example.org')
+        self.assertEqual(len(stub.queries), 3)
+
+        self.clock.now += 2
+        resolver.query('example.org')
+        self.assertEqual(len(stub.queries), 4)
+
+    def test_negative(self):
+        import dns.exception
+        import dns.resolver
+
+        from vspace_utils.mx import CachingResolver
+
+        stub = _StubResolver({
+            ('example.com', 'MX'): _Answer(['10 mx.example.com.'], ttl=3600),
+            ('example.org', 'MX'): dns.resolver.NoAnswer,
+            ('example.net', 'MX'): dns.exception.Timeout,
+        })
+        resolver = CachingResolver(resolver=stub, negative_ttl=30)
+
+        for i in xrange(2):
+            resolver.query('example.com')
+            self.assertRaises(
+                dns.resolver.NXDOMAIN, resolver.query, 'missing.com')
+            self.assertRaises(
+                dns.resolver.NoAnswer, resolver.query, 'example.org')
+
+        self.assertEqual(len(stub.queries), 3)
+
+        # Non-existing domains are cached for a shorter time
+        self.clock.now += 31
+        resolver.query('example.com')
+        self.assertRaises(dns.resolver.NXDOMAIN, resolver.query, 'missing.com')
+        self.assertEqual(len(stub.queries), 4)
+
+        # Timeouts aren't cached at all
+        for i in xrange(2):
+            self.assertRaises(
+                dns.exception.Timeout, resolver.query, 'example.net')
+
+        self.assertEqual(len(stub.queries), 6)
+
+    def test_single_flight(self):
+        from vspace_utils.mx import CachingResolver
+
+        # Not cached, so later lookups would query again
+        stub = _StubResolver(
+            {('example.com', 'MX'): _Answer(['10 mx.example.com.'], ttl=0)})
+        resolver = CachingResolver(resolver=stub)
+
+        # Block the first lookup until all threads are waiting for it
+        query = stub.query
+        started = threading.Event()
+
+        def blocking_query(*args, **kwargs):
+            started.set()
+            stub.release.wait(10)
+            return query(*args, **kwargs)
+
+        stub.query = blocking_query
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(resolver.query('example.com')))
+            for i in xrange(5)
+        ]
+        for thread in threads:
+            thread.start()
+
+        started.wait(10)
+        time.sleep(0.2)
+        stub.release.set()
+
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(results, [('10 mx.example.com.', )] * 5)
+        self.assertEqual(len(stub.queries), 1)
+
+        resolver.query('example.com')
+        self.assertEqual(len(stub.queries), 2)
+
+
+class ValidateAddressesTests(TestCase):
+    def setUp(self):
+        from vspace_utils.mx import CachingResolver
+
+        self.stub = _StubResolver({
+            ('example.com', 'MX'): _Answer(['10 mx.example.com.']),
+        }, hang=('slow.com', ))
+        self.resolver = CachingResolver(resolver=self.stub)
+
+    def tearDown(self):
+        self.stub.release.set()
+        self.resolver.close()
+
+    def test_streamed(self):
+        from vspace_utils.mx import validate_addresses
+
+        results = validate_addresses([
+            'a@example.com', 'c@slow.com', 'invalid', 'b@Example.com',
+            'd@missing.com'
+        ], resolver=self.resolver, timeout=5)
+
+        # Syntax errors come first
+        address, error = results.next()
+        self.assertEqual(address, 'invalid')
+        self.assertTrue(error)
+
+        # Followed by the verdicts of resolved domains, without waiting for
+        # slow ones
+        verdicts = dict(results.next() for i in xrange(3))
+        self.assertEqual(verdicts['a@example.com'], None)
+        self.assertEqual(verdicts['b@Example.com'], None)
+        self.assertTrue(verdicts['d@missing.com'])
+
+        self.stub.release.set()
+        self.assertEqual(results.next()[0], 'c@slow.com')
+        self.assertRaises(StopIteration, results.next)
+
+        # Every domain is looked up once
+        self.assertEqual(self.stub.queries.count(('example.com', 'MX')), 1)
+
+    def test_timeout(self):
+        from vspace_utils.mx import validate_addresses
+
+        addresses = ['a@slow.com', 'b@slow.com', 'c@example.com']
+
+        start = time.time()
+        verdicts = dict(validate_addresses(
+            addresses, resolver=self.resolver, timeout=0.2))
+        self.assertTrue(time.time() - start < 2)
+
+        self.assertTrue(verdicts['a@slow.com'])
+        self.assertTrue(verdicts['b@slow.com'])
+        self.assertEqual(verdicts['c@example.com'], None)
+
+        verdicts = dict(validate_addresses(
+            addresses, resolver=self.resolver, timeout=0.2,
+            on_timeout='accept'))
+        self.assertEqual(verdicts['a@slow.com'], None)
+
+
+class CheckMailDomainTests(TestCase):
+    def setUp(self):
+        import dns.resolver
+
+        from vspace_utils.mx import CachingResolver
+
+        self.stub = _StubResolver({
+            ('example.com', 'MX'): _Answer(['10 mx.example.com.']),
+            ('example.org', 'MX'): dns.resolver.NoAnswer,
+            ('example.org', 'A'): _Answer(['192.0.2.1']),
+        }, hang=('slow.com', ))
+        self.resolver = CachingResolver(resolver=self.stub, max_lookups=2)
+
+    def tearDown(self):
+        self.stub.release.set()
+        self.resolver.close()
+
+    def test_check(self):
+        self.assertEqual(self.resolver.check_mail_domain('example.com'), 'ok')
+        self.assertEqual(self.resolver.check_mail_domain('example.org'), 'ok')
+        self.assertEqual(
+            self.resolver.check_mail_domain('missing.com'), 'nxdomain')
+
+        # Lookups run on a shared, bounded pool
+        pool = self.resolver.get_pool()
+        self.assertEqual(len(pool._pool), 2)
+
+        self.assertEqual(
+            self.resolver.check_mail_domain('slow.com', lifetime=0.1),
+            'timeout')
+        self.assertTrue(self.resolver.get_pool() is pool)
+
+    def test_default_lifetime(self):
+        from vspace_utils.mx import CachingResolver
+
+        self.assertEqual(CachingResolver(resolver=self.stub).lifetime, 5)
+
+    def test_on_timeout(self):
+        from django.core.exceptions import ValidationError
+
+        from vspace_utils.mx import validate_domain
+
+        # Non-existing domains are rejected regardless of the policy
+        self.assertRaises(
+            ValidationError, validate_domain, 'missing.com', self.resolver,
+            on_timeout='accept'
+        )
+
+        for on_timeout in ('reject', 'defer'):
+            try:
+                validate_domain(
+                    'slow.com', self.resolver, lifetime=0.1,
+                    on_timeout=on_timeout)
+            except ValidationError, e:
+                pass
+            else:
+                self.fail('No ValidationError raised')
+
+            self.assertEqual(
+                e.code, 'dns_timeout' if on_timeout == 'defer' else None)
+
+        validate_domain(
+            'slow.com', self.resolver, lifetime=0.1, on_timeout='accept')
+
+    def test_lookup_completed(self):
+        from vspace_utils.mx import lookup_completed
+
+        lookups = []
+
+        def receiver(sender, domain, rdtype, status, duration, **kwargs):
+            lookups.append((domain, rdtype, status))
+
+        lookup_completed.connect(receiver)
+        try:
+            self.resolver.query('example.com')
+            self.resolver.query('example.com')
+
+            self.assertRaises(Exception, self.resolver.query, 'missing.com')
+        finally:
+            lookup_completed.disconnect(receiver)
+
+        # Only sent for uncached lookups
+        self.assertEqual(lookups, [
+            ('example.com', 'MX', 'ok'),
+            ('missing.com', 'MX', 'nxdomain'),
+        ])
+
+
+def _create_image(format, size=(13, 7), mode='RGB', **kwargs):
+    """ Return the contents of an image file. """
+    f = StringIO()
+    Image.new(mode, size).save(f, format, **kwargs)
+
+    return f.getvalue()
+
+
+class SniffMimetypeTests(TestCase):
+    def test_signatures(self):
+        from vspace_utils.files import sniff_mimetype
+
+        self.assertEqual(sniff_mimetype('%PDF-1.4\n'), 'application/pdf')
+        self.assertEqual(
+            sniff_mimetype('RIFF\x00\x00\x00\x00WAVEfmt '), 'audio/wav')
+        self.assertEqual(sniff_mimetype('ID3\x03\x00'), 'audio/mpeg')
+
+        # MPEG-1 layer III frame, 128 kbit/s at 44.1 kHz
+        self.assertEqual(
+            sniff_mimetype('\xff\xfb\x90\x64' + '\x00' * 100), 'audio/mpeg')
+
+    def test_refined_by_name(self):
+        from vspace_utils.files import sniff_mimetype
+
+        self.assertEqual(
+            sniff_mimetype('PK\x03\x04', 'report.docx'),
+            'application/vnd.openxmlformats-officedocument.'
+            'wordprocessingml.document'
+        )
+        self.assertEqual(sniff_mimetype('PK\x03\x04', 'image.png'),
+                         'application/zip')
+
+    def test_short_signatures_in_text(self):
+        from vspace_utils.files import sniff_mimetype
+
+        csv = 'BMW;Audi;Volkswagen\n1;2;3\n'
+        self.assertEqual(sniff_mimetype(csv, 'cars.csv'), 'text/csv')
+        self.assertEqual(sniff_mimetype(csv), 'text/plain')
+
+        # Invalid bitrate and sampling rate
+        self.assertNotEqual(
+            sniff_mimetype('\xff\xfb\xff\xff' + 'x' * 100), 'audio/mpeg')
+
+    def test_svg(self):
+        from vspace_utils.files import sniff_mimetype
+
+        svg = '<svg xmlns="http://www.w3.org/2000/svg" width="10"></svg>'
+
+        self.assertEqual(sniff_mimetype(svg), 'image/svg+xml')
+        self.assertEqual(sniff_mimetype(
+            '\xef\xbb\xbf<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!-- Generator: Editor -->\n'
+            '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" '
+            '"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n' + svg
+        ), 'image/svg+xml')
+
+        # HTML with inline SVG
+        self.assertEqual(
+            sniff_mimetype('<!DOCTYPE html><html><body>%s</body></html>' % svg),
+            'text/html'
+        )
+
+        # Text mentioning SVG
+        self.assertEqual(
+            sniff_mimetype('Embed images with <svg> elements.'), 'text/plain')
+        self.assertEqual(
+            sniff_mimetype('<?xml version="1.0"?><doc><svg/></doc>'),
+            'application/xml'
+        )
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_bmp(self):
+        from vspace_utils.files import sniff_mimetype
+
+        self.assertEqual(
+            sniff_mimetype(_create_image('BMP')), 'image/bmp')
+
+
+class _CountingFile(object):
+    """ File wrapper counting the number of bytes read. """
+
+    def __init__(self, f, counter):
+        self.file = f
+        self.counter = counter
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.counter.append(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class _CountingStorage(FileSystemStorage):
+    """ Local filesystem stand-in for remote storages, counting reads. """
+
+    def __init__(self, *args, **kwargs):
+        super(_CountingStorage, self).__init__(*args, **kwargs)
+        self.reads = []
+
+    def _open(self, name, mode='rb'):
+        f = super(_CountingStorage, self)._open(name, mode)
+        f.file = _CountingFile(f.file, self.reads)
+        return f
+
+
+@unittest.skipIf(Image is None, 'PIL is not installed')
+class ImageDimensionsTests(TestCase):
+    formats = (
+        ('PNG', {}),
+        ('GIF', {}),
+        ('JPEG', {}),
+        ('JPEG', {'progressive': True}),
+        ('BMP', {}),
+        ('WEBP', {}),
+        ('WEBP', {'lossless': True}),
+    )
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = _CountingStorage(location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_formats(self):
+        from vspace_utils.images import parse_image_dimensions
+
+        for format, kwargs in self.formats:
+            data = _create_image(format, **kwargs)
+
+            self.assertEqual(
+                parse_image_dimensions(StringIO(data)), (13, 7),
+                '%s %s' % (format, kwargs)
+            )
+
+    def test_not_an_image(self):
+        from vspace_utils.images import parse_image_dimensions
+
+        self.assertEqual(parse_image_dimensions(StringIO('Hello')), None)
+
+        # Text starting with the BMP signature
+        self.assertEqual(
+            parse_image_dimensions(StringIO('BMW;Audi\n' * 10)), None)
+
+    def test_truncated(self):
+        from vspace_utils.images import parse_image_dimensions
+
+        data = _create_image('PNG')
+        self.assertEqual(parse_image_dimensions(StringIO(data[:20])), None)
+
+    def test_get_image_dimensions(self):
+        from vspace_utils.images import get_image_dimensions
+
+        name = self.storage.save(
+            'image.png', ContentFile(_create_image('PNG')))
+
+        # Paths, as well as open files, keeping their position
+        self.assertEqual(
+            get_image_dimensions(self.storage.path(name)), (13, 7))
+
+        f = open(self.storage.path(name), 'rb')
+        try:
+            f.seek(5)
+            self.assertEqual(get_image_dimensions(f), (13, 7))
+            self.assertEqual(f.tell(), 5)
+        finally:
+            f.close()
+
+    def test_storage_reads_header_only(self):
+        from vspace_utils.images import get_storage_image_dimensions
+
+        # Large metadata segment before the JPEG frame header
+        data = _create_image(
+            'JPEG', size=(640, 480), exif='Exif\x00\x00' + 'x' * 60000)
+        name = self.storage.save('large.jpg', ContentFile(data))
+
+        self.assertEqual(
+            get_storage_image_dimensions(self.storage, name), (640, 480))
+
+        # Segments are skipped instead of read
+        self.assertTrue(sum(self.storage.reads) < 3 * 4096)
+        self.assertTrue(len(data) > 60000)
+
+    def test_validator_sizes(self):
+        from django.core.exceptions import ValidationError
+        from vspace_utils.validators import ImageDimensionsValidator
+
+        image = ContentFile(_create_image('PNG'), name='image.png')
+
+        # Minimum and maximum sizes can be used without allowed sizes
+        ImageDimensionsValidator(min_size=(10, 5))(image)
+        ImageDimensionsValidator(allowed_sizes=[(13, 7)])(image)
+
+        self.assertRaises(
+            ValidationError, ImageDimensionsValidator(max_size=(10, 10)),
+            image
+        )
+
+        # But not combined with allowed sizes
+        self.assertRaises(
+            AssertionError, ImageDimensionsValidator,
+            max_size=(10, 10), allowed_sizes=[(13, 7)]
+        )
+
+
+class ValidatingUploadHandlerTests(TestCase):
+    def upload(self, name, data, **kwargs):
+        """
+        Parse a request uploading a file with `name` and `data`, validated
+        by a `FileValidator` with the given arguments. Returns the handler,
+        the uploaded files and the number of bytes read from the request.
+        """
+        from django.core.files.uploadhandler import MemoryFileUploadHandler
+        from django.http.multipartparser import MultiPartParser
+        from django.test.client import encode_multipart
+        from vspace_utils.uploadhandlers import ValidatingUploadHandler
+        from vspace_utils.validators import FileValidator
+
+        body = encode_multipart('BoUnDaRy', {
+            'title': 'Title',
+            'upload': ContentFile(data, name=name),
+        })
+
+        handler = ValidatingUploadHandler(
+            validators={'upload': [FileValidator(**kwargs)]})
+
+        reads = []
+        parser = MultiPartParser({
+            'CONTENT_TYPE': 'multipart/form-data; boundary=BoUnDaRy',
+            'CONTENT_LENGTH': len(body),
+        }, _CountingFile(StringIO(body), reads), [
+            handler, MemoryFileUploadHandler()
+        ])
+
+        post, files = parser.parse()
+
+        return handler, files, sum(reads)
+
+    def test_valid(self):
+        handler, files, read = self.upload(
+            'document.pdf', '%PDF-1.4\n' + 'x' * 10000,
+            allowed_extensions=('pdf', ),
+            allowed_mimetypes=('application/pdf', ),
+            max_size=100 * 1024
+        )
+
+        self.assertEqual(handler.errors, {})
+        self.assertEqual(files['upload'].size, 10009)
+
+    def test_extension(self):
+        handler, files, read = self.upload(
+            'image.png', 'x' * 1024 * 1024, allowed_extensions=('pdf', ))
+
+        # Stopped before reading the file
+        self.assertEqual(len(handler.errors['upload']), 1)
+        self.assertFalse(files)
+        self.assertTrue(read < 128 * 1024)
+
+    def test_size(self):
+        handler, files, read = self.upload(
+            'document.pdf', '%PDF-1.4\n' + 'x' * 1024 * 1024,
+            max_size=100 * 1024
+        )
+
+        # Stopped once the maximum size has been exceeded
+        self.assertEqual(len(handler.errors['upload']), 1)
+        self.assertFalse(files)
+        self.assertTrue(read < 256 * 1024)
+
+    def test_mimetype(self):
+        handler, files, read = self.upload(
+            'document.pdf', 'Hello\n' * 200 * 1024,
+            allowed_mimetypes=('application/pdf', )
+        )
+
+        # Stopped once the header has been sniffed
+        self.assertEqual(len(handler.errors['upload']), 1)
+        self.assertFalse(files)
+        self.assertTrue(read < 128 * 1024)
+
+    def test_mimetype_short_file(self):
+        # Smaller than the header, sniffed when complete
+        handler, files, read = self.upload(
+            'document.pdf', 'Hello', allowed_mimetypes=('application/pdf', ))
+
+        self.assertEqual(len(handler.errors['upload']), 1)
+        self.assertFalse(files)
+
+
+class FileValidationPipelineTests(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = _CountingStorage(location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def get_validators(self):
+        from vspace_utils.validators import (
+            FileValidator, ImageDimensionsValidator
+        )
+
+        return [
+            FileValidator(allowed_mimetypes=('application/pdf', ),
+                          max_size=24 * 1024 * 1024),
+            ImageDimensionsValidator(max_size=(2000, 2000)),
+        ]
+
+    def read_bytes(self, name, validate):
+        """ Number of bytes read from the storage by `validate(open)`. """
+        del self.storage.reads[:]
+
+        opened = []
+        def open_file():
+            f = self.storage.open(name)
+            opened.append(f)
+            return f
+
+        try:
+            validate(open_file)
+        finally:
+            for f in opened:
+                f.close()
+
+        return sum(self.storage.reads)
+
+    def compare_reads(self, name):
+        """
+        Number of bytes read by separately called validators and by a
+        pipeline of the same validators.
+        """
+        from django.core.exceptions import ValidationError
+        from vspace_utils.validators import FileValidationPipeline
+
+        validators = self.get_validators()
+
+        def chained(open_file):
+            for validator in validators:
+                try:
+                    validator(open_file())
+                except ValidationError:
+                    pass
+
+        def pipeline(open_file):
+            try:
+                FileValidationPipeline(validators)(open_file())
+            except ValidationError:
+                pass
+
+        return (
+            self.read_bytes(name, chained), self.read_bytes(name, pipeline))
+
+    def test_single_pass(self):
+        from vspace_utils.files import WINDOW_SIZE
+
+        # 1 MB document, which isn't an image
+        name = self.storage.save('document.pdf', ContentFile(
+            '%PDF-1.4\n' + 'x' * 1024 * 1024))
+
+        chained_bytes, pipeline_bytes = self.compare_reads(name)
+
+        logger.info(
+            'Document: %d bytes read by chained validators, %d by pipeline',
+            chained_bytes, pipeline_bytes
+        )
+
+        # A single window, even though the file is no image
+        self.assertTrue(0 < pipeline_bytes <= WINDOW_SIZE)
+        self.assertTrue(pipeline_bytes < chained_bytes)
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_single_pass_image(self):
+        from vspace_utils.files import WINDOW_SIZE
+
+        # 2 MB JPEG with a 30 KB EXIF segment
+        data = _create_image(
+            'JPEG', size=(640, 480), exif='Exif\x00\x00' + 'x' * 30000)
+        name = self.storage.save(
+            'image.jpg', ContentFile(data + '\x00' * (2 * 1024 * 1024)))
+
+        chained_bytes, pipeline_bytes = self.compare_reads(name)
+
+        logger.info(
+            'JPEG: %d bytes read by chained validators, %d by pipeline',
+            chained_bytes, pipeline_bytes
+        )
+
+        self.assertTrue(0 < pipeline_bytes <= WINDOW_SIZE)
+        self.assertTrue(pipeline_bytes < chained_bytes)
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_unknown_image_format(self):
+        from vspace_utils.files import inspect_file
+
+        # Not sniffed nor parsed, PIL is used instead
+        name = self.storage.save('image.tga', ContentFile(
+            _create_image('TGA')))
+
+        f = self.storage.open(name)
+        try:
+            info = inspect_file(f)
+
+            self.assertEqual(info.mimetype, None)
+            self.assertEqual(info.dimensions, (13, 7))
+        finally:
+            f.close()
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_errors(self):
+        from django.core.exceptions import ValidationError
+        from vspace_utils.files import inspect_file
+        from vspace_utils.validators import FileValidationPipeline
+
+        name = self.storage.save('image.png', ContentFile(
+            _create_image('PNG', size=(3000, 10))))
+
+        f = self.storage.open(name)
+        try:
+            self.assertEqual(inspect_file(f).dimensions, (3000, 10))
+
+            errors = FileValidationPipeline(
+                self.get_validators()).get_errors(inspect_file(f))
+            self.assertEqual(len(errors), 2)
+
+            self.assertRaises(ValidationError,
+                              FileValidationPipeline(self.get_validators()), f)
+        finally:
+            f.close()
+
+
+class SplitDateFormFieldTests(TestCase):
+    def test_subclass_choices(self):
+        from vspace_utils.fields import SplitDateFormField
+
+        class ShortMonthsField(SplitDateFormField):
+            MONTHS = [(1, 'JAN')]
+
+        # Fill the cache of the parent class first
+        SplitDateFormField().widget.render('date', None)
+
+        html = ShortMonthsField().widget.render('date', None)
+        self.assertTrue('JAN' in html)
+        self.assertFalse('February' in html)
+
+        html = SplitDateFormField().widget.render('date', None)
+        self.assertFalse('JAN' in html)
+
+    def test_widget_cached(self):
+        from vspace_utils.fields import SplitDateFormField
+
+        calls = []
+
+        class CountingField(SplitDateFormField):
+            @classmethod
+            def widget_factory(cls, years):
+                calls.append(years)
+                return super(CountingField, cls).widget_factory(years)
+
+        # The widget class and year choices are built once, not per field
+        widget_classes = set(
+            type(CountingField().widget) for i in xrange(200))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(widget_classes), 1)
+
+        CountingField(reverse=True)
+        self.assertEqual(len(calls), 2)
+
+    def test_lazy_till_date(self):
+        import datetime
+        from django import forms
+        from vspace_utils.fields import SplitDateFormField
+
+        calls = []
+
+        def till_date():
+            calls.append(1)
+            return datetime.date(2010, 6, 1)
+
+        fields = [SplitDateFormField(till_date=till_date) for i in xrange(10)]
+
+        # Evaluated when rendering or validating, at most once a day
+        self.assertEqual(calls, [])
+
+        html = fields[0].widget.render('date', None)
+        self.assertTrue('2010' in html)
+        self.assertFalse('2011' in html)
+
+        self.assertEqual(
+            fields[1].clean(['1', '6', '2010']), datetime.date(2010, 6, 1))
+        self.assertRaises(
+            forms.ValidationError, fields[2].clean, ['2', '6', '2010'])
+        self.assertRaises(
+            forms.ValidationError, fields[3].clean, ['1', '6', '2011'])
+
+        self.assertEqual(calls, [1])
+
+    def test_construction_cost(self):
+        import gc
+        from vspace_utils.fields import SplitDateFormField
+
+        count = 1000
+
+        # Warm up the caches
+        SplitDateFormField().widget.render('date', None)
+        cached = len(SplitDateFormField._widget_cache)
+
+        gc.collect()
+        objects = len(gc.get_objects())
+        start = time.time()
+
+        fields = [SplitDateFormField() for i in xrange(count)]
+
+        duration = time.time() - start
+        gc.collect()
+        objects = len(gc.get_objects()) - objects
+
+        logger.info(
+            'SplitDateFormField: %.1f us and %.1f objects per field',
+            duration / count * 1e6, float(objects) / count
+        )
+
+        # No year choices or widget classes per field
+        self.assertEqual(len(fields), count)
+        self.assertEqual(len(SplitDateFormField._widget_cache), cached)
+
+
+class _CountingEmailBackend(LocmemBackend):
+    """ Locmem backend recording the size of every `send_messages()` call. """
+
+    calls = []
+
+    def send_messages(self, messages):
+        self.calls.append(len(messages))
+        return super(_CountingEmailBackend, self).send_messages(messages)
+
+
+class RequestScopeTestMixin(object):
+    """ Send request signals, like the test client does. """
+
+    def setUp(self):
+        del _CountingEmailBackend.calls[:]
+
+        # Like the test client, keep the test database connection open
+        request_finished.disconnect(close_old_connections)
+
+    def tearDown(self):
+        request_finished.connect(close_old_connections)
+
+    def start_request(self):
+        request_started.send(sender=self.__class__)
+
+    def finish_request(self, exception=False):
+        if exception:
+            got_request_exception.send(sender=self.__class__, request=None)
+
+        request_finished.send(sender=self.__class__)
+
+
+def _message(subject='Subject'):
+    return EmailMessage(subject, 'Body', 'from@example.com', ['to@example.com'])
+
+
+@override_settings(
+    EMAIL_BACKEND='vspace_utils.tests._CountingEmailBackend',
+    EMAIL_BATCH_SIZE=2)
+class MailBatchTests(RequestScopeTestMixin, TestCase):
+    def test_unbatched(self):
+        from vspace_utils.mail import queue_message
+
+        queue_message(_message())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_batched_messages(self):
+        from vspace_utils.mail import batched_messages, queue_message
+
+        with batched_messages():
+            for i in xrange(3):
+                queue_message(_message())
+
+            with batched_messages():
+                queue_message(_message())
+
+            # Nested batches are sent with the outermost batch
+            self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(_CountingEmailBackend.calls, [2, 2])
+
+    def test_batched_messages_exception(self):
+        from vspace_utils.mail import batched_messages, queue_message
+
+        try:
+            with batched_messages():
+                queue_message(_message())
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(mail.outbox, [])
+
+    def test_request(self):
+        from vspace_utils.mail import queue_message
+
+        self.start_request()
+        queue_message(_message())
+        queue_message(_message())
+        self.assertEqual(mail.outbox, [])
+        self.finish_request()
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(_CountingEmailBackend.calls, [2])
+
+    def test_request_exception(self):
+        from vspace_utils.mail import queue_message
+
+        self.start_request()
+        queue_message(_message())
+        self.finish_request(exception=True)
+
+        self.assertEqual(mail.outbox, [])
+
+        # Nothing is left queued for the next request
+        self.start_request()
+        self.finish_request()
+        self.assertEqual(mail.outbox, [])
+
+
+_queued_calls = []
+
+
+class _QueuedListener(Listener):
+    def dispatch(self, sender, **kwargs):
+        if kwargs.get('fail'):
+            raise ValueError('Failing')
+
+        _queued_calls.append((sender, kwargs))
+
+
+class ThreadPoolExecutorTests(TestCase):
+    def test_close_connection(self):
+        from vspace_utils import executors
+        from vspace_utils.listeners import Listener
+
+        calls = []
+
+        class RecordingListener(Listener):
+            def dispatch(self, sender, **kwargs):
+                calls.append(('dispatch', sender))
+
+        original = executors.close_old_connections
+        executors.close_old_connections = \
+            lambda: calls.append(('close', None))
+
+        try:
+            executor = executors.ThreadPoolExecutor(max_workers=1)
+            executor.submit(RecordingListener, {}, 'sender', {})
+            executor.shutdown()
+        finally:
+            executors.close_old_connections = original
+
+        # Closed after the call, and when the worker stops
+        self.assertEqual(calls[:2], [('dispatch', 'sender'), ('close', None)])
+
+    def test_shutdown_full_queue(self):
+        from vspace_utils.executors import ThreadPoolExecutor
+        from vspace_utils.listeners import Listener
+
+        release = threading.Event()
+
+        class BlockingListener(Listener):
+            def dispatch(self, sender, **kwargs):
+                release.wait(10)
+
+        executor = ThreadPoolExecutor(
+            max_workers=1, max_queue=1, drain_timeout=0.2)
+
+        try:
+            executor.submit(BlockingListener, {}, 'sender', {})
+            while executor._queue.qsize():
+                time.sleep(0.01)
+            executor.submit(BlockingListener, {}, 'sender', {})
+
+            # Shutting down doesn't block on the full queue
+            start = time.time()
+            executor.shutdown()
+            self.assertTrue(time.time() - start < 2)
+
+        finally:
+            release.set()
+
+
+class DatabaseExecutorTests(TestCase):
+    def setUp(self):
+        del _queued_calls[:]
+
+    def test_process_queue(self):
+        from django.contrib.sites.models import Site
+        from django.core.management import call_command
+        from vspace_utils.executors import DatabaseExecutor
+        from vspace_utils.models import QueuedListenerCall
+
+        executor = DatabaseExecutor()
+        executor.submit(_QueuedListener, {}, Site, {'value': 1})
+        executor.submit(_QueuedListener, {}, 'sender', {'fail': True})
+
+        self.assertEqual(_queued_calls, [])
+        self.assertEqual(QueuedListenerCall.objects.count(), 2)
+
+        call_command('process_listener_queue', once=True)
+
+        self.assertEqual(_queued_calls, [(Site, {'value': 1})])
+
+        failed = QueuedListenerCall.objects.get()
+        self.assertEqual(failed.attempts, 1)
+        self.assertTrue('Failing' in failed.last_error)
+
+    def test_claim(self):
+        from django.core.management import call_command
+        from vspace_utils.executors import DatabaseExecutor
+        from vspace_utils.management.commands.process_listener_queue import \
+            Command
+        from vspace_utils.models import QueuedListenerCall
+
+        DatabaseExecutor().submit(_QueuedListener, {}, 'sender', {})
+        call = QueuedListenerCall.objects.get()
+
+        # Claiming counts as an attempt, ie. when the worker crashes
+        self.assertTrue(Command().claim(call.pk, lease=0))
+        self.assertEqual(QueuedListenerCall.objects.get().attempts, 1)
+
+        QueuedListenerCall.objects.update(attempts=5)
+        call_command('process_listener_queue', once=True, max_attempts=5)
+
+        self.assertEqual(_queued_calls, [])
+        self.assertEqual(QueuedListenerCall.objects.count(), 1)
+
+
+class TemplateCacheTests(TestCase):
+    def setUp(self):
+        from vspace_utils import listeners, stats
+        from vspace_utils.listeners import EmailingListener
+
+        self.template_dir = tempfile.mkdtemp()
+        for name, content in (
+                ('subject.txt', 'Hello {{ name }}'),
+                ('body.txt', '{% for i in items %}{{ i }} {% endfor %}')):
+            f = open('%s/%s' % (self.template_dir, name), 'w')
+            f.write(content)
+            f.close()
+
+        EmailingListener._template_cache.clear()
+        stats.reset()
+
+        # Count template compilations
+        self.loads = []
+        self.select_template = listeners.select_template
+
+        def select_template(template_names):
+            self.loads.append(template_names)
+            return self.select_template(template_names)
+
+        listeners.select_template = select_template
+
+        class TemplateListener(EmailingListener):
+            subject_template_name = 'subject.txt'
+            body_template_name = 'body.txt'
+
+            def get_recipients(self):
+                return ['to@example.com']
+
+        self.listener_class = TemplateListener
+
+    def tearDown(self):
+        from vspace_utils import listeners
+
+        listeners.select_template = self.select_template
+        self.listener_class._template_cache.clear()
+        shutil.rmtree(self.template_dir)
+
+    def create_messages(self, count):
+        listener = self.listener_class()
+
+        return [
+            listener.create_message({'name': i, 'items': range(10)})
+            for i in xrange(count)
+        ]
+
+    def test_compiled_once(self):
+        from vspace_utils import stats
+
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, ), DEBUG=False):
+            messages = self.create_messages(100)
+
+        self.assertEqual(messages[7].subject, 'Hello 7')
+        self.assertEqual(len(self.loads), 2)
+
+        # Per-message render time
+        render = stats.snapshot()[self.listener_class.get_stats_name()]['render']
+        self.assertEqual(render['calls'], 100)
+        logger.info('%.3f ms per message', render['mean'] * 1000)
+
+    def test_debug_reloads(self):
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, ), DEBUG=True):
+            self.create_messages(3)
+
+        # Templates may be edited, without the cached loader
+        self.assertEqual(len(self.loads), 6)
+
+    def test_language(self):
+        from django.utils import translation
+
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, ), DEBUG=False):
+            for language in ('en', 'de', 'en'):
+                translation.activate(language)
+                try:
+                    self.create_messages(2)
+                finally:
+                    translation.deactivate()
+
+        # Shared between languages
+        self.assertEqual(len(self.loads), 2)
+
+    def test_benchmark(self):
+        timings = []
+        for debug in (True, False):
+            # DEBUG without the cached loader compiles for every message
+            with self.settings(TEMPLATE_DIRS=(self.template_dir, ),
+                    DEBUG=debug):
+                start = time.time()
+                self.create_messages(200)
+                timings.append((time.time() - start) / 200 * 1000)
+
+        self.assertEqual(len(self.loads), 402)
+
+        logger.info(
+            'Rendering: %.3f ms per message uncached, %.3f ms cached',
+            *timings
+        )
+
+
+class _ConnectionCountingEmailBackend(_CountingEmailBackend):
+    """ Counting backend also recording every connection opened. """
+
+    connections = []
+
+    def open(self):
+        self.connections.append(self)
+        return super(_ConnectionCountingEmailBackend, self).open()
+
+
+@override_settings(
+    EMAIL_BACKEND='vspace_utils.tests._ConnectionCountingEmailBackend',
+    EMAIL_BATCH_SIZE=2)
+class FanOutTests(TestCase):
+    def setUp(self):
+        from django.utils import translation
+        from vspace_utils.listeners import TranslatedEmailingListener
+
+        del _CountingEmailBackend.calls[:]
+        del _ConnectionCountingEmailBackend.connections[:]
+
+        translation.activate('en')
+
+        renders = self.renders = []
+
+        class FanOutListener(TranslatedEmailingListener):
+            fail = False
+
+            def get_recipient_language(self, recipient):
+                return recipient.rsplit('.', 1)[1]
+
+            def render_subject(self, context):
+                language = translation.get_language()
+                renders.append(language)
+
+                if self.fail:
+                    raise ValueError('Rendering failed')
+
+                return 'Subject %s' % language
+
+            def render_body(self, context):
+                return 'Body %s' % translation.get_language()
+
+        self.listener_class = FanOutListener
+
+    def tearDown(self):
+        from django.utils import translation
+
+        translation.deactivate()
+
+    def test_render_once_per_language(self):
+        recipients = [
+            'a@example.nl', 'b@example.de', 'c@example.nl', 'd@example.de',
+            'e@example.nl',
+        ]
+
+        sent = self.listener_class().fan_out(None, recipients)
+
+        self.assertEqual(sent, 5)
+        self.assertEqual(self.renders, ['nl', 'de'])
+
+        # Grouped per language, in order of first occurrence
+        self.assertEqual([(m.subject, m.body, m.to) for m in mail.outbox], [
+            ('Subject nl', 'Body nl', ['a@example.nl']),
+            ('Subject nl', 'Body nl', ['c@example.nl']),
+            ('Subject nl', 'Body nl', ['e@example.nl']),
+            ('Subject de', 'Body de', ['b@example.de']),
+            ('Subject de', 'Body de', ['d@example.de']),
+        ])
+
+    def test_single_connection(self):
+        recipients = ['%d@example.%s' % (i, ('nl', 'de')[i % 2])
+            for i in xrange(5)]
+
+        self.listener_class().fan_out(None, recipients)
+
+        # All languages share one connection, in batches of EMAIL_BATCH_SIZE
+        self.assertEqual(len(_ConnectionCountingEmailBackend.connections), 1)
+        self.assertEqual(_CountingEmailBackend.calls, [2, 2, 1])
+
+    def test_bcc(self):
+        listener = self.listener_class()
+        listener.delivery = 'bcc'
+        listener.bcc_chunk_size = 2
+
+        recipients = ['a@example.nl', 'b@example.nl', 'c@example.nl']
+        self.assertEqual(listener.fan_out(None, recipients), 2)
+
+        self.assertEqual([m.bcc for m in mail.outbox],
+            [['a@example.nl', 'b@example.nl'], ['c@example.nl']])
+        self.assertEqual(self.renders, ['nl'])
+
+    def test_language_restored(self):
+        from django.utils import translation
+
+        listener = self.listener_class()
+        listener.fail = True
+
+        self.assertRaises(ValueError,
+            listener.fan_out, None, ['a@example.nl', 'b@example.de'])
+
+        self.assertEqual(self.renders, ['nl'])
+        self.assertEqual(translation.get_language(), 'en')
+        self.assertEqual(len(mail.outbox), 0)
+
+        # And after successful rendering
+        listener.fail = False
+        listener.fan_out(None, ['a@example.nl', 'b@example.de'])
+
+        self.assertEqual(translation.get_language(), 'en')
+
+
+class _RecordingCache(object):
+    """ Cache stand-in recording the timeouts passed. """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.timeouts = []
+
+    def add(self, key, value, timeout):
+        self.timeouts.append(timeout)
+        return self.cache.add(key, value, timeout)
+
+    def set(self, key, value, timeout):
+        self.timeouts.append(timeout)
+        return self.cache.set(key, value, timeout)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+
+class ListenerStatsTests(TestCase):
+    def setUp(self):
+        from vspace_utils import stats
+
+        stats.reset()
+        stats.reset_shared()
+
+    def tearDown(self):
+        from vspace_utils import stats
+
+        stats.reset()
+        stats.reset_shared()
+
+    def test_flush(self):
+        from vspace_utils import stats
+
+        stats.record('listener', 'dispatch', 0.002)
+        stats.record('listener', 'dispatch', 2.0, error=True)
+        stats.incr('listener', 'messages', 3)
+
+        # Not flushed while recording
+        self.assertEqual(stats.shared_snapshot(), {})
+
+        stats.flush()
+        stats.record('listener', 'render', 0.02)
+        stats.incr('listener', 'messages', 2)
+        stats.flush()
+
+        # Flushing again doesn't add anything
+        stats.flush()
+
+        shared = stats.shared_snapshot()['listener']
+        self.assertEqual(sorted(shared), ['dispatch', 'render'])
+        self.assertEqual(shared['dispatch']['calls'], 2)
+        self.assertEqual(shared['dispatch']['errors'], 1)
+        self.assertAlmostEqual(shared['dispatch']['total'], 2.002, 3)
+
+        self.assertEqual(stats.shared_counters(), {'listener': {'messages': 5}})
+
+        stats.reset_shared()
+        self.assertEqual(stats.shared_snapshot(), {})
+        self.assertEqual(stats.shared_counters(), {})
+
+    def test_index(self):
+        from vspace_utils import stats
+
+        cache = stats.get_shared_cache()
+
+        # Entries are added once, whatever order processes flush in
+        for entry in (('a', 'dispatch'), ('b', 'send'), ('a', 'dispatch')):
+            stats._add_to_index(cache, stats.METRICS_INDEX, entry)
+
+        self.assertEqual(
+            stats._get_index(cache, stats.METRICS_INDEX),
+            [('a', 'dispatch'), ('b', 'send')]
+        )
+
+    def test_timeout(self):
+        from vspace_utils import stats
+
+        cache = _RecordingCache(stats.get_shared_cache())
+        stats._add_to_index(cache, stats.COUNTERS_INDEX, ('a', 'messages'))
+        stats._incr(cache, 'vspace_utils.listener_stats.test', 1)
+
+        # None is the default timeout of the backend on Django < 1.6
+        self.assertTrue(cache.timeouts)
+        self.assertEqual(set(cache.timeouts), set([stats.CACHE_TIMEOUT]))
+
+    def test_flusher_started(self):
+        import os
+        from vspace_utils import stats
+
+        stats.record('listener', 'dispatch', 0.001)
+
+        self.assertEqual(stats._flusher_pid[0], os.getpid())
+        self.assertTrue(any(
+            thread.name == 'listener-stats-flusher' and thread.daemon
+            for thread in threading.enumerate()
+        ))
+
+    def test_query_counter(self):
+        from django.contrib.sites.models import Site
+        from django.db import connection
+        from vspace_utils.stats import QueryCounter
+
+        start = len(connection.queries)
+
+        for i in xrange(3):
+            with QueryCounter(force=True) as queries:
+                list(Site.objects.all())
+                Site.objects.count()
+
+            self.assertEqual(queries.count, 2)
+
+        # The log doesn't grow outside of requests
+        self.assertEqual(len(connection.queries), start)
+
+
+class _Instance(object):
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class _CoalescedEmailingListener(EmailingListener):
+    coalesce = True
+    batch_send = True
+
+    def dispatch(self, sender, **kwargs):
+        self.handler(sender, **kwargs)
+
+    def create_message(self, context):
+        return _message('Instance %s' % self.kwargs['instance'].pk)
+
+
+@override_settings(EMAIL_BACKEND='vspace_utils.tests._CountingEmailBackend')
+class CoalescingTests(RequestScopeTestMixin, TestCase):
+    def setUp(self):
+        super(CoalescingTests, self).setUp()
+
+        self.signal = Signal(providing_args=['instance'])
+        self.listener = _CoalescedEmailingListener.as_listener()
+        self.signal.connect(self.listener, weak=False)
+
+    def send(self, *pks):
+        for pk in pks:
+            self.signal.send(sender=_Instance, instance=_Instance(pk))
+
+    def test_coalesced_signals(self):
+        from vspace_utils.coalescing import coalesced_signals
+        from vspace_utils.mail import batched_messages
+
+        with batched_messages():
+            with coalesced_signals():
+                self.send(1, 2, 1, 3, 2)
+                self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ['Instance 1', 'Instance 2', 'Instance 3']
+        )
+        self.assertEqual(_CountingEmailBackend.calls, [3])
+
+    def test_unsaved(self):
+        from vspace_utils.coalescing import coalesced_signals
+
+        instance = _Instance(None)
+
+        with coalesced_signals():
+            self.signal.send(sender=_Instance, instance=instance)
+            self.signal.send(sender=_Instance, instance=instance)
+            self.signal.send(sender=_Instance, instance=_Instance(None))
+
+        # Different unsaved instances aren't collapsed
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_request(self):
+        # Coalesced calls run before the message batch of the request ends
+        self.start_request()
+        self.send(1, 2, 1, 3, 2)
+        self.finish_request()
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(_CountingEmailBackend.calls, [3])
+
+    def test_request_exception(self):
+        self.start_request()
+        self.send(1, 2)
+        self.finish_request(exception=True)
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(_CountingEmailBackend.calls, [])
+
+    def test_close_connection(self):
+        from vspace_utils.scopes import _closes_connections
+
+        # Connections opened by the work done at the end of requests are
+        # only closed when Django closes connections, unlike in tests
+        self.assertFalse(_closes_connections())
+
+        request_finished.connect(close_old_connections)
+        self.assertTrue(_closes_connections())
+
+        self.start_request()
+        self.send(1, 2)
+        self.finish_request()
+
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class _FailingEmailBackend(LocmemBackend):
+    """
+    Locmem backend failing for messages with the subject 'fail' and
+    silently not sending those with the subject 'drop'.
+    """
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.subject == 'fail':
+                raise IOError('Connection refused')
+
+            if message.subject == 'drop':
+                return 0
+
+        return super(_FailingEmailBackend, self).send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='vspace_utils.tests._FailingEmailBackend')
+class OutboxTests(TestCase):
+    def store(self, *subjects):
+        from vspace_utils.mail import store_message
+
+        return [store_message(_message(subject)) for subject in subjects]
+
+    def test_send_outbox(self):
+        from django.core.management import call_command
+        from vspace_utils.models import OutboxMessage
+
+        self.store('one', 'two', 'three')
+
+        # Nothing is sent when storing
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+
+        call_command('send_outbox', batch_size=2, once=True)
+
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ['one', 'two', 'three']
+        )
+        self.assertEqual(mail.outbox[0].to, ['to@example.com'])
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+    def test_retry(self):
+        import datetime
+        from django.utils import timezone
+        from vspace_utils.mail import send_outbox
+        from vspace_utils.models import OutboxMessage
+
+        failing, = self.store('fail')
+        self.store('ok')
+
+        self.assertEqual(send_outbox(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+        failing = OutboxMessage.objects.get(pk=failing.pk)
+        self.assertEqual(failing.attempts, 1)
+        self.assertTrue('Connection refused' in failing.last_error)
+        self.assertEqual(failing.lock_id, '')
+
+        # Backing off
+        self.assertTrue(failing.locked_until > timezone.now())
+        self.assertEqual(send_outbox(), 0)
+
+        # Retried when the backoff has passed, until max_attempts
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        OutboxMessage.objects.update(locked_until=past)
+        self.assertEqual(send_outbox(max_attempts=3), 1)
+
+        # Given up on, and removed, after max_attempts
+        OutboxMessage.objects.update(locked_until=past)
+        self.assertEqual(send_outbox(max_attempts=3), 1)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_not_sent(self):
+        from vspace_utils.mail import send_outbox
+        from vspace_utils.models import OutboxMessage
+
+        self.store('drop')
+
+        # Not reported as sent by the backend
+        self.assertEqual(send_outbox(), 1)
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(OutboxMessage.objects.get().attempts, 1)
+
+    def test_claim(self):
+        from vspace_utils.mail import claim_outbox_messages
+
+        self.store('one', 'two', 'three')
+
+        first = claim_outbox_messages(batch_size=2)
+        second = claim_outbox_messages(batch_size=2)
+
+        # Claimed messages are locked for other workers
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(
+            set(m.pk for m in first) & set(m.pk for m in second))
+        self.assertEqual(claim_outbox_messages(), [])
+
+    def test_listener(self):
+        from vspace_utils.listeners import EmailingListener
+        from vspace_utils.models import OutboxMessage
+
+        class OutboxListener(EmailingListener):
+            outbox = True
+
+            def dispatch(self, sender, **kwargs):
+                self.handler(sender, **kwargs)
+
+            def create_message(self, context):
+                return _message('stored')
+
+        OutboxListener.as_listener()(sender=None)
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(
+            OutboxMessage.objects.get().get_message().subject, 'stored')
+
+
+class LazyContextTests(TestCase):
+    def setUp(self):
+        from django.contrib.sites.models import SITE_CACHE
+
+        self.template_dir = tempfile.mkdtemp()
+        for name, content in (
+                ('subject.txt', 'Hello {{ name }}'),
+                ('body.txt', 'Hi {{ name }}'),
+                ('site_body.txt', 'Welcome to {{ site.domain }}')):
+            f = open('%s/%s' % (self.template_dir, name), 'w')
+            f.write(content)
+            f.close()
+
+        # Force the current site to be queried when used
+        SITE_CACHE.clear()
+
+        class ContextListener(EmailingListener):
+            subject_template_name = 'subject.txt'
+            body_template_name = 'body.txt'
+
+            def get_recipients(self):
+                return ['to@example.com']
+
+        self.listener_class = ContextListener
+
+    def tearDown(self):
+        self.listener_class._template_cache.clear()
+        shutil.rmtree(self.template_dir)
+
+    def test_lazy(self):
+        from vspace_utils.listeners import LazyContext
+
+        calls = []
+
+        def count():
+            calls.append(None)
+            return 3
+
+        context = LazyContext(name='test')
+        context.lazy('count', count)
+
+        self.assertEqual(calls, [])
+        self.assertEqual(context['count'], 3)
+        self.assertEqual(context.get('count'), 3)
+        self.assertEqual(context.get('missing', 1), 1)
+
+        # Evaluated only once
+        self.assertEqual(calls, [None])
+
+    def test_unused_not_evaluated(self):
+        from vspace_utils.listeners import LazyValue
+
+        listener = self.listener_class()
+
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, )):
+            with self.assertNumQueries(0):
+                listener.handler(None, name='Jan')
+
+        self.assertEqual(mail.outbox[0].body, 'Hi Jan')
+
+        # The site is part of the context, but was never evaluated
+        context = listener.get_context_data()
+        self.assertTrue(
+            isinstance(dict.__getitem__(context, 'site'), LazyValue))
+
+    def test_used_evaluated(self):
+        listener = self.listener_class()
+        listener.body_template_name = 'site_body.txt'
+
+        with self.settings(TEMPLATE_DIRS=(self.template_dir, )):
+            with self.assertNumQueries(1):
+                listener.handler(None, name='Jan')
+
+        self.assertEqual(mail.outbox[0].body, 'Welcome to example.com')
+
+
+class ListenerRegistryTests(TestCase):
+    def setUp(self):
+        from vspace_utils.listeners import Listener, ListenerRegistry
+
+        self.registry = ListenerRegistry()
+        self.signal = Signal()
+        self.calls = []
+
+        calls = self.calls
+
+        class RecordingListener(Listener):
+            def dispatch(self, sender, **kwargs):
+                calls.append(sender)
+
+        self.listener_class = RecordingListener
+
+    def test_senders(self):
+        from django.contrib.sites.models import Site
+
+        self.registry.register(
+            self.signal, self.listener_class, senders=('sites.Site', ))
+        self.registry.register(self.signal, self.listener_class)
+
+        self.signal.send(sender=Site)
+        self.signal.send(sender=object)
+
+        self.assertEqual(self.calls, [Site, Site, object])
+
+    def test_unknown_model(self):
+        from django.contrib.sites.models import Site
+
+        self.registry.register(
+            self.signal, self.listener_class,
+            senders=('vspace_utils.Nope', 'invalid', 'sites.Site')
+        )
+
+        # Unknown models are skipped, and don't break dispatching
+        self.signal.send(sender=Site)
+        self.signal.send(sender=object)
+
+        self.assertEqual(self.calls, [Site])
+
+
+class SlugItem(AutoUniqueSlugMixin, models.Model):
+    """ Test model, created for the tests of this app only. """
+
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(unique=True, blank=True)
+
+    class Meta:
+        app_label = 'vspace_utils'
+
+
+class ScopedSlugItem(AutoUniqueSlugMixin, models.Model):
+    """ Test model with slugs unique per group. """
+
+    group = models.IntegerField()
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(blank=True)
+
+    class Meta:
+        app_label = 'vspace_utils'
+
+    def get_slug_queryset(self):
+        return ScopedSlugItem.objects.filter(group=self.group)
+
+
+class UniqueSlugTests(TestCase):
+    def setUp(self):
+        for slug in ('a', 'a-1', 'a-b', 'ab', 'abc', 'apple'):
+            SlugItem.objects.create(name=slug, slug=slug)
+
+    def test_generate_slug(self):
+        item = SlugItem(name='A')
+
+        # Collisions are resolved with a single query
+        with self.assertNumQueries(1):
+            self.assertEqual(item.generate_slug(), 'a-2')
+
+        item.save()
+        self.assertEqual(item.slug, 'a-2')
+
+    def test_taken_slugs(self):
+        item = SlugItem(name='a')
+
+        # Unrelated slugs sharing the prefix aren't fetched
+        self.assertEqual(item.get_taken_slugs('a'), set(['a', 'a-1', 'a-b']))
+        self.assertEqual(item.get_taken_slugs('b'), set())
+
+    def test_assign_slugs(self):
+        items = (SlugItem(name=name) for name in ('a', 'b', 'a', 'ab'))
+
+        # Generators are returned as a list
+        with self.assertNumQueries(1):
+            items = SlugItem.assign_slugs(items)
+
+        self.assertEqual(
+            [item.slug for item in items], ['a-2', 'b', 'a-3', 'ab-1'])
+
+    def test_retry(self):
+        item = SlugItem(name='a')
+
+        generate_slug = item.generate_slug
+        generated = []
+
+        def stale_slug():
+            # The first slug is taken by a concurrent save in the meantime
+            generated.append(generate_slug() if generated else 'a')
+            return generated[-1]
+
+        item.generate_slug = stale_slug
+        item.save()
+
+        self.assertEqual(generated, ['a', 'a-2'])
+        self.assertEqual(SlugItem.objects.get(pk=item.pk).slug, 'a-2')
+
+    def test_retry_other_error(self):
+        from django.db import IntegrityError
+
+        existing = SlugItem.objects.get(slug='a')
+
+        item = SlugItem(pk=existing.pk, name='b')
+
+        generate_slug = item.generate_slug
+        generated = []
+
+        def counting_slug():
+            generated.append(generate_slug())
+            return generated[-1]
+
+        item.generate_slug = counting_slug
+
+        # Errors which aren't caused by the slug aren't retried
+        self.assertRaises(IntegrityError, item.save, force_insert=True)
+        self.assertEqual(generated, ['b'])
+
+    def test_assign_slugs_scope(self):
+        ScopedSlugItem.objects.create(group=1, name='a')
+        ScopedSlugItem.objects.create(group=2, name='a')
+        ScopedSlugItem.objects.create(group=2, name='a')
+
+        items = [
+            ScopedSlugItem(group=group, name='a') for group in (1, 2, 3, 1)
+        ]
+
+        # A query per scope
+        with self.assertNumQueries(3):
+            ScopedSlugItem.assign_slugs(items)
+
+        self.assertEqual(
+            [item.slug for item in items], ['a-1', 'a-2', 'a', 'a-2'])
+
+        # The same as when saving
+        item = ScopedSlugItem(group=2, name='a')
+        item.save()
+        self.assertEqual(item.slug, 'a-2')
+
+
+class PlainSlugItem(AutoSlugMixin, models.Model):
+    """ Test model with a non-unique slug. """
+
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(blank=True)
+
+    class Meta:
+        app_label = 'vspace_utils'
+
+
+class UpdateSlugTests(TestCase):
+    def setUp(self):
+        self.saved = []
+        post_save.connect(self.count_save, sender=PlainSlugItem)
+
+    def tearDown(self):
+        post_save.disconnect(self.count_save, sender=PlainSlugItem)
+
+    def count_save(self, sender, instance, **kwargs):
+        self.saved.append(instance.pk)
+
+    def test_update_slug(self):
+        item = PlainSlugItem.objects.create(name='a', slug='x')
+        PlainSlugItem.objects.filter(pk=item.pk).update(slug='')
+
+        item.slug = ''
+        item.name = 'B'
+
+        # Only the slug column is written, without sending signals
+        with self.assertNumQueries(1):
+            item.update_slug()
+
+        item = PlainSlugItem.objects.get(pk=item.pk)
+        self.assertEqual((item.name, item.slug), ('a', 'b'))
+        self.assertEqual(self.saved, [item.pk])
+
+    def test_slug_on_insert(self):
+        item = PlainSlugItem(name='A')
+        item._slug_on_insert = False
+        item.save()
+
+        self.assertEqual(PlainSlugItem.objects.get(pk=item.pk).slug, '')
+
+        with self.assertNumQueries(1):
+            item.update_slug()
+
+        self.assertEqual(PlainSlugItem.objects.get(pk=item.pk).slug, 'a')
+        self.assertEqual(self.saved, [item.pk])
+
+    def test_no_reentry(self):
+        # A common pattern: generating the slug once the object is saved
+        def receiver(sender, instance, **kwargs):
+            instance.update_slug()
+
+        post_save.connect(receiver, sender=PlainSlugItem)
+        try:
+            item = PlainSlugItem(name='A')
+            item._slug_on_insert = False
+            item.save()
+        finally:
+            post_save.disconnect(receiver, sender=PlainSlugItem)
+
+        self.assertEqual(PlainSlugItem.objects.get(pk=item.pk).slug, 'a')
+        self.assertEqual(self.saved, [item.pk])
+
+    def test_explicit_pk(self):
+        # Unsaved objects with a primary key are inserted, with a slug
+        item = PlainSlugItem(pk=10, name='A')
+        item.save()
+        self.assertEqual(PlainSlugItem.objects.get(pk=10).slug, 'a')
+
+        item = PlainSlugItem(pk=11, name='B')
+        item._slug_on_insert = False
+        item.update_slug()
+        self.assertEqual(PlainSlugItem.objects.get(pk=11).slug, 'b')
+
+        self.assertEqual(self.saved, [10, 11])
+
+
+class OrderedItem(models.Model):
+    """ Test model for orderings. """
+
+    group = models.IntegerField(default=1)
+    sort_order = models.IntegerField(null=True)
+
+    class Meta:
+        app_label = 'vspace_utils'
+
+
+class _FailingCache(object):
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            self.calls.append(name)
+            raise Exception('Cache is down')
+
+        return fail
+
+
+class _SharedCache(object):
+    """ Stand-in for a shared cache, ie. memcached, in the local cache. """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+
+class OrderingAllocatorTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+
+        for sort_order in (10, 20, 30):
+            OrderedItem.objects.create(sort_order=sort_order)
+
+    def get_allocator(self, model_or_qs, **kwargs):
+        from django.core.cache import cache
+        from vspace_utils.utils import OrderingAllocator
+
+        allocator = OrderingAllocator(model_or_qs, **kwargs)
+        allocator.cache = _SharedCache(cache)
+
+        return allocator
+
+    def test_query_savings(self):
+        from vspace_utils.utils import get_next_ordering
+
+        # A query per object
+        with self.assertNumQueries(10):
+            for i in xrange(10):
+                get_next_ordering(OrderedItem)
+
+        # Only when seeding the counter
+        allocator = self.get_allocator(OrderedItem)
+        with self.assertNumQueries(1):
+            values = [allocator.next_value() for i in xrange(10)]
+
+        self.assertEqual(values, range(40, 140, 10))
+
+    def test_allocate(self):
+        allocator = self.get_allocator(OrderedItem)
+
+        self.assertEqual(allocator.allocate(3), [40, 50, 60])
+        self.assertEqual(allocator.allocate(), [70])
+
+        # Reseeded from the database
+        OrderedItem.objects.create(sort_order=200)
+        allocator.reset()
+        self.assertEqual(allocator.next_value(), 210)
+
+    def test_scope(self):
+        OrderedItem.objects.create(group=2, sort_order=5)
+
+        allocator = self.get_allocator(
+            OrderedItem.objects.filter(group=2), scope=2)
+        self.assertEqual(allocator.next_value(), 15)
+        self.assertEqual(self.get_allocator(OrderedItem).next_value(), 40)
+
+    def test_non_atomic_backends(self):
+        from django.core.cache.backends.dummy import DummyCache
+        from vspace_utils import utils
+
+        warnings = []
+        warning = utils.logger.warning
+        utils.logger.warning = lambda *args: warnings.append(args)
+
+        try:
+            for cache in (None, DummyCache('', {})):
+                utils._warned_backends.clear()
+                del warnings[:]
+
+                for i in xrange(2):
+                    allocator = utils.OrderingAllocator(OrderedItem)
+                    if cache is not None:
+                        allocator.cache = cache
+
+                    # From the database, with a single query
+                    for j in xrange(3):
+                        with self.assertNumQueries(1):
+                            self.assertEqual(allocator.allocate(2), [40, 50])
+
+                # Warned once
+                self.assertEqual(len(warnings), 1)
+        finally:
+            utils.logger.warning = warning
+
+    def test_fallback(self):
+        cache = _FailingCache()
+
+        allocator = self.get_allocator(OrderedItem)
+        allocator.cache = cache
+
+        self.assertEqual(allocator.allocate(2), [40, 50])
+        self.assertEqual(cache.calls, ['incr'])
+
+        # The cache isn't tried again for a while
+        with self.assertNumQueries(1):
+            self.assertEqual(allocator.allocate(2), [40, 50])
+
+        self.assertEqual(cache.calls, ['incr'])
+
+        allocator._failed_at -= allocator.retry_after
+        allocator.allocate()
+        self.assertEqual(cache.calls, ['incr', 'incr'])
+
+
+class MoveOrderingTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+
+        self.items = [
+            OrderedItem.objects.create(sort_order=sort_order)
+            for sort_order in (10, 20, 30, 40)
+        ]
+
+    def get_orderings(self):
+        return list(OrderedItem.objects.order_by(
+            'sort_order', 'pk').values_list('pk', flat=True))
+
+    def test_move(self):
+        from vspace_utils.utils import move_ordering
+
+        a, b, c, d = [item.pk for item in self.items]
+
+        # A single row is updated when there is room
+        with self.assertNumQueries(2):
+            self.assertEqual(move_ordering(OrderedItem, d, after=a), 1)
+
+        self.assertEqual(self.get_orderings(), [a, d, b, c])
+
+        move_ordering(OrderedItem, a, before=c)
+        move_ordering(OrderedItem, c)
+        self.assertEqual(self.get_orderings(), [c, d, b, a])
+
+    def test_compact(self):
+        from vspace_utils.utils import move_ordering
+
+        a, b, c, d = [item.pk for item in self.items]
+        OrderedItem.objects.filter(pk=b).update(sort_order=11)
+
+        move_ordering(OrderedItem, d, after=a)
+
+        self.assertEqual(self.get_orderings(), [a, d, b, c])
+        self.assertEqual(
+            list(OrderedItem.objects.order_by('sort_order').values_list(
+                'sort_order', flat=True)),
+            [10, 20, 30, 40]
+        )
+
+    def test_move_to_end_with_allocator(self):
+        from django.core.cache import cache
+        from vspace_utils.utils import move_ordering, OrderingAllocator
+
+        allocator = OrderingAllocator(OrderedItem)
+        allocator.cache = _SharedCache(cache)
+        allocated = allocator.allocate(2)
+
+        move_ordering(OrderedItem, self.items[0].pk,
+                      after=self.items[-1].pk, allocator=allocator)
+
+        # No value handed out twice
+        value = OrderedItem.objects.get(pk=self.items[0].pk).sort_order
+        self.assertFalse(value in allocated)
+        self.assertFalse(allocator.next_value() in allocated + [value])
+
+    def test_not_in_queryset(self):
+        from vspace_utils.utils import move_ordering
+
+        other = OrderedItem.objects.create(group=2, sort_order=10)
+        qs = OrderedItem.objects.filter(group=1)
+
+        self.assertRaises(
+            ValueError, move_ordering, qs, self.items[0].pk, after=other.pk)
+        self.assertRaises(
+            ValueError, move_ordering, qs, other.pk, before=self.items[0].pk)
@@ -0,0 +1,209 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from cStringIO import StringIO
+
+from django.core.exceptions import ValidationError
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from vspace_utils.files import HEADER_SIZE, sniff_mimetype
+from vspace_utils.images import parse_image_dimensions
+from vspace_utils.validators import (
+    FileValidator, FileValidationPipeline, ImageDimensionsValidator
+)
+
+
+class ValidatingUploadHandler(FileUploadHandler):
+    """
+    Upload handler enforcing the rules of `FileValidator` and
+    `ImageDimensionsValidator` while the upload is being received, instead
+    of after it has been spooled to disk entirely.
+
+    As soon as a file exceeds the maximum size or its extension, sniffed
+    mimetype or image dimensions are not allowed, the upload is stopped
+    and the rest of the request body is not read. The errors are stored,
+    per field, in `request.upload_errors`.
+
+    Usage in a view::
+
+        @csrf_exempt
+        def upload_view(request):
+            request.upload_handlers.insert(0,
+                ValidatingUploadHandler.for_model(request, MyModel))
+
+            return _upload_view(request)
+
+        @csrf_protect
+        def _upload_view(request):
+            if request.upload_errors:
+                # Report errors
+                pass
+
+    Note that upload handlers can only be changed before `request.POST` or
+    `request.FILES` are accessed, hence the CSRF decorators.
+
+    The regular validators should still be used, as the handler only
+    checks the rules which can be checked during upload.
+    """
+
+    # Number of bytes to inspect for determining image dimensions, allowing
+    # for large metadata segments in JPEG's
+    dimensions_window = 128 * 1024
+
+    def __init__(self, request=None, validators=None):
+        """
+        `validators` is a dictionary mapping form field names to lists of
+        validators, only `FileValidator` and `ImageDimensionsValidator`
+        instances, possibly combined in a `FileValidationPipeline`, are used.
+        """
+        super(ValidatingUploadHandler, self).__init__(request)
+
+        self.validators = {}
+        for field_name, field_validators in (validators or {}).iteritems():
+            # Unpack validators combined in a pipeline
+            unpacked = []
+            for validator in field_validators:
+                if isinstance(validator, FileValidationPipeline):
+                    unpacked.extend(validator.validators)
+                else:
+                    unpacked.append(validator)
+
+            field_validators = [
+                validator for validator in unpacked
+                if isinstance(validator,
+                              (FileValidator, ImageDimensionsValidator))
+            ]
+
+            if field_validators:
+                self.validators[field_name] = field_validators
+
+        self.errors = {}
+
+        if request is not None:
+            request.upload_errors = self.errors
+
+    @classmethod
+    def for_model(cls, request, model, fields=None, prefix=None):
+        """
+        Create a handler using the validators of the file fields of `model`,
+        optionally limited to `fields`. Use `prefix` when the form has one.
+        """
+        validators = {}
+
+        for field in model._meta.fields:
+            if fields and field.name not in fields:
+                continue
+
+            if prefix:
+                field_name = '%s-%s' % (prefix, field.name)
+            else:
+                field_name = field.name
+
+            validators[field_name] = field.validators
+
+        return cls(request, validators)
+
+    def get_validators(self, validator_class):
+        return [
+            validator for validator in self.current_validators
+            if isinstance(validator, validator_class)
+        ]
+
+    def abort(self, error):
+        """ Record the error for the current field and stop the upload. """
+        logger.info(
+            'Stopping upload of %s for %s: %s',
+            self.file_name, self.field_name, error.messages[0]
+        )
+
+        self.errors.setdefault(self.field_name, []).extend(error.messages)
+
+        raise StopUpload(connection_reset=True)
+
+    def new_file(self, field_name, file_name, content_type, content_length,
+                 charset=None):
+        super(ValidatingUploadHandler, self).new_file(
+            field_name, file_name, content_type, content_length, charset)
+
+        self.current_validators = self.validators.get(field_name, [])
+        self.header = ''
+        self.mimetype_checked = False
+        self.dimensions_checked = False
+
+        try:
+            for validator in self.get_validators(FileValidator):
+                validator.check_extension(file_name)
+
+                if content_length is not None:
+                    validator.check_max_size(content_length)
+
+        except ValidationError, e:
+            self.abort(e)
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.current_validators:
+            return raw_data
+
+        if len(self.header) < self.dimensions_window and \
+                not (self.mimetype_checked and self.dimensions_checked):
+            self.header += raw_data[:self.dimensions_window - len(self.header)]
+
+        try:
+            for validator in self.get_validators(FileValidator):
+                validator.check_max_size(start + len(raw_data))
+
+            self.check_header()
+
+        except ValidationError, e:
+            self.abort(e)
+
+        return raw_data
+
+    def check_header(self):
+        """ Check the mimetype and dimensions as soon as the header allows. """
+        if not self.mimetype_checked and len(self.header) >= HEADER_SIZE:
+            self.check_mimetype()
+
+        dimension_validators = self.get_validators(ImageDimensionsValidator)
+
+        if not dimension_validators:
+            self.dimensions_checked = True
+
+        if not self.dimensions_checked:
+            dimensions = parse_image_dimensions(StringIO(self.header))
+
+            if dimensions:
+                self.dimensions_checked = True
+
+                for validator in dimension_validators:
+                    validator.check_dimensions(*dimensions)
+
+            elif len(self.header) >= self.dimensions_window:
+                # Leave it to the regular validators
+                self.dimensions_checked = True
+
+    def check_mimetype(self):
+        self.mimetype_checked = True
+
+        mimetype = sniff_mimetype(self.header[:HEADER_SIZE], self.file_name)
+
+        for validator in self.get_validators(FileValidator):
+            if not validator.allowed_mimetypes:
+                continue
+
+            if mimetype is None and validator.trust_client:
+                validator.check_mimetype(self.content_type)
+            else:
+                validator.check_mimetype(
+                    mimetype or 'application/octet-stream')
+
+    def file_complete(self, file_size):
+        # Files smaller than the header size haven't been sniffed yet
+        if self.current_validators and not self.mimetype_checked:
+            try:
+                self.check_mimetype()
+            except ValidationError, e:
+                self.abort(e)
+
+        # Leave creating the file to the other handlers
+        return None
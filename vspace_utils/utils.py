@@ -1,7 +1,11 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from django.db import models
+import hashlib
+import time
+
+from django.db import connections, models, router, transaction
+from django.utils.functional import cached_property
 
 
 def get_next_ordering(model_or_qs, field_name='sort_order', increment=10):
@@ -15,18 +19,10 @@ def get_next_ordering(model_or_qs, field_name='sort_order', increment=10):
                 default=lambda: get_next_ordering(MyModel)
             )
 
+    When many objects are created, consider using an `OrderingAllocator`
+    instead.
     """
-    if isinstance(model_or_qs, models.base.ModelBase):
-        # If a model has been given, create QuerySet for all objects
-        qs = model_or_qs.objects.all()
-    else:
-        # No model has been given, assert that the input is in fact
-        # a QuerySet.
-        assert isinstance(model_or_qs, models.query.QuerySet)
-        qs = model_or_qs
-
-    aggregate = qs.aggregate(latest=models.Max(field_name))
-    latest = aggregate['latest']
+    latest = get_latest_ordering(model_or_qs, field_name)
 
     if latest:
         return latest + increment
@@ -34,6 +30,187 @@ def get_next_ordering(model_or_qs, field_name='sort_order', increment=10):
         return increment
 
 
+def _get_queryset(model_or_qs):
+    if isinstance(model_or_qs, models.base.ModelBase):
+        # If a model has been given, create QuerySet for all objects
+        return model_or_qs.objects.all()
+
+    # No model has been given, assert that the input is in fact
+    # a QuerySet.
+    assert isinstance(model_or_qs, models.query.QuerySet)
+    return model_or_qs
+
+
+def get_latest_ordering(model_or_qs, field_name='sort_order'):
+    """ Return the highest value of `field_name`, or `None`. """
+    qs = _get_queryset(model_or_qs)
+
+    aggregate = qs.aggregate(latest=models.Max(field_name))
+    return aggregate['latest']
+
+
+# Cache backends which aren't shared between processes or don't increment
+# atomically, with which allocators would hand out duplicate values
+NON_ATOMIC_CACHE_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.filebased.FileBasedCache',
+    'django.core.cache.backends.db.DatabaseCache',
+)
+
+# Non-atomic backends which have been warned about
+_warned_backends = set()
+
+
+def _get_non_atomic_backend(cache):
+    """ Return the path of the non-atomic backend `cache` is, if any. """
+    for cls in type(cache).__mro__:
+        path = '%s.%s' % (cls.__module__, cls.__name__)
+
+        if path in NON_ATOMIC_CACHE_BACKENDS:
+            return path
+
+    return None
+
+
+class OrderingAllocator(object):
+    """
+    Hands out values for an ordering field, like `get_next_ordering`, from
+    a counter in the Django cache instead of querying the highest value
+    every time.
+
+    Use case::
+
+        class MyModel(models.Model):
+            sort_order = models.PositiveSmallIntegerField(
+                default=lambda: allocator.next_value()
+            )
+
+        allocator = OrderingAllocator(MyModel)
+
+        # Or, when creating many objects
+        for obj, sort_order in zip(objects, allocator.allocate(len(objects))):
+            obj.sort_order = sort_order
+
+    Orderings within a part of the objects, ie. per parent, are supported
+    by passing a QuerySet, in which case `scope` should identify it::
+
+        OrderingAllocator(parent.children.all(), scope=parent.pk)
+
+    The counter is seeded with the highest value in the database when it
+    is missing and reseeded when it expires after `timeout` seconds, to
+    pick up values set otherwise.
+
+    Only cache backends which are shared between processes and increment
+    atomically, ie. memcached, are used. With other backends, like the
+    local memory cache, a warning is logged once and values come from
+    `get_next_ordering`, as they do for `retry_after` seconds after the
+    cache failed.
+    """
+
+    retry_after = 60
+
+    def __init__(self, model_or_qs, field_name='sort_order', increment=10,
+                 scope=None, cache_alias=None, timeout=3600):
+        self.queryset = _get_queryset(model_or_qs)
+        self.field_name = field_name
+        self.increment = increment
+        self.timeout = timeout
+
+        if scope is None and isinstance(model_or_qs, models.query.QuerySet):
+            scope = hashlib.md5(str(self.queryset.query)).hexdigest()
+
+        opts = self.queryset.model._meta
+        self.cache_key = 'vspace_utils.ordering.%s.%s.%s.%s' % (
+            opts.app_label, opts.object_name, field_name, scope or '')
+
+        self.cache_alias = cache_alias
+
+        self._failed_at = None
+
+    @cached_property
+    def cache(self):
+        if self.cache_alias is None:
+            from django.core.cache import cache
+            return cache
+
+        try:
+            from django.core.cache import caches
+            return caches[self.cache_alias]
+        except ImportError:
+            # Django < 1.7
+            from django.core.cache import get_cache
+            return get_cache(self.cache_alias)
+
+    @cached_property
+    def use_cache(self):
+        """ Whether the cache backend is safe to allocate values from. """
+        backend = _get_non_atomic_backend(self.cache)
+
+        if backend is None:
+            return True
+
+        if backend not in _warned_backends:
+            _warned_backends.add(backend)
+
+            logger.warning(
+                'Cache backend %s is not shared between processes or not '
+                'atomic, allocating orderings from the database', backend
+            )
+
+        return False
+
+    def seed(self):
+        """ Seed the counter with the highest value in the database. """
+        latest = get_latest_ordering(self.queryset, self.field_name) or 0
+
+        # When another process seeded the counter first, keep its value
+        self.cache.add(self.cache_key, latest, self.timeout)
+
+    def reset(self):
+        """ Drop the counter, ie. after renumbering. """
+        self.cache.delete(self.cache_key)
+
+    def allocate(self, n=1):
+        """ Return a list of `n` increasing values. """
+        delta = n * self.increment
+
+        failed = self._failed_at is not None and \
+            time.time() < self._failed_at + self.retry_after
+
+        if self.use_cache and not failed:
+            try:
+                try:
+                    end = self.cache.incr(self.cache_key, delta)
+                except ValueError:
+                    # Missing or expired
+                    self.seed()
+                    end = self.cache.incr(self.cache_key, delta)
+
+            except Exception:
+                logger.exception(
+                    'Error allocating ordering, using database for %d seconds',
+                    self.retry_after
+                )
+
+                self._failed_at = time.time()
+
+            else:
+                self._failed_at = None
+
+                return range(
+                    end - delta + self.increment, end + 1, self.increment)
+
+        start = get_next_ordering(
+            self.queryset, self.field_name, self.increment)
+
+        return range(start, start + delta, self.increment)
+
+    def next_value(self):
+        """ Return a single value. """
+        return self.allocate()[0]
+
+
 def get_or_create_object(model, **kwargs):
     """
     Get or create feed entry with specified kwargs without saving.
@@ -56,3 +233,190 @@ def get_or_create_object(model, **kwargs):
         logger.debug('Creating new entry %s', db_entry)
 
     return db_entry
+
+
+def bulk_update_column(model, field_name, values, chunk_size=500, using=None):
+    """
+    Set `field_name` for many rows of `model` at once, with a single
+    `UPDATE ... SET field = CASE pk WHEN ... END` statement per chunk of
+    `chunk_size` rows. `values` maps primary keys to the new values.
+
+    Like `QuerySet.update()`, no signals are sent and `save()` is not
+    called. Returns the number of rows updated.
+    """
+    opts = model._meta
+    field = opts.get_field(field_name)
+
+    if using is None:
+        using = router.db_for_write(model)
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    items = list(values.items())
+    updated = 0
+
+    cursor = connection.cursor()
+
+    for start in xrange(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+
+        pks = []
+        params = []
+        for pk, value in chunk:
+            pk = opts.pk.get_db_prep_value(pk, connection)
+            pks.append(pk)
+
+            params.extend([pk, field.get_db_prep_save(value, connection)])
+        params.extend(pks)
+
+        sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            qn(opts.db_table), qn(field.column), qn(opts.pk.column),
+            ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+            qn(opts.pk.column), ', '.join(['%s'] * len(chunk))
+        )
+
+        cursor.execute(sql, params)
+        updated += cursor.rowcount
+
+    transaction.commit_unless_managed(using=using)
+
+    logger.debug('Updated %s of %d %s rows', field_name, updated, opts.db_table)
+
+    return updated
+
+
+def _get_orderings(qs, field_name):
+    """ Return the (pk, value) tuples of `qs`, in their current order. """
+    return list(qs.order_by(field_name, 'pk').values_list('pk', field_name))
+
+
+def apply_ordering(model_or_qs, pks, field_name='sort_order', increment=10,
+                   chunk_size=500, allocator=None):
+    """
+    Renumber the objects in `model_or_qs` in the order of `pks`, using
+    multiples of `increment` without gaps. Objects not in `pks` are placed
+    after them, in their current order.
+
+    Only rows of which the value changes are updated, using
+    `bulk_update_column()`, without calling `save()` or sending signals.
+    When given, the `OrderingAllocator` for the objects is reset. Returns
+    the number of rows updated.
+
+    Use case, ie. in a view handling drag and drop::
+
+        apply_ordering(parent.children.all(), request.POST.getlist('pk'))
+
+    """
+    qs = _get_queryset(model_or_qs)
+    to_python = qs.model._meta.pk.to_python
+
+    pks = [to_python(pk) for pk in pks]
+    orderings = _get_orderings(qs, field_name)
+
+    current = dict(orderings)
+    ordered = [pk for pk in pks if pk in current]
+
+    listed = set(ordered)
+    ordered.extend(pk for pk, value in orderings if pk not in listed)
+
+    values = {}
+    for index, pk in enumerate(ordered):
+        value = (index + 1) * increment
+
+        if current[pk] != value:
+            values[pk] = value
+
+    updated = 0
+    if values:
+        updated = bulk_update_column(
+            qs.model, field_name, values, chunk_size, using=qs.db)
+
+    if allocator is not None:
+        allocator.reset()
+
+    logger.debug('Renumbered %d of %d objects', updated, len(ordered))
+
+    return updated
+
+
+def move_ordering(model_or_qs, pk, after=None, before=None,
+                  field_name='sort_order', increment=10, chunk_size=500,
+                  allocator=None):
+    """
+    Move the object with primary key `pk` in `model_or_qs` between the
+    objects `after` and `before`, given by primary key; one of them
+    suffices. Without either, the object is moved to the start.
+
+    When the gap between the neighbours allows, only the moved object is
+    updated. Otherwise, all objects are renumbered by `apply_ordering()`.
+    When given, values at the end are taken from the `OrderingAllocator`
+    for the objects, which is reset when renumbering. Returns the number
+    of rows updated.
+
+    Raises `ValueError` when `pk`, `after` or `before` is not in
+    `model_or_qs`.
+    """
+    qs = _get_queryset(model_or_qs)
+    to_python = qs.model._meta.pk.to_python
+
+    pk = to_python(pk)
+    orderings = _get_orderings(qs, field_name)
+
+    if pk not in set(other_pk for other_pk, value in orderings):
+        raise ValueError('Object %s to move is not in the queryset' % pk)
+
+    orderings = [
+        (other_pk, value) for other_pk, value in orderings if other_pk != pk
+    ]
+    ordered = [other_pk for other_pk, value in orderings]
+
+    def index(neighbour):
+        try:
+            return ordered.index(to_python(neighbour))
+        except ValueError:
+            raise ValueError(
+                'Object %s to move next to is not in the queryset, or is '
+                'the object to move' % neighbour
+            )
+
+    # Position to insert at, among the other objects
+    if after is not None:
+        position = index(after) + 1
+    elif before is not None:
+        position = index(before)
+    else:
+        position = 0
+
+    if position:
+        lower = orderings[position - 1][1]
+    else:
+        lower = 0
+
+    value = None
+
+    if lower is not None:
+        if position == len(orderings):
+            if allocator is not None:
+                # Values up to the counter may have been handed out already
+                value = allocator.next_value()
+            else:
+                value = lower + increment
+        else:
+            upper = orderings[position][1]
+
+            if upper is not None and upper - lower >= 2:
+                value = (lower + upper) // 2
+
+    if value is not None:
+        updated = qs.filter(pk=pk).update(**{field_name: value})
+
+        logger.debug('Moved object %s to %d', pk, value)
+
+        return updated
+
+    # No room, compact
+    ordered.insert(position, pk)
+
+    return apply_ordering(
+        qs, ordered, field_name, increment, chunk_size, allocator)
@@ -2,12 +2,12 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-import platform
 import re
 import urllib
-import urllib2
 import urlparse
 
+from multiprocessing.pool import ThreadPool
+
 from os.path import splitext
 
 from django.core.exceptions import ValidationError
@@ -15,11 +15,14 @@ from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import filesizeformat
 
 from django.core.validators import RegexValidator, BaseValidator
-from django.core.urlresolvers import resolve
-from django.core.files.images import get_image_dimensions
+from django.core.urlresolvers import get_resolver, get_urlconf
 from django.http import Http404
 from django.utils.encoding import smart_unicode
 
+from vspace_utils.caching import LRUCache
+from vspace_utils.files import inspect_file
+from vspace_utils.linkcheck import LinkChecker, get_default_checker
+
 try:
     from django.conf import settings
     URL_VALIDATOR_USER_AGENT = settings.URL_VALIDATOR_USER_AGENT
@@ -31,7 +34,9 @@ except ImportError:
 class URLValidator(RegexValidator):
     """
     URLValidator with verify_exists still in there. Only to be used with
-    trusted users. This is the original Django code.
+    trusted users. This is the original Django code, with verification
+    delegated to a `LinkChecker` keeping connections alive and caching
+    results (see `vspace_utils.linkcheck`).
 
     See: https://www.djangoproject.com/weblog/2011/sep/09/security-releases-issued/
     """
@@ -44,12 +49,22 @@ class URLValidator(RegexValidator):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
     def __init__(self, verify_exists=False,
-                 validator_user_agent=URL_VALIDATOR_USER_AGENT):
+                 validator_user_agent=URL_VALIDATOR_USER_AGENT, checker=None):
         super(URLValidator, self).__init__()
         self.verify_exists = verify_exists
         self.user_agent = validator_user_agent
+        self.checker = checker
 
     def __call__(self, value):
+        url = self.prepare(value)
+
+        if url is not None:
+            self.verify(url)
+
+    def clean(self, value):
+        """
+        Check the syntax of the URL, returning the (IDN-encoded) URL.
+        """
         try:
             super(URLValidator, self).__call__(value)
         except ValidationError, e:
@@ -68,57 +83,136 @@ class URLValidator(RegexValidator):
         else:
             url = value
 
+        return url
+
+    def prepare(self, value):
+        """
+        Perform all validation which can be done in-process. Returns the URL
+        which still has to be verified remotely or `None` when done.
+        """
+        url = self.clean(value)
+
         #This is deprecated and will be removed in a future release.
         if self.verify_exists:
-            headers = {
-                "Accept": "text/xml,application/xml,application/xhtml+xml,text/html;q=0.9,text/plain;q=0.8,image/png,*/*;q=0.5",
-                "Accept-Language": "en-us,en;q=0.5",
-                "Accept-Charset": "ISO-8859-1,utf-8;q=0.7,*;q=0.7",
-                "Connection": "close",
-                "User-Agent": self.user_agent,
-            }
-            url = url.encode('utf-8')
-            # Quote characters from the unreserved set, refs #16812
-            url = urllib.quote(url, "!*'();:@&=+$,/?#[]")
-            broken_error = ValidationError(
-                _(u'This URL appears to be a broken link.'), code='invalid_link')
+            return url
+
+        return None
+
+    def validate_many(self, urls, max_workers=10, per_host=2):
+        """
+        Validate many URL's at once, ie. for imports. Returns a dictionary
+        mapping each of the given URL's to `None` when valid or the
+        `ValidationError` raised for it.
+
+        URL's are stripped and de-duplicated and syntax checks run
+        in-process, after which remote URL's are verified on a pool of at
+        most `max_workers` threads, sending no more than `per_host`
+        concurrent requests to a single host.
+
+        Without a `checker` on the validator, a new `LinkChecker` is used
+        instead of the process-wide one, which is closed when done.
+        """
+        results = {}
+        originals = {}
+
+        for original in urls:
+            value = smart_unicode(original).strip()
+            originals.setdefault(value, []).append(original)
+
+        # In-process validation, grouping remote URL's per host
+        hosts = {}
+        for value in originals.iterkeys():
             try:
-                req = urllib2.Request(url, None, headers)
-                req.get_method = lambda: 'HEAD'
-                #Create an opener that does not support local file access
-                opener = urllib2.OpenerDirector()
-
-                #Don't follow redirects, but don't treat them as errors either
-                error_nop = lambda *args, **kwargs: True
-                http_error_processor = urllib2.HTTPErrorProcessor()
-                http_error_processor.http_error_301 = error_nop
-                http_error_processor.http_error_302 = error_nop
-                http_error_processor.http_error_307 = error_nop
-
-                handlers = [urllib2.UnknownHandler(),
-                            urllib2.HTTPHandler(),
-                            urllib2.HTTPDefaultErrorHandler(),
-                            urllib2.FTPHandler(),
-                            http_error_processor]
+                url = self.prepare(value)
+            except ValidationError, e:
+                results[value] = e
+                continue
+
+            if url is None:
+                results[value] = None
+            else:
+                host = urlparse.urlsplit(url)[:2]
+                hosts.setdefault(host, []).append((value, url))
+
+        # Divide each host's URL's over at most `per_host` lanes, ordered
+        # such that the first lanes to run cover as many hosts as possible.
+        lanes = []
+        for lane in xrange(per_host):
+            for host_urls in hosts.itervalues():
+                if host_urls[lane::per_host]:
+                    lanes.append(host_urls[lane::per_host])
+
+        checker = self.checker or LinkChecker()
+
+        def verify_lane(lane):
+            lane_results = []
+            for value, url in lane:
                 try:
-                    import ssl
-                    handlers.append(urllib2.HTTPSHandler())
-                except:
-                    #Python isn't compiled with SSL support
-                    logger.debug(
-                        'Not validating SSL URL\'s, Python isn\'t compiled '
-                        'with SSL support'
-                    )
-                    pass
-                map(opener.add_handler, handlers)
-                if platform.python_version_tuple() >= (2, 6):
-                    opener.open(req, timeout=10)
+                    self.verify(url, checker)
+                except ValidationError, e:
+                    lane_results.append((value, e))
                 else:
-                    opener.open(req)
-            except ValueError:
-                raise ValidationError(_(u'Enter a valid URL.'), code='invalid')
-            except: # urllib2.URLError, httplib.InvalidURL, etc.
-                raise broken_error
+                    lane_results.append((value, None))
+
+            return lane_results
+
+        if lanes:
+            logger.debug(
+                'Verifying %d URL\'s for %d hosts',
+                sum(map(len, lanes)), len(hosts)
+            )
+
+            pool = ThreadPool(min(max_workers, len(lanes)))
+            try:
+                for lane_results in pool.imap_unordered(verify_lane, lanes):
+                    results.update(lane_results)
+            finally:
+                pool.close()
+                pool.join()
+
+                if checker is not self.checker:
+                    checker.close()
+
+        # Map results back to the original input values
+        mapped = {}
+        for value, error in results.iteritems():
+            for original in originals[value]:
+                mapped[original] = error
+
+        return mapped
+
+    def get_checker(self):
+        """
+        Return the `LinkChecker` used for verifying URL's. Defaults to the
+        process-wide checker, sharing connections and cached results between
+        all validators.
+        """
+        if self.checker is None:
+            return get_default_checker()
+
+        return self.checker
+
+    def verify(self, url, checker=None):
+        """
+        Verify that the URL exists, raising `ValidationError` if not. Uses
+        `checker` or, by default, the checker returned by `get_checker()`.
+        """
+        url = url.encode('utf-8')
+        # Quote characters from the unreserved set, refs #16812
+        url = urllib.quote(url, "!*'();:@&=+$,/?#[]")
+
+        if checker is None:
+            checker = self.get_checker()
+
+        try:
+            exists = checker.check(
+                url, headers={"User-Agent": self.user_agent})
+        except ValueError:
+            raise ValidationError(_(u'Enter a valid URL.'), code='invalid')
+
+        if not exists:
+            raise ValidationError(
+                _(u'This URL appears to be a broken link.'), code='invalid_link')
 
 
 class RelativeURLValidator(URLValidator):
@@ -137,31 +231,66 @@ class RelativeURLValidator(URLValidator):
         r'(?::\d+)?)?' # optional port
         r'(?:/?|[/?]\S+)$', re.IGNORECASE) # host is optional, allow for relative URLs
 
-    def __call__(self, value):
-        try:
-            # Attempt validation in the superclass: checks full-fledged URL's
-            super(RelativeURLValidator, self).__call__(value)
-        except ValidationError as e:
-            if self.verify_exists and value.startswith('/'):
-                # The URL was invalid, possibly because it is a local URL.
-                # If it starts with '/', attempt to resolve it locally.
-
-                broken_error = ValidationError(
-                    _(u'This URL appears to be a broken link.'),
-                    code='invalid_link'
-                )
+    # Bounded cache of local resolve outcomes, shared by all instances
+    resolve_cache = LRUCache(maxsize=4096)
 
-                # Attempt local validation
-                try:
-                    resolve(value)
+    def is_local(self, value):
+        """ Whether the value is a local URL, ie. '/some/path/'. """
+        return value.startswith('/') and not value.startswith('//')
 
-                except Http404:
-                    logger.info('Could not resolve local URL \'%s\'', value)
-                    raise broken_error
+    def prepare(self, value):
+        if value and self.is_local(value):
+            # Fast path for local URL's, skipping the absolute URL logic
+            if not self.regex.search(smart_unicode(value)) and \
+                    not self.verify_exists:
+                raise ValidationError(self.message, code=self.code)
 
-            else:
-                # Re-raise original error
-                raise e
+            if self.verify_exists:
+                self.verify_local(value)
+
+            return None
+
+        return super(RelativeURLValidator, self).prepare(value)
+
+    def resolves(self, path):
+        """
+        Return whether a local path resolves. Outcomes are cached per
+        resolver, so changing the URLconf or clearing URL caches implies
+        starting afresh.
+        """
+        resolver = get_resolver(get_urlconf())
+        key = (resolver, path)
+
+        result = self.resolve_cache.get(key)
+        if result is None:
+            try:
+                resolver.resolve(path)
+                result = True
+
+            except Http404:
+                result = False
+
+            self.resolve_cache.set(key, result)
+
+        return result
+
+    def verify_local(self, value):
+        """
+        Verify that a local URL resolves, raising `ValidationError` if not.
+
+        Like Django's URL resolving, only the path is considered: the query
+        string and fragment are ignored, so URL's differing only in these
+        share their cached outcome.
+        """
+        path = urlparse.urlsplit(value).path
+
+        if not self.resolves(path):
+            logger.info('Could not resolve local URL \'%s\'', value)
+
+            raise ValidationError(
+                _(u'This URL appears to be a broken link.'),
+                code='invalid_link'
+            )
 
 
 class FileValidator(object):
@@ -177,6 +306,11 @@ class FileValidator(object):
             ie. 100
         max_size: maximum number of bytes allowed
             ie. 24*1024*1024 for 24 MB
+        trust_client: whether to fall back to the content type supplied
+            by the client when the type cannot be sniffed (default False)
+
+    The mimetype is sniffed from the first few KB of the file's contents
+    (see `vspace_utils.files`), the file is never read in its entirety.
 
     Usage example::
 
@@ -196,13 +330,59 @@ class FileValidator(object):
         self.allowed_mimetypes = kwargs.pop('allowed_mimetypes', None)
         self.min_size = kwargs.pop('min_size', 0)
         self.max_size = kwargs.pop('max_size', None)
+        self.trust_client = kwargs.pop('trust_client', False)
+
+    def get_mimetype(self, info):
+        """
+        The mimetype sniffed from the file's header, falling back to the
+        client supplied content type if `trust_client` is set.
+        """
+        mimetype = info.mimetype
+
+        if mimetype is None and self.trust_client:
+            mimetype = info.client_mimetype
+
+        return mimetype or 'application/octet-stream'
 
     def __call__(self, value):
         """
         Check the extension, content type and file size.
         """
-        # Check the extension
-        ext = splitext(value.name)[1][1:].lower()
+        errors = self.get_errors(inspect_file(value))
+
+        if errors:
+            raise errors[0]
+
+    def get_errors(self, info):
+        """
+        Return a list with a `ValidationError` for each failed check, given
+        a `FileInfo` instance.
+        """
+        errors = []
+
+        checks = [
+            # Check the extension
+            (self.check_extension, lambda: info.name),
+            # Check the file size
+            (self.check_size, lambda: info.size),
+        ]
+
+        # Check the content type
+        if self.allowed_mimetypes:
+            checks.insert(1, (self.check_mimetype,
+                              lambda: self.get_mimetype(info)))
+
+        for check, get_value in checks:
+            try:
+                check(get_value())
+            except ValidationError, e:
+                errors.append(e)
+
+        return errors
+
+    def check_extension(self, name):
+        """ Raise a `ValidationError` for disallowed file extensions. """
+        ext = splitext(name)[1][1:].lower()
         if self.allowed_extensions and not ext in self.allowed_extensions:
             message = self.extension_message % {
                 'extension': ext,
@@ -211,8 +391,8 @@ class FileValidator(object):
 
             raise ValidationError(message)
 
-        # Check the content type
-        mimetype = value.file.content_type
+    def check_mimetype(self, mimetype):
+        """ Raise a `ValidationError` for disallowed mimetypes. """
         if self.allowed_mimetypes and not mimetype in self.allowed_mimetypes:
             message = self.mime_message % {
                 'mimetype': mimetype,
@@ -221,8 +401,8 @@ class FileValidator(object):
 
             raise ValidationError(message)
 
-        # Check the file size
-        filesize = value.file._size
+    def check_max_size(self, filesize):
+        """ Raise a `ValidationError` for files exceeding `max_size`. """
         if self.max_size and filesize > self.max_size:
             message = self.max_size_message % {
                 'size': filesizeformat(filesize),
@@ -231,7 +411,11 @@ class FileValidator(object):
 
             raise ValidationError(message)
 
-        elif filesize < self.min_size:
+    def check_size(self, filesize):
+        """ Raise a `ValidationError` for too large or too small files. """
+        self.check_max_size(filesize)
+
+        if filesize < self.min_size:
             message = self.min_size_message % {
                 'size': filesizeformat(filesize),
                 'allowed_size': filesizeformat(self.min_size)
@@ -252,6 +436,9 @@ class ImageDimensionsValidator(object):
 
     Note that allowed_sizes cannot be used together with min_size or max_size.
 
+    Dimensions are parsed from the image headers only, see
+    `vspace_utils.images`.
+
     Usage example::
 
         MyModel(models.Model):
@@ -266,7 +453,7 @@ class ImageDimensionsValidator(object):
     max_size_message = _('Invalid image size %(size)s. Maximum size: %(max_size)s')
 
     def __init__(self, min_size=None, max_size=None, allowed_sizes=[]):
-        assert allowed_sizes and not (min_size or max_size), \
+        assert not (allowed_sizes and (min_size or max_size)), \
             'Either allowed sizes or a combination of min_size and max_size may be set.'
 
         self.allowed_sizes = allowed_sizes
@@ -275,8 +462,25 @@ class ImageDimensionsValidator(object):
         self.max_size = max_size
 
     def __call__(self, value):
-        width, height = get_image_dimensions(value.file)
+        errors = self.get_errors(inspect_file(value))
 
+        if errors:
+            raise errors[0]
+
+    def get_errors(self, info):
+        """
+        Return a list with a `ValidationError` for each failed check, given
+        a `FileInfo` instance.
+        """
+        try:
+            self.check_dimensions(*info.dimensions)
+        except ValidationError, e:
+            return [e]
+
+        return []
+
+    def check_dimensions(self, width, height):
+        """ Raise a `ValidationError` for disallowed dimensions. """
         if self.allowed_sizes and not (width, height) in self.allowed_sizes:
             message = self.invalid_size_message % {
                 'size': '%sx%s' % (width, height),
@@ -311,6 +515,56 @@ class ImageDimensionsValidator(object):
             raise ValidationError(message)
 
 
+class FileValidationPipeline(object):
+    """
+    Run several file validators in a single pass over the file, returning
+    all errors at once.
+
+    The file is inspected only once: its size, sniffed mimetype and image
+    dimensions are computed from a single buffered window and shared
+    between the validators. Validators supporting this implement
+    `get_errors(info)`, taking a `vspace_utils.files.FileInfo` and
+    returning a list of `ValidationError`'s. Other validators are simply
+    called with the file.
+
+    Usage example::
+
+        MyModel(models.Model):
+            image = ImageField(upload_to='mymodel_images',
+                validators=[FileValidationPipeline([
+                    FileValidator(max_size=24*1024*1024),
+                    ImageDimensionsValidator(min_size=(200, 100))
+                ])])
+    """
+
+    def __init__(self, validators):
+        self.validators = validators
+
+    def get_errors(self, info):
+        errors = []
+
+        for validator in self.validators:
+            if hasattr(validator, 'get_errors'):
+                errors.extend(validator.get_errors(info))
+            else:
+                try:
+                    validator(info.value)
+                except ValidationError, e:
+                    errors.append(e)
+
+        return errors
+
+    def __call__(self, value):
+        errors = self.get_errors(inspect_file(value))
+
+        if errors:
+            messages = []
+            for error in errors:
+                messages.extend(error.messages)
+
+            raise ValidationError(messages)
+
+
 class ExactLengthValidator(BaseValidator):
     compare = lambda self, a, b: a != b
     clean = lambda self, x: len(x)